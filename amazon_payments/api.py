@@ -2,19 +2,129 @@ import datetime
 import hmac
 import hashlib
 import base64
+import inspect
+import re
+import time
 from urllib import urlencode, quote
-from urlparse import urlparse
+from urlparse import urlparse, parse_qs
 import logging
 from decimal import Decimal
 
-import requests
+from amazon_payments.bulk import run_in_threads
+from amazon_payments.lazy import LazyModule
+from amazon_payments.throttling import BULK, NORMAL
 
-from bs4 import BeautifulSoup
+# Imported on first use; bs4 brings in lxml, which is slow to import.
+requests = LazyModule("requests")
+bs4 = LazyModule("bs4")
 
 logger = logging.getLogger("amazon_payments")
 
 DEFAULT_API_URL = "https://mws.amazonservices.com/OffAmazonPayments/2013-01-01"
 
+# Amazon identifiers that are extracted from a request / response pair into
+# their own columns when a transaction is logged.
+TRANSACTION_ID_FIELDS = (
+    ("order_reference_id", "AmazonOrderReferenceId"),
+    ("authorization_id", "AmazonAuthorizationId"),
+    ("capture_id", "AmazonCaptureId"),
+)
+# The capture IDs in an authorization's IdList
+CAPTURE_ID_MEMBER_RE = re.compile(r"<member>\s*([^<\s]+-C\d+)\s*</member>")
+
+# Actions that move money. If one of these calls times out, Amazon may
+# still have made the charge or refund.
+MONEY_MOVING_ACTIONS = (
+    "Authorize",
+    "AuthorizeOnBillingAgreement",
+    "Capture",
+    "Refund",
+)
+
+# Status lookups whose responses can be kept in the API's status cache,
+# with the parameter holding the ID they're for, the tag holding the state
+# and the terminal states, which are cached for longer.
+CACHED_ACTIONS = {
+    "GetAuthorizationDetails": (
+        "AmazonAuthorizationId", "AuthorizationStatus",
+        ("Closed", "Declined")),
+    "GetOrderReferenceDetails": (
+        "AmazonOrderReferenceId", "OrderReferenceStatus",
+        ("Closed", "Canceled")),
+}
+
+
+def _find_tag(tag, xml):
+    match = re.search(r"<%s>([^<]+)</%s>" % (tag, tag), xml)
+    if match:
+        return match.group(1).strip()
+
+
+def get_order_reference_id(amazon_id):
+    """
+    Returns the ID of the order reference that an authorization, capture
+    or refund ID belongs to (e.g. S01-6576755-3809974 for the
+    authorization S01-6576755-3809974-A067494), or None if the ID isn't
+    one of those.
+    """
+    parts = (amazon_id or "").split("-")
+    if len(parts) == 4:
+        return "-".join(parts[:3])
+
+
+def _call_callback(callback, raw_request, raw_response, **details):
+    """
+    Calls a do_request callback, passing it only the call details it
+    accepts, so callbacks taking just the raw request and response still
+    work.
+    """
+    func = callback
+    if not (inspect.isfunction(func) or inspect.ismethod(func)):
+        func = getattr(func, "__call__", None)
+    try:
+        args, varargs, keywords, defaults = inspect.getargspec(func)
+    except TypeError:
+        args, keywords = [], None
+    if keywords is None:
+        details = dict((name, value) for name, value in details.items()
+                       if name in args)
+    return callback(raw_request, raw_response, **details)
+
+
+def get_transaction_details(raw_request, raw_response, action=None):
+    """
+    Extracts the action, error code, request ID and Amazon identifiers
+    from a raw request URL and raw XML response, as passed to a
+    `do_request` callback.
+
+    A regular expression scan is used instead of a full XML parse so
+    that this can be run cheaply on every call and over historical
+    transactions.
+    """
+    raw_request = raw_request or ""
+    raw_response = raw_response or ""
+    params = dict((key, values[0]) for key, values in
+                  parse_qs(urlparse(raw_request).query).items())
+    details = {
+        "action": action or params.get("Action", ""),
+        "error_code": None,
+        "request_id": (_find_tag("RequestId", raw_response) or
+                       _find_tag("RequestID", raw_response)),
+    }
+    if "<ErrorResponse" in raw_response:
+        details["error_code"] = _find_tag("Code", raw_response)
+    elif raw_response.startswith("InvalidOrderReferenceStatus"):
+        details["error_code"] = "InvalidOrderReferenceStatus"
+    for field, tag in TRANSACTION_ID_FIELDS:
+        details[field] = _find_tag(tag, raw_response) or params.get(tag)
+    if details["capture_id"] is None:
+        # Authorizations made with CaptureNow only list their capture's ID
+        # in IdList
+        match = CAPTURE_ID_MEMBER_RE.search(raw_response)
+        if match:
+            details["capture_id"] = match.group(1)
+    return details
+
 
 class AmazonPaymentsAPIError(Exception):
     pass
@@ -24,7 +134,9 @@ class AmazonPaymentsAPI(object):
 
     def __init__(self, access_key, secret_key, seller_id,
                  endpoint=DEFAULT_API_URL, version="2013-01-01", is_live=False,
-                 exception_class=AmazonPaymentsAPIError):
+                 exception_class=AmazonPaymentsAPIError, timeout=None,
+                 concurrency_controller=None, rate_limiter=None,
+                 priority=NORMAL, status_cache=None, rate_limit_wait=None):
 
         self.access_key = access_key
         self.secret_key = secret_key
@@ -33,6 +145,22 @@ class AmazonPaymentsAPI(object):
         self.version = version
         self.is_live = is_live
         self.exception_class = exception_class
+        # Seconds to wait for Amazon to respond, so that a slow call can't
+        # tie up the worker serving the request indefinitely.
+        self.timeout = timeout
+        # Optionally limits the calls in flight across threads (see
+        # throttling.ConcurrencyController), for bulk jobs.
+        self.concurrency_controller = concurrency_controller
+        # Optionally shared with other API users (see
+        # locks.SharedRateLimiter), which calls made by this API wait for
+        # with the given priority unless do_request is told otherwise, for
+        # up to rate_limit_wait seconds if set.
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+        self.rate_limit_wait = rate_limit_wait
+        # Optionally caches the responses of CACHED_ACTIONS (see
+        # caching.StatusCache).
+        self.status_cache = status_cache
 
     def _quote(self, value):
         return quote(value).replace('%7E', '~')
@@ -69,26 +197,89 @@ class AmazonPaymentsAPI(object):
         return _data
 
     def do_request(self, action, params={}, process=True, callback=None,
-                   **kwargs):
+                   priority=None, use_cache=True, **kwargs):
         """
         Performs a call to the Amazon Payments API, then calls the
         callback function (if set) with 2 positional arguments:
-        the raw request and the raw response.
+        the raw request and the raw response. Callbacks that accept them
+        are also passed the keyword arguments `action`, `status_code` and
+        `latency` (in seconds).
+
+        Raises exception_class with the code "RequestFailed" if Amazon
+        can't be reached or doesn't respond within the timeout. For
+        MONEY_MOVING_ACTIONS, the code is "OutcomeUnknown" unless the
+        connection couldn't be made, as Amazon may have moved the money.
+
+        If the API has a rate limiter, this waits for it with the given
+        priority (or the API's), and raises exception_class with the code
+        "RequestThrottled" without making the call if it would have to
+        wait for longer than the API's rate_limit_wait. If it has a
+        concurrency controller, this waits for it before making the call,
+        and reports whether it was throttled.
+
+        If the API has a status cache, cached responses of CACHED_ACTIONS
+        are returned from it without making a call (so the callback isn't
+        called), unless use_cache=False, in which case the call is always
+        made. Other calls invalidate the cached statuses of the IDs they're
+        made for and of their order references.
 
         Returns a 2-tuple with:
         - a BeautifulSoup Tag object if process=True or the raw XML
           response if process=False
         - the result of the callback function if it was set, else None.
         """
+        if use_cache:
+            cached = self.get_cached_status(action, params)
+            if cached is not None:
+                logger.info("Using cached %s response" % action)
+                return (self.process_response(cached) if process
+                        else cached), None
         logger.info("Performing %s action" % action)
         params["Action"] = action
         params = self._add_required_parameters(params)
         logger.debug("Request data: %s" % params)
         kwargs["params"] = params
-        response = requests.post(self.endpoint, **kwargs)
+        if self.timeout is not None:
+            kwargs.setdefault("timeout", self.timeout)
+        if self.rate_limiter is not None and not self.rate_limiter.acquire(
+                priority or self.priority, timeout=self.rate_limit_wait):
+            logger.warning("%s call not made, as the rate limit would be "
+                           "exceeded" % action)
+            raise self.exception_class(
+                "RequestThrottled", "The request rate limit was exceeded")
+        controller = self.concurrency_controller
+        token = controller.acquire() if controller is not None else None
+        start = time.time()
+        try:
+            response = requests.post(self.endpoint, **kwargs)
+        except Exception, e:
+            if controller is not None:
+                controller.release(token, throttled=True)
+            # The call may still have changed the state on Amazon's side
+            self.invalidate_cached_statuses(action, params)
+            if not isinstance(e, requests.RequestException):
+                raise
+            logger.warning("%s request failed after %.2fs: %s" % (
+                action, time.time() - start, e))
+            if (action in MONEY_MOVING_ACTIONS and
+                    not isinstance(e, requests.ConnectTimeout)):
+                # The call may have been made, so it mustn't be retried with
+                # another reference ID before checking its outcome.
+                raise self.exception_class("OutcomeUnknown", unicode(e))
+            raise self.exception_class("RequestFailed", unicode(e))
+        latency = time.time() - start
+        if controller is not None:
+            controller.release(token, latency, throttled=(
+                response.status_code == 503 or
+                "<Code>RequestThrottled</Code>" in response.content))
         logger.debug("Amazon response: \n%s", response.content)
+        self.invalidate_cached_statuses(action, params)
+        if response.status_code == 200:
+            self.cache_status(action, params, response.content)
         if callback:
-            tx = callback(response.url, response.content)
+            tx = _call_callback(
+                callback, response.url, response.content, action=action,
+                status_code=response.status_code, latency=latency)
         else:
             tx = None
         if process:
@@ -101,12 +292,68 @@ class AmazonPaymentsAPI(object):
             value = response.content
         return value, tx
 
+    def get_cached_status(self, action, params):
+        if self.status_cache is None or action not in CACHED_ACTIONS:
+            return None
+        id_param = CACHED_ACTIONS[action][0]
+        return self.status_cache.get(action, params[id_param])
+
+    def cache_status(self, action, params, response):
+        if self.status_cache is None or action not in CACHED_ACTIONS:
+            return
+        id_param, status_tag, terminal_states = CACHED_ACTIONS[action]
+        match = re.search(r"<%s>(.*?)</%s>" % (status_tag, status_tag),
+                          response, re.DOTALL)
+        if match is None:
+            # An error, or an unexpected response
+            return
+        state = _find_tag("State", match.group(1))
+        self.status_cache.set(action, params[id_param], response,
+                              terminal=state in terminal_states)
+
+    def invalidate_cached_statuses(self, action, params):
+        """
+        Drops the cached statuses of the IDs a call other than a status
+        lookup was made for, and of their order references, as it may have
+        changed them (e.g. a Capture changes the state of the authorization
+        and of its order reference, and an Authorize can close the order
+        reference's other authorizations).
+        """
+        if self.status_cache is None or action in CACHED_ACTIONS:
+            return
+        order_reference_id = params.get("AmazonOrderReferenceId")
+        for id_param in ("AmazonAuthorizationId", "AmazonCaptureId",
+                         "AmazonRefundId"):
+            order_reference_id = (order_reference_id or
+                                  get_order_reference_id(params.get(id_param)))
+        self.invalidate_status(
+            order_reference_id, params.get("AmazonAuthorizationId"))
+
+    def invalidate_status(self, order_reference_id=None,
+                          authorization_id=None):
+        """
+        Drops the cached statuses of an order reference and all of its
+        authorizations, and/or of an authorization and its order reference,
+        e.g. when an IPN says they've changed.
+        """
+        if self.status_cache is None:
+            return
+        if authorization_id:
+            self.status_cache.invalidate(
+                "GetAuthorizationDetails", authorization_id)
+            order_reference_id = (order_reference_id or
+                                  get_order_reference_id(authorization_id))
+        if order_reference_id:
+            self.status_cache.invalidate(
+                "GetOrderReferenceDetails", order_reference_id)
+            self.status_cache.invalidate_order_reference(order_reference_id)
+
     def process_response(self, response):
         """
         Create a BeautifulSoup object from the XML response gotten from
         Amazon.
         """
-        soup = BeautifulSoup(response, 'xml')
+        soup = bs4.BeautifulSoup(response, 'xml')
         if soup.ErrorResponse:
             error = soup.ErrorResponse.Error
             raise self.exception_class(error.Code.text, error.Message.text)
@@ -117,23 +364,39 @@ class AmazonPaymentsAPI(object):
                                        response[28:])
         return soup
 
+    def get_billing_agreement_details(self, billing_agreement_id,
+                                      access_token, **kwargs):
+        """
+        Performs a GetBillingAgreementDetails request and returns the
+        response (see do_request).
+        """
+        return self.do_request(
+            "GetBillingAgreementDetails",
+            {"AmazonBillingAgreementId": billing_agreement_id,
+             "AddressConsentToken": access_token}, **kwargs)[0]
+
     def get_amazon_order_details(self, billing_agreement_id, access_token,
                                  has_subscriptions=False,
                                  validate_shipping_address=True,
                                  validate_payment_details=True,
-                                 valid_shipping_countries=[], **kwargs):
+                                 valid_shipping_countries=[],
+                                 raw_response=None, **kwargs):
         """
         Preforms a GetBillingAgreementDetails request, and checks if
         there the user has set a valid shipping address (if
         validate_shipping_address is True) and/or there is a valid
         payment method (if validate_payment_details is True).
+
+        If raw_response is set, it's checked instead of making the request,
+        e.g. for details fetched earlier by get_billing_agreement_details.
         """
         # Cannot call do_request with process=False here
         kwargs.pop("process", None)
-        response = self.do_request(
-            "GetBillingAgreementDetails",
-            {"AmazonBillingAgreementId": billing_agreement_id,
-             "AddressConsentToken": access_token}, **kwargs)[0]
+        if raw_response is None:
+            response = self.get_billing_agreement_details(
+                billing_agreement_id, access_token, **kwargs)
+        else:
+            response = self.process_response(raw_response)
         amazon_order_details = response\
             .GetBillingAgreementDetailsResponse\
             .GetBillingAgreementDetailsResult\
@@ -238,16 +501,201 @@ class AmazonPaymentsAPI(object):
             .AmazonAuthorizationId.text
         return authorization_id, tx
 
-    def get_authorization_status(self, authorization_id, **kwargs):
+    def authorize_on_billing_agreement(self, billing_agreement_id, auth_ref,
+                                       amount, currency, **kwargs):
+        """
+        Performs an "AuthorizeOnBillingAgreement" API call, which charges a
+        billing agreement without the buyer being present, and returns the
+        authorization ID, the AuthorizationStatus tag and the result of
+        running the callback function if it was set.
+
+        Amazon rejects reused AuthorizationReferenceIds, so retrying a call
+        with the same auth_ref can't charge the buyer twice.
+        """
+        # Cannot call do_request with process=False here
+        kwargs.pop("process", None)
+        response, tx = self.do_request(
+            "AuthorizeOnBillingAgreement",
+            {"AmazonBillingAgreementId": billing_agreement_id,
+             "AuthorizationReferenceId": auth_ref,
+             "AuthorizationAmount.Amount": amount,
+             "AuthorizationAmount.CurrencyCode": currency,
+             "CaptureNow": "true",
+             "TransactionTimeout": 0}, **kwargs)
+        auth_details = response\
+            .AuthorizeOnBillingAgreementResponse\
+            .AuthorizeOnBillingAgreementResult\
+            .AuthorizationDetails
+        return (auth_details.AmazonAuthorizationId.text,
+                auth_details.AuthorizationStatus, tx)
+
+    def capture(self, authorization_id, capture_ref, amount, currency,
+                **kwargs):
+        """
+        Performs a "Capture" API call for an open authorization, and returns
+        the capture ID, the CaptureStatus tag and the result of running the
+        callback function if it was set.
+        """
+        # Cannot call do_request with process=False here
+        kwargs.pop("process", None)
+        response, tx = self.do_request(
+            "Capture",
+            {"AmazonAuthorizationId": authorization_id,
+             "CaptureReferenceId": capture_ref,
+             "CaptureAmount.Amount": amount,
+             "CaptureAmount.CurrencyCode": currency}, **kwargs)
+        capture_details = response\
+            .CaptureResponse\
+            .CaptureResult\
+            .CaptureDetails
+        return (capture_details.AmazonCaptureId.text,
+                capture_details.CaptureStatus, tx)
+
+    def refund(self, capture_id, refund_ref, amount, currency, **kwargs):
+        """
+        Performs a "Refund" API call for a capture, and returns the refund
+        ID, the RefundStatus tag and the result of running the callback
+        function if it was set.
+        """
+        # Cannot call do_request with process=False here
+        kwargs.pop("process", None)
+        response, tx = self.do_request(
+            "Refund",
+            {"AmazonCaptureId": capture_id,
+             "RefundReferenceId": refund_ref,
+             "RefundAmount.Amount": amount,
+             "RefundAmount.CurrencyCode": currency}, **kwargs)
+        refund_details = response\
+            .RefundResponse\
+            .RefundResult\
+            .RefundDetails
+        return (refund_details.AmazonRefundId.text,
+                refund_details.RefundStatus, tx)
+
+    def close_order_reference(self, order_reference_id, reason=None,
+                              **kwargs):
+        """
+        Performs a "CloseOrderReference" API call, after which no more
+        authorizations can be made on the order reference. Returns the
+        result of running the callback function if it was set.
+        """
+        params = {"AmazonOrderReferenceId": order_reference_id}
+        if reason:
+            params["ClosureReason"] = reason
+        kwargs.pop("process", None)
+        return self.do_request("CloseOrderReference", params, **kwargs)[1]
+
+    def cancel_order_reference(self, order_reference_id, reason=None,
+                               **kwargs):
+        """
+        Performs a "CancelOrderReference" API call, which cancels an order
+        reference that hasn't been captured yet and closes its open
+        authorizations. Returns the result of running the callback function
+        if it was set.
+        """
+        params = {"AmazonOrderReferenceId": order_reference_id}
+        if reason:
+            params["CancelationReason"] = reason
+        kwargs.pop("process", None)
+        return self.do_request("CancelOrderReference", params, **kwargs)[1]
+
+    def run_bulk(self, method, operations, workers=4, rate_limiter=None,
+                 **kwargs):
+        """
+        Calls method (e.g. self.capture) with each of the given argument
+        tuples (and kwargs) from `workers` threads, waiting for the rate
+        limiter (if given) at bulk priority before each call. Yields
+        (arguments, result, error) tuples as the calls finish; error is the
+        exception raised by the call, if any, in which case result is None.
+
+        A callback given in kwargs is called from the worker threads.
+        """
+        def call(args):
+            if rate_limiter is not None:
+                rate_limiter.acquire(BULK)
+            return method(*args, **kwargs)
+
+        for args, result, exc_info in run_in_threads(
+                call, operations, workers):
+            yield args, result, exc_info[1] if exc_info else None
+
+    def bulk_capture(self, captures, **kwargs):
+        """
+        Runs capture for each of the given (authorization ID, capture
+        reference, amount, currency) tuples. See run_bulk.
+        """
+        return self.run_bulk(self.capture, captures, **kwargs)
+
+    def bulk_refund(self, refunds, **kwargs):
+        """
+        Runs refund for each of the given (capture ID, refund reference,
+        amount, currency) tuples. See run_bulk.
+        """
+        return self.run_bulk(self.refund, refunds, **kwargs)
+
+    def bulk_close_order_reference(self, order_references, **kwargs):
+        """
+        Runs close_order_reference for each of the given (order reference
+        ID, reason) tuples. See run_bulk.
+        """
+        return self.run_bulk(
+            self.close_order_reference, order_references, **kwargs)
+
+    def bulk_cancel_order_reference(self, order_references, **kwargs):
+        """
+        Runs cancel_order_reference for each of the given (order reference
+        ID, reason) tuples. See run_bulk.
+        """
+        return self.run_bulk(
+            self.cancel_order_reference, order_references, **kwargs)
+
+    def get_order_reference_details(self, order_reference_id, **kwargs):
+        """
+        Performs a "GetOrderReferenceDetails" API call and returns the
+        OrderReferenceDetails tag.
+        """
+        # Cannot call do_request with process=False here
+        kwargs.pop("process", None)
+        response = self.do_request(
+            "GetOrderReferenceDetails",
+            {"AmazonOrderReferenceId": order_reference_id}, **kwargs)[0]
+        return response\
+            .GetOrderReferenceDetailsResponse\
+            .GetOrderReferenceDetailsResult\
+            .OrderReferenceDetails
+
+    def get_authorization_details(self, authorization_id, **kwargs):
         # Cannot call do_request with process=False here
         kwargs.pop("process", None)
         response = self.do_request(
             "GetAuthorizationDetails",
             {"AmazonAuthorizationId": authorization_id}, **kwargs)[0]
-        amazon_auth_details = response\
+        return response\
             .GetAuthorizationDetailsResponse\
             .GetAuthorizationDetailsResult\
             .AuthorizationDetails
+
+    def find_authorization(self, order_reference_id, auth_ref, **kwargs):
+        """
+        Returns the ID of the authorization of an order reference that was
+        made with the given AuthorizationReferenceId, or None if there isn't
+        one, e.g. to check the outcome of an Authorize call that timed out.
+        """
+        kwargs["use_cache"] = False
+        details = self.get_order_reference_details(
+            order_reference_id, **kwargs)
+        members = details.IdList.find_all("member") if details.IdList else []
+        for member in members:
+            auth_details = self.get_authorization_details(
+                member.text.strip(), **kwargs)
+            if (auth_details.AuthorizationReferenceId and
+                    auth_details.AuthorizationReferenceId.text == auth_ref):
+                return auth_details.AmazonAuthorizationId.text
+        return None
+
+    def get_authorization_status(self, authorization_id, **kwargs):
+        amazon_auth_details = self.get_authorization_details(
+            authorization_id, **kwargs)
         auth_status = amazon_auth_details.AuthorizationStatus
         try:
             auth_amount = amazon_auth_details.CapturedAmount.Amount.text
@@ -0,0 +1,42 @@
+import Queue
+import sys
+import threading
+
+
+def run_in_threads(func, items, workers=4):
+    """
+    Calls func(item) for each item from `workers` threads, and yields
+    (item, result, exc_info) tuples in the order the calls finish. exc_info
+    is None unless the call raised an exception, in which case result is
+    None.
+
+    Only func runs in the threads, so it should only do I/O such as API
+    calls. The results should be saved by the caller, in its own thread and
+    DB connection.
+    """
+    items = list(items)
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+    done = Queue.Queue()
+
+    def work():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((item, func(item), None))
+            except Exception:
+                done.put((item, None, sys.exc_info()))
+
+    threads = [threading.Thread(target=work)
+               for i in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for i in range(len(items)):
+        yield done.get()
+    for thread in threads:
+        thread.join()
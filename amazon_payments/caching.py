@@ -0,0 +1,69 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from amazon_payments.api import get_order_reference_id
+
+
+class StatusCache(object):
+    """
+    Keeps the raw responses of status lookups (see api.CACHED_ACTIONS) in
+    the Django cache. Terminal states are kept for `terminal_timeout`
+    seconds unless invalidated, and other states for `timeout` seconds.
+
+    The keys of the statuses of an order reference's authorizations (and
+    captures and refunds) include a version kept for the order reference,
+    so that they can all be invalidated at once with
+    invalidate_order_reference.
+    """
+
+    def __init__(self, timeout=60, terminal_timeout=24 * 60 * 60):
+        self.timeout = timeout
+        self.terminal_timeout = terminal_timeout
+
+    def get_version_key(self, order_reference_id):
+        return "amazon_payments_status_version:%s" % order_reference_id
+
+    def get_key(self, action, amazon_id):
+        key = "amazon_payments_status:%s:%s" % (action, amazon_id)
+        order_reference_id = get_order_reference_id(amazon_id)
+        if order_reference_id:
+            version = cache.get(self.get_version_key(order_reference_id))
+            if version:
+                key = "%s:%s" % (key, version)
+        return key
+
+    def get(self, action, amazon_id):
+        return cache.get(self.get_key(action, amazon_id))
+
+    def set(self, action, amazon_id, response, terminal=False):
+        cache.set(self.get_key(action, amazon_id), response,
+                  self.terminal_timeout if terminal else self.timeout)
+
+    def invalidate(self, action, amazon_id):
+        cache.delete(self.get_key(action, amazon_id))
+
+    def invalidate_order_reference(self, order_reference_id):
+        """
+        Drops the cached statuses of everything belonging to an order
+        reference, such as its authorizations.
+        """
+        # The statuses cached before this version was set expire before it
+        # does, so they can't come back once it has expired.
+        cache.set(self.get_version_key(order_reference_id), uuid.uuid4().hex,
+                  max(self.timeout, self.terminal_timeout))
+
+
+def get_status_cache():
+    """
+    Returns a StatusCache using the AMAZON_PAYMENTS_STATUS_CACHE_TIMEOUT and
+    AMAZON_PAYMENTS_STATUS_CACHE_TERMINAL_TIMEOUT settings, or None if the
+    former is 0.
+    """
+    timeout = getattr(settings, "AMAZON_PAYMENTS_STATUS_CACHE_TIMEOUT", 60)
+    if not timeout:
+        return None
+    return StatusCache(timeout, getattr(
+        settings, "AMAZON_PAYMENTS_STATUS_CACHE_TERMINAL_TIMEOUT",
+        24 * 60 * 60))
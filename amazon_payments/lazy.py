@@ -0,0 +1,54 @@
+import importlib
+import threading
+
+_lock = threading.Lock()
+
+
+class LazyModule(object):
+    """
+    Stands in for a module that's only imported when one of its attributes
+    is first used, so importing amazon_payments doesn't pull in requests,
+    bs4 and lxml until an API call is made.
+
+    Attributes are looked up on the real module each time, so patching
+    e.g. requests.post still works.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        if self._module is None:
+            with _lock:
+                if self._module is None:
+                    self.__dict__["_module"] = importlib.import_module(
+                        self._name)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        return "<lazy module %r>" % self._name
+
+
+def lazy_view(module, name, **initkwargs):
+    """
+    Returns a view function for the class based view `name` in `module`,
+    which imports the module (and calls as_view) on the first request
+    rather than when the URLconf is loaded.
+    """
+    views = []
+
+    def view(request, *args, **kwargs):
+        if not views:
+            view_class = getattr(importlib.import_module(module), name)
+            views.append(view_class.as_view(**initkwargs))
+        return views[0](request, *args, **kwargs)
+    view.__name__ = name
+    view.__module__ = module
+    return view
@@ -0,0 +1,82 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from amazon_payments.throttling import NORMAL, RateLimiter
+
+
+class CacheLock(object):
+    """
+    A lock shared by all processes using the same Django cache backend.
+
+    The lock expires after `timeout` seconds, so that a crashed process
+    can't hold it forever. It should therefore be longer than the work done
+    while holding it.
+    """
+
+    def __init__(self, key, timeout=60, poll_interval=0.05):
+        self.key = "amazon_payments_lock:%s" % key
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.token = None
+
+    def acquire(self, wait=0):
+        """
+        Tries to acquire the lock for up to `wait` seconds. Returns True if
+        the lock was acquired.
+        """
+        token = uuid.uuid4().hex
+        deadline = time.time() + wait
+        while not cache.add(self.key, token, self.timeout):
+            if time.time() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+        self.token = token
+        return True
+
+    def release(self):
+        # Don't release a lock that expired and was taken by someone else.
+        if self.token and cache.get(self.key) == self.token:
+            cache.delete(self.key)
+        self.token = None
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    A RateLimiter whose bucket is kept in the Django cache, so that it's
+    shared by all the processes using the same cache backend (e.g. the web
+    servers handling checkouts and the nodes running bulk jobs).
+    """
+
+    def __init__(self, name, rate, burst=1, headroom=None):
+        super(SharedRateLimiter, self).__init__(rate, burst, headroom)
+        self.key = "amazon_payments_rate:%s" % name
+        self.lock_key = "rate:%s" % name
+
+    def try_acquire(self, priority=NORMAL):
+        lock = CacheLock(self.lock_key, timeout=5)
+        if not lock.acquire(wait=1):
+            return lock.poll_interval
+        try:
+            now = time.time()
+            tokens, updated_at = cache.get(self.key) or (self.burst, now)
+            tokens, wait = self._take(tokens, updated_at, now, priority)
+            cache.set(self.key, (tokens, now), None)
+            return wait
+        finally:
+            lock.release()
+
+
+def get_shared_rate_limiter():
+    """
+    Returns the SharedRateLimiter configured with the
+    AMAZON_PAYMENTS_SHARED_RATE_LIMIT setting, or None if it isn't set.
+    """
+    config = getattr(settings, "AMAZON_PAYMENTS_SHARED_RATE_LIMIT", None)
+    if not config:
+        return None
+    return SharedRateLimiter(
+        "mws", config["rate"], config.get("burst", 1),
+        config.get("headroom"))
@@ -0,0 +1,41 @@
+import random
+
+from django.conf import settings
+
+from amazon_payments.api import MONEY_MOVING_ACTIONS
+
+
+class TransactionLogPolicy(object):
+    """
+    Decides how much of an MWS call is saved to the transaction log.
+
+    Errors and money-moving actions are always saved in full, i.e. with the
+    raw request and response, as they may be needed to settle disputes.
+    Other (successful) calls are saved in full at the given sample rate, and
+    the rest are saved as summaries that only contain the structured
+    columns.
+    """
+
+    FULL, SUMMARY = "full", "summary"
+
+    def __init__(self, sample_rate=1.0, always_full_actions=None):
+        self.sample_rate = sample_rate
+        if always_full_actions is None:
+            always_full_actions = MONEY_MOVING_ACTIONS
+        self.always_full_actions = frozenset(always_full_actions)
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            getattr(settings, "AMAZON_PAYMENTS_LOG_SAMPLE_RATE", 1.0),
+            getattr(settings, "AMAZON_PAYMENTS_LOG_ALWAYS_FULL_ACTIONS",
+                    None))
+
+    def get_level(self, action, error_code=None, status_code=None):
+        if error_code or (status_code and status_code >= 400):
+            return self.FULL
+        if action in self.always_full_actions:
+            return self.FULL
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            return self.FULL
+        return self.SUMMARY
@@ -0,0 +1,86 @@
+import logging
+from collections import deque
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from amazon_payments.api import get_transaction_details
+from amazon_payments.models import AmazonPaymentsTransaction
+
+logger = logging.getLogger("amazon_payments")
+
+
+def parse_rows(rows):
+    """
+    Parses a batch of (pk, raw request, raw response) tuples. Defined at
+    module level so that it can be run in a worker process.
+    """
+    return [(pk, get_transaction_details(request, response))
+            for pk, request, response in rows]
+
+
+class Command(BaseCommand):
+    help = ("Fills in the structured columns of Amazon Payments transactions "
+            "logged before they were extracted at request time.")
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", default=1000,
+                    help="Number of transactions parsed and updated per "
+                         "batch."),
+        make_option("--workers", type="int", default=1,
+                    help="Number of processes used to parse batches."),
+        make_option("--all", action="store_true", default=False,
+                    help="Re-parse transactions that have already been "
+                         "backfilled."),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        workers = options["workers"]
+        queryset = AmazonPaymentsTransaction.objects.order_by("pk")
+        if not options["all"]:
+            queryset = queryset.filter(action__isnull=True)
+
+        updated = 0
+        pool = Pool(workers) if workers > 1 else None
+        pending = deque()
+        try:
+            for rows in self.get_batches(queryset, batch_size):
+                if pool is None:
+                    updated += self.save_batch(parse_rows(rows))
+                    continue
+                # Keep at most one batch in flight per worker, so memory
+                # use doesn't grow with the size of the table.
+                pending.append(pool.apply_async(parse_rows, (rows,)))
+                if len(pending) >= workers:
+                    updated += self.save_batch(pending.popleft().get())
+            while pending:
+                updated += self.save_batch(pending.popleft().get())
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.stdout.write("Backfilled %s transactions." % updated)
+
+    def get_batches(self, queryset, batch_size):
+        """
+        Yields batches of raw transactions in primary key order, using
+        keyset pagination so that each batch is a cheap index range scan.
+        """
+        last_pk = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk).values_list(
+                "pk", "request", "response")[:batch_size])
+            if not rows:
+                return
+            last_pk = rows[-1][0]
+            yield rows
+
+    def save_batch(self, parsed_rows):
+        with transaction.atomic():
+            for pk, details in parsed_rows:
+                AmazonPaymentsTransaction.objects.filter(pk=pk).update(
+                    **details)
+        logger.debug("Backfilled transactions up to #%s" % parsed_rows[-1][0])
+        return len(parsed_rows)
@@ -0,0 +1,255 @@
+import csv
+import hashlib
+import logging
+import Queue
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from amazon_payments import AmazonPaymentsAPI
+from amazon_payments.api import (
+    MONEY_MOVING_ACTIONS, get_order_reference_id, get_transaction_details)
+from amazon_payments.caching import get_status_cache
+from amazon_payments.locks import get_shared_rate_limiter
+from amazon_payments.logging_policy import TransactionLogPolicy
+from amazon_payments.models import (
+    AmazonPaymentsSession, AmazonPaymentsTransaction,
+    AmazonPaymentsAuthAttempt)
+from amazon_payments.throttling import (
+    BULK, ConcurrencyController, RateLimiter)
+
+logger = logging.getLogger("amazon_payments")
+
+ACTIONS = ("capture", "refund", "close", "cancel")
+
+# The state sessions are moved to after each successful operation. Captures
+# and refunds are only successful once their state is Completed.
+SESSION_STATES = {
+    "capture": AmazonPaymentsSession.CAPTURED,
+    "refund": AmazonPaymentsSession.REFUNDED,
+    "close": AmazonPaymentsSession.CLOSED,
+    "cancel": AmazonPaymentsSession.CLOSED,
+}
+
+REPORT_FIELDS = ("line", "action", "amazon_id", "reference_id", "result",
+                 "result_id", "state", "error_code", "error_message")
+
+
+def generate_reference_id(action, amazon_id, amount):
+    """
+    Returns a CaptureReferenceId for an operation. It's derived from the
+    operation, so running the same file again can't capture anything
+    twice.
+    """
+    digest = hashlib.sha1(
+        "%s:%s:%s" % (action, amazon_id, amount)).hexdigest()
+    return action[0] + digest[:31]
+
+
+class Command(BaseCommand):
+    args = "<operations.csv>"
+    help = ("Runs a batch of Amazon Payments operations from a CSV file with "
+            "the columns action (capture, refund, close or cancel), "
+            "amazon_id (the authorization, capture or order reference ID), "
+            "amount, currency, reference_id (required for refunds) and reason "
+            "(for close and cancel). Writes a CSV report with the result of "
+            "each operation as it finishes: ok, pending (for captures and "
+            "refunds that Amazon is still processing), declined or error.")
+    option_list = BaseCommand.option_list + (
+        make_option("--workers", type="int", default=4,
+                    help="Number of threads making API calls."),
+        make_option("--adaptive", action="store_true", default=False,
+                    help="Start with one call at a time, and adjust the "
+                         "number of calls in flight (up to --workers) to "
+                         "how Amazon is responding."),
+        make_option("--rate", type="float", default=1,
+                    help="Maximum average number of API calls per second."),
+        make_option("--burst", type="int", default=10,
+                    help="Maximum number of API calls in a burst."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Exactly one operations file must be given.")
+        api = AmazonPaymentsAPI(
+            settings.AMAZON_PAYMENTS_ACCESS_KEY,
+            settings.AMAZON_PAYMENTS_SECRET_KEY,
+            settings.AMAZON_PAYMENTS_SELLER_ID,
+            settings.AMAZON_PAYMENTS_API_ENDPOINT,
+            settings.AMAZON_PAYMENTS_API_VERSION,
+            settings.AMAZON_PAYMENTS_IS_LIVE,
+            timeout=getattr(settings, "AMAZON_PAYMENTS_API_TIMEOUT", 30),
+            concurrency_controller=(
+                ConcurrencyController(options["workers"])
+                if options["adaptive"] else None),
+            rate_limiter=get_shared_rate_limiter(), priority=BULK,
+            status_cache=get_status_cache(),
+        )
+        self.transaction_log_policy = TransactionLogPolicy.from_settings()
+        with open(args[0], "rb") as operations_file:
+            operations = self.read_operations(operations_file)
+        # Calls are logged from this thread, as they finish.
+        calls = Queue.Queue()
+
+        def callback(raw_request, raw_response, **kwargs):
+            calls.put((raw_request, raw_response, kwargs))
+
+        self.methods = {
+            "capture": api.capture,
+            "refund": api.refund,
+            "close": api.close_order_reference,
+            "cancel": api.cancel_order_reference,
+        }
+        writer = csv.writer(self.stdout, lineterminator="\n")
+        writer.writerow(REPORT_FIELDS)
+        failed = pending = 0
+        results = api.run_bulk(
+            self.run_operation, [(op,) for op in operations],
+            workers=options["workers"],
+            rate_limiter=RateLimiter(options["rate"], options["burst"]),
+            callback=callback)
+        for (operation,), result, error in results:
+            self.log_calls(calls)
+            row = dict(operation, result="ok")
+            if error is not None:
+                failed += 1
+                row["result"] = "error"
+                if isinstance(error, api.exception_class):
+                    row["error_code"] = error.args[0]
+                    row["error_message"] = error.args[-1]
+                else:
+                    row["error_code"] = error.__class__.__name__
+            else:
+                row.update(result)
+                if result.get("state") == "Pending":
+                    pending += 1
+                    row["result"] = "pending"
+                elif result.get("state") == "Declined":
+                    failed += 1
+                    row["result"] = "declined"
+                elif result.get("state") in (None, "Completed"):
+                    self.update_session(operation)
+            writer.writerow([unicode(row.get(field) or "").encode("utf-8")
+                             for field in REPORT_FIELDS])
+        self.log_calls(calls)
+        self.stderr.write("Ran %s operations (%s failed, %s pending)." % (
+            len(operations), failed, pending))
+
+    def read_operations(self, operations_file):
+        operations = []
+        reader = csv.DictReader(operations_file)
+        for line, row in enumerate(reader, 2):
+            action = (row.get("action") or "").strip().lower()
+            if action not in ACTIONS:
+                raise CommandError("Unknown action %r on line %s." % (
+                    action, line))
+            operation = {
+                "line": line,
+                "action": action,
+                "amazon_id": (row.get("amazon_id") or "").strip(),
+                "amount": (row.get("amount") or "").strip(),
+                "currency": ((row.get("currency") or "").strip() or
+                             settings.AMAZON_PAYMENTS_CURRENCY),
+                "reference_id": (row.get("reference_id") or "").strip(),
+                "reason": (row.get("reason") or "").strip(),
+            }
+            if action in ("capture", "refund"):
+                if not operation["amount"]:
+                    raise CommandError("No amount on line %s." % line)
+            # An authorization can only be captured once, but a capture can
+            # have several refunds of the same amount, which a generated
+            # reference ID couldn't tell apart
+            if action == "refund" and not operation["reference_id"]:
+                raise CommandError("No reference_id on line %s." % line)
+            if action == "capture" and not operation["reference_id"]:
+                operation["reference_id"] = generate_reference_id(
+                    action, operation["amazon_id"], operation["amount"])
+            operations.append(operation)
+        return operations
+
+    def run_operation(self, operation, callback=None):
+        """
+        Runs an operation. Called from the API's worker threads.
+        """
+        method = self.methods[operation["action"]]
+        if operation["action"] in ("close", "cancel"):
+            method(operation["amazon_id"], operation["reason"] or None,
+                   callback=callback)
+            return {}
+        result_id, status, tx = method(
+            operation["amazon_id"], operation["reference_id"],
+            operation["amount"], operation["currency"], callback=callback)
+        result = {"result_id": result_id, "state": status.State.text}
+        if status.ReasonCode:
+            result["error_code"] = status.ReasonCode.text
+        return result
+
+    def find_session(self, details):
+        """
+        Returns the session of a call, found from the Amazon IDs in it.
+        """
+        if details["order_reference_id"]:
+            session = AmazonPaymentsSession.objects.filter(
+                order_reference_id=details["order_reference_id"]).first()
+            if session is not None:
+                return session
+        if details["authorization_id"]:
+            auth_attempt = AmazonPaymentsAuthAttempt.objects.filter(
+                authorization_id=details["authorization_id"],
+            ).select_related("session").first()
+            if auth_attempt is not None:
+                return auth_attempt.session
+        if details["capture_id"]:
+            tx = AmazonPaymentsTransaction.objects.filter(
+                capture_id=details["capture_id"],
+            ).select_related("session").first()
+            if tx is not None:
+                return tx.session
+        # Authorization and capture IDs start with their order reference's
+        for amazon_id in (details["authorization_id"], details["capture_id"]):
+            order_reference_id = get_order_reference_id(amazon_id)
+            if order_reference_id:
+                return AmazonPaymentsSession.objects.filter(
+                    order_reference_id=order_reference_id).first()
+
+    def log_calls(self, calls):
+        while not calls.empty():
+            raw_request, raw_response, kwargs = calls.get()
+            self.log_call(raw_request, raw_response, **kwargs)
+
+    def log_call(self, raw_request, raw_response, action=None,
+                 status_code=None, latency=None):
+        details = get_transaction_details(raw_request, raw_response, action)
+        session = self.find_session(details)
+        if session is None:
+            if details["action"] in MONEY_MOVING_ACTIONS:
+                # Keep the whole call, as it can't be stored
+                logger.error(
+                    "No session found for %s call, not storing it.\n"
+                    "Request: %s\nResponse: %s" % (
+                        details["action"], raw_request, raw_response))
+            else:
+                logger.warning("No session found for %s call, not logging "
+                               "it" % details["action"])
+            return
+        level = self.transaction_log_policy.get_level(
+            details["action"], details["error_code"], status_code)
+        if level == TransactionLogPolicy.SUMMARY:
+            raw_request = raw_response = None
+        AmazonPaymentsTransaction.objects.create(
+            session=session, request=raw_request, response=raw_response,
+            status_code=status_code, latency=latency, **details)
+
+    def update_session(self, operation):
+        field = "order_reference_id"
+        if operation["action"] == "capture":
+            field = "authorization_id"
+        elif operation["action"] == "refund":
+            field = "capture_id"
+        details = dict.fromkeys(
+            ("order_reference_id", "authorization_id", "capture_id"))
+        details[field] = operation["amazon_id"]
+        session = self.find_session(details)
+        if session is not None:
+            session.transition(SESSION_STATES[operation["action"]])
@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from amazon_payments.settlements import SettlementImporter, open_report
+
+
+class Command(BaseCommand):
+    args = "<report> [<report> ...]"
+    help = ("Imports Amazon Payments flat file settlement reports (which may "
+            "be gzipped), matching their rows to orders. Importing a report "
+            "again replaces the rows imported for its settlements.")
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", default=5000,
+                    help="Number of rows inserted per batch."),
+        make_option("--delimiter", default="\t",
+                    help="Column delimiter of the reports (tab by "
+                         "default)."),
+    )
+
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError("No settlement reports given.")
+        importer = SettlementImporter(
+            batch_size=options["batch_size"],
+            delimiter=str(options["delimiter"]))
+        for path in paths:
+            report = open_report(path)
+            try:
+                imported, matched = importer.run(report)
+            finally:
+                report.close()
+            self.stdout.write("Imported %s rows from %s (%s matched)." % (
+                imported, path, matched))
@@ -0,0 +1,115 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import time
+from optparse import make_option
+
+from django.core import serializers
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import router, transaction
+from django.utils import timezone
+
+from amazon_payments.models import (
+    AmazonPaymentsSession, AmazonPaymentsTransaction,
+    AmazonPaymentsAuthAttempt)
+
+logger = logging.getLogger("amazon_payments")
+
+# The states of sessions that can be pruned: ones that are over without any
+# money having been taken. Sessions with an authorization or renewals are
+# kept whatever their state.
+PRUNABLE_STATES = (
+    AmazonPaymentsSession.DRAFT,
+    AmazonPaymentsSession.DECLINED,
+    AmazonPaymentsSession.CLOSED,
+)
+
+
+class Command(BaseCommand):
+    help = ("Archives Amazon Payments sessions of abandoned baskets that are "
+            "older than the retention window, together with their "
+            "transactions and auth attempts, to a compressed JSONL file and "
+            "then deletes them. Sessions that are in progress, or that have "
+            "an authorization or renewals, are kept.")
+    option_list = BaseCommand.option_list + (
+        make_option("--days", type="int", default=90,
+                    help="Retention window in days."),
+        make_option("--archive-dir",
+                    help="Directory in which the archive file is created."),
+        make_option("--no-archive", action="store_true", default=False,
+                    help="Delete the rows without archiving them."),
+        make_option("--batch-size", type="int", default=500,
+                    help="Number of sessions deleted per transaction."),
+        make_option("--sleep", type="float", default=0,
+                    help="Seconds to wait between batches."),
+    )
+
+    def handle(self, *args, **options):
+        if not (options["archive_dir"] or options["no_archive"]):
+            raise CommandError(
+                "Either --archive-dir or --no-archive must be given.")
+        cutoff = timezone.now() - datetime.timedelta(days=options["days"])
+        queryset = AmazonPaymentsSession.objects.filter(
+            order__isnull=True, created_at__lt=cutoff,
+            state__in=PRUNABLE_STATES,
+        ).exclude(
+            auth_attempts__authorization_id__isnull=False,
+        ).exclude(
+            renewals__isnull=False,
+        ).order_by("pk")
+
+        archive = None
+        if not options["no_archive"]:
+            path = os.path.join(
+                options["archive_dir"], "amazon_payments-%s.jsonl.gz" % (
+                    timezone.now().strftime("%Y%m%d%H%M%S")))
+            archive = gzip.open(path, "wb")
+        deleted = 0
+        try:
+            last_pk = 0
+            while True:
+                # The transaction log may be routed to its own database.
+                with transaction.atomic(using=router.db_for_write(
+                        AmazonPaymentsSession)), transaction.atomic(
+                        using=router.db_for_write(AmazonPaymentsTransaction)):
+                    pks = list(queryset.filter(pk__gt=last_pk).values_list(
+                        "pk", flat=True)[:options["batch_size"]])
+                    if not pks:
+                        break
+                    last_pk = pks[-1]
+                    deleted += self.prune_batch(queryset.filter(
+                        pk__gte=pks[0], pk__lte=last_pk), archive)
+                if options["sleep"]:
+                    time.sleep(options["sleep"])
+        finally:
+            if archive is not None:
+                archive.close()
+        self.stdout.write("Pruned %s sessions." % deleted)
+
+    def prune_batch(self, sessions, archive):
+        session_pks = list(sessions.values_list("pk", flat=True))
+        if not session_pks:
+            return 0
+        # Children come first, so that deleting the sessions doesn't have
+        # to cascade.
+        querysets = [
+            AmazonPaymentsAuthAttempt.objects.filter(
+                session__in=session_pks),
+            AmazonPaymentsTransaction.objects.filter(
+                session__in=session_pks),
+            AmazonPaymentsSession.objects.filter(pk__in=session_pks),
+        ]
+        if archive is not None:
+            for queryset in querysets:
+                for obj in serializers.serialize("python", queryset):
+                    archive.write(json.dumps(obj, cls=DjangoJSONEncoder))
+                    archive.write("\n")
+            archive.flush()
+        for queryset in querysets:
+            queryset.delete()
+        logger.debug("Pruned Amazon Payments sessions #%s to #%s" % (
+            session_pks[0], session_pks[-1]))
+        return len(session_pks)
@@ -0,0 +1,74 @@
+import csv
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from amazon_payments import AmazonPaymentsAPI
+from amazon_payments.caching import get_status_cache
+from amazon_payments.locks import get_shared_rate_limiter
+from amazon_payments.reconciliation import Mismatch, Reconciler
+from amazon_payments.throttling import (
+    BULK, ConcurrencyController, RateLimiter)
+
+
+class Command(BaseCommand):
+    help = ("Checks that orders paid with Amazon Payments match the state "
+            "and amounts of their authorizations on Amazon, and writes the "
+            "mismatches found as CSV. Carries on from where the last run "
+            "stopped, unless --from-start is given.")
+    option_list = BaseCommand.option_list + (
+        make_option("--workers", type="int", default=4,
+                    help="Number of threads making API calls."),
+        make_option("--adaptive", action="store_true", default=False,
+                    help="Start with one call at a time, and adjust the "
+                         "number of calls in flight (up to --workers) to "
+                         "how Amazon is responding."),
+        make_option("--batch-size", type="int", default=100,
+                    help="Number of orders checked between checkpoints."),
+        make_option("--rate", type="float", default=1,
+                    help="Maximum average number of API calls per second."),
+        make_option("--burst", type="int", default=20,
+                    help="Maximum number of API calls in a burst."),
+        make_option("--from-start", action="store_true", default=False,
+                    help="Check all orders, ignoring the checkpoint."),
+        make_option("--output",
+                    help="File the report is written to, instead of "
+                         "stdout."),
+    )
+
+    def handle(self, *args, **options):
+        api = AmazonPaymentsAPI(
+            settings.AMAZON_PAYMENTS_ACCESS_KEY,
+            settings.AMAZON_PAYMENTS_SECRET_KEY,
+            settings.AMAZON_PAYMENTS_SELLER_ID,
+            settings.AMAZON_PAYMENTS_API_ENDPOINT,
+            settings.AMAZON_PAYMENTS_API_VERSION,
+            settings.AMAZON_PAYMENTS_IS_LIVE,
+            timeout=getattr(settings, "AMAZON_PAYMENTS_API_TIMEOUT", 30),
+            concurrency_controller=(
+                ConcurrencyController(options["workers"])
+                if options["adaptive"] else None),
+            rate_limiter=get_shared_rate_limiter(), priority=BULK,
+            status_cache=get_status_cache(),
+        )
+        reconciler = Reconciler(
+            api, workers=options["workers"],
+            batch_size=options["batch_size"],
+            rate_limiter=RateLimiter(options["rate"], options["burst"]))
+        output = self.stdout
+        if options["output"]:
+            output = open(options["output"], "wb")
+        mismatches = 0
+        try:
+            writer = csv.writer(output, lineterminator="\n")
+            writer.writerow(Mismatch._fields)
+            for mismatch in reconciler.run(resume=not options["from_start"]):
+                writer.writerow([
+                    "" if value is None else unicode(value).encode("utf-8")
+                    for value in mismatch])
+                mismatches += 1
+        finally:
+            if options["output"]:
+                output.close()
+        self.stderr.write("Found %s mismatches." % mismatches)
@@ -0,0 +1,101 @@
+import datetime
+import os
+import socket
+from collections import defaultdict
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from amazon_payments import AmazonPaymentsAPI
+from amazon_payments.locks import get_shared_rate_limiter
+from amazon_payments.models import (
+    SHARD_BUCKETS, AmazonPaymentsRenewal, AmazonPaymentsShardLease)
+from amazon_payments.renewals import RenewalProcessor
+from amazon_payments.throttling import (
+    BULK, ConcurrencyController, RateLimiter)
+
+
+class Command(BaseCommand):
+    help = ("Charges the billing agreements of due Amazon Payments renewals "
+            "with AuthorizeOnBillingAgreement. Safe to rerun: renewals that "
+            "were charged are skipped, and retried calls reuse their "
+            "AuthorizationReferenceId.")
+    option_list = BaseCommand.option_list + (
+        make_option("--workers", type="int", default=4,
+                    help="Number of threads making API calls."),
+        make_option("--adaptive", action="store_true", default=False,
+                    help="Start with one call at a time, and adjust the "
+                         "number of calls in flight (up to --workers) to "
+                         "how Amazon is responding."),
+        make_option("--batch-size", type="int", default=100,
+                    help="Number of renewals claimed at a time."),
+        make_option("--rate", type="float", default=1,
+                    help="Maximum average number of API calls per second, "
+                         "if AMAZON_PAYMENTS_SHARED_RATE_LIMIT isn't set."),
+        make_option("--burst", type="int", default=10,
+                    help="Maximum number of API calls in a burst, if "
+                         "AMAZON_PAYMENTS_SHARED_RATE_LIMIT isn't set."),
+        make_option("--stale-after", type="int", default=60,
+                    help="Minutes after which renewals left authorizing by "
+                         "an earlier run are retried."),
+        make_option("--shards", type="int", default=1,
+                    help="Number of shards the renewals are split into. "
+                         "Each shard is leased by one node at a time, so "
+                         "every node should use the same number."),
+        make_option("--lease-timeout", type="int", default=10,
+                    help="Minutes after which the shard of a node that "
+                         "stopped renewing its lease (e.g. because it "
+                         "crashed) may be taken by another node."),
+    )
+
+    def handle(self, *args, **options):
+        api = AmazonPaymentsAPI(
+            settings.AMAZON_PAYMENTS_ACCESS_KEY,
+            settings.AMAZON_PAYMENTS_SECRET_KEY,
+            settings.AMAZON_PAYMENTS_SELLER_ID,
+            settings.AMAZON_PAYMENTS_API_ENDPOINT,
+            settings.AMAZON_PAYMENTS_API_VERSION,
+            settings.AMAZON_PAYMENTS_IS_LIVE,
+            timeout=getattr(settings, "AMAZON_PAYMENTS_API_TIMEOUT", 30),
+            concurrency_controller=(
+                ConcurrencyController(options["workers"])
+                if options["adaptive"] else None),
+            # The shared limiter keeps every node (and the checkout views)
+            # within the account's rate between them.
+            rate_limiter=(get_shared_rate_limiter() or
+                          RateLimiter(options["rate"], options["burst"])),
+            priority=BULK,
+        )
+        processor = RenewalProcessor(
+            api, workers=options["workers"],
+            batch_size=options["batch_size"])
+        if not 1 <= options["shards"] <= SHARD_BUCKETS:
+            raise CommandError(
+                "--shards must be between 1 and %s" % SHARD_BUCKETS)
+        renewals = AmazonPaymentsRenewal.objects.due(
+            datetime.timedelta(minutes=options["stale_after"]))
+        lease_timeout = datetime.timedelta(minutes=options["lease_timeout"])
+        owner = "%s:%s" % (socket.gethostname(), os.getpid())
+        counts = defaultdict(int)
+        done = set()
+        # Work through the shards that aren't leased by other nodes, one at
+        # a time, renewing the lease between batches.
+        while True:
+            lease = AmazonPaymentsShardLease.objects.acquire(
+                "renewals", options["shards"], owner, lease_timeout,
+                exclude=done)
+            if lease is None:
+                break
+            done.add(lease.shard)
+            try:
+                shard_counts = processor.run(
+                    renewals.filter(bucket__in=lease.get_buckets()),
+                    heartbeat=lambda: lease.renew(lease_timeout))
+            finally:
+                lease.release()
+            for state, count in shard_counts.items():
+                counts[state] += count
+        for state, label in AmazonPaymentsRenewal.STATE_CHOICES:
+            if counts.get(state):
+                self.stdout.write("%s: %s" % (label, counts[state]))
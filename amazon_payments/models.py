@@ -1,27 +1,398 @@
-from django.db import models
+import hashlib
+import zlib
+
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+
+
+class AmazonPaymentsSessionManager(models.Manager):
+
+    def for_billing_agreement(self, billing_agreement_id):
+        return self.filter(billing_agreement_id=billing_agreement_id)
+
+    def get_by_order_reference_id(self, order_reference_id):
+        return self.get(order_reference_id=order_reference_id)
+
+    def stuck_authorizations(self, older_than):
+        """
+        Returns the sessions that have been waiting for an authorization
+        result since before the given timedelta ago.
+        """
+        return self.filter(
+            state=AmazonPaymentsSession.AUTHORIZING,
+            state_changed_at__lt=timezone.now() - older_than)
 
 
 class AmazonPaymentsSession(models.Model):
-    billing_agreement_id = models.TextField()
+    DRAFT = "draft"
+    ORDER_REFERENCE_CREATED = "order_reference_created"
+    AUTHORIZING = "authorizing"
+    AUTHORIZED = "authorized"
+    DECLINED = "declined"
+    CAPTURED = "captured"
+    CLOSED = "closed"
+    REFUNDED = "refunded"
+    STATE_CHOICES = (
+        (DRAFT, "Draft"),
+        (ORDER_REFERENCE_CREATED, "Order reference created"),
+        (AUTHORIZING, "Authorizing"),
+        (AUTHORIZED, "Authorized"),
+        (DECLINED, "Declined"),
+        (CAPTURED, "Captured"),
+        (CLOSED, "Closed"),
+        (REFUNDED, "Refunded"),
+    )
+    # The states each state can move to. AUTHORIZING can't move to itself,
+    # so that an order reference can't be authorized twice at once; it moves
+    # back to ORDER_REFERENCE_CREATED if Amazon rejects the authorization.
+    TRANSITIONS = {
+        DRAFT: (ORDER_REFERENCE_CREATED, AUTHORIZING),
+        ORDER_REFERENCE_CREATED: (AUTHORIZING, CLOSED),
+        AUTHORIZING: (ORDER_REFERENCE_CREATED, AUTHORIZED, DECLINED,
+                      CAPTURED, CLOSED),
+        AUTHORIZED: (CAPTURED, DECLINED, CLOSED),
+        DECLINED: (AUTHORIZING, CLOSED),
+        CAPTURED: (REFUNDED, CLOSED),
+        CLOSED: (REFUNDED,),
+        REFUNDED: (REFUNDED, CLOSED),
+    }
+
+    billing_agreement_id = models.CharField(max_length=64, db_index=True)
     basket = models.OneToOneField("basket.Basket", blank=True, null=True)
     order = models.OneToOneField("order.Order", blank=True, null=True)
-    order_reference_id = models.TextField(blank=True, null=True)
+    order_reference_id = models.CharField(max_length=64, blank=True,
+                                          null=True, unique=True)
     access_token = models.TextField(blank=True, null=True)
+    access_token_expires_at = models.DateTimeField(blank=True, null=True)
+    state = models.CharField(max_length=32, choices=STATE_CHOICES,
+                             default=DRAFT, db_index=True)
+    state_changed_at = models.DateTimeField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = AmazonPaymentsSessionManager()
+
+    class Meta:
+        index_together = [("state", "state_changed_at")]
+
+    def is_access_token_expired(self):
+        """
+        Returns True if the access token is known to have expired, in which
+        case MWS calls using it would fail with InvalidAddressConsentToken.
+        """
+        return (self.access_token_expires_at is not None and
+                self.access_token_expires_at <= timezone.now())
+
+    def transition(self, state, **fields):
+        """
+        Moves the session to the given state (also setting any given fields)
+        if that's allowed from the state it's in. Returns True if the state
+        was changed.
+
+        For saved sessions, the check and the update are done in a single
+        UPDATE statement, so two concurrent transitions from the same state
+        can't both succeed.
+        """
+        allowed_from = [from_state for from_state, to_states
+                        in self.TRANSITIONS.items() if state in to_states]
+        fields.update(state=state, state_changed_at=timezone.now())
+        if self.pk is None:
+            changed = self.state in allowed_from
+        else:
+            changed = bool(AmazonPaymentsSession.objects.filter(
+                pk=self.pk, state__in=allowed_from).update(**fields))
+        if changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+        return changed
+
 
 class AmazonPaymentsTransaction(models.Model):
     session = models.ForeignKey(AmazonPaymentsSession,
                                 related_name="transactions")
     request = models.TextField(blank=True, null=True)
     response = models.TextField(blank=True, null=True)
+    action = models.CharField(max_length=64, blank=True, null=True,
+                              db_index=True)
+    status_code = models.PositiveSmallIntegerField(blank=True, null=True)
+    error_code = models.CharField(max_length=64, blank=True, null=True,
+                                  db_index=True)
+    latency = models.FloatField(blank=True, null=True)
+    request_id = models.CharField(max_length=64, blank=True, null=True,
+                                  db_index=True)
+    order_reference_id = models.CharField(max_length=64, blank=True,
+                                          null=True, db_index=True)
+    authorization_id = models.CharField(max_length=64, blank=True, null=True,
+                                        db_index=True)
+    capture_id = models.CharField(max_length=64, blank=True, null=True,
+                                  db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
 
+class AmazonPaymentsAuthAttemptManager(models.Manager):
+
+    def get_by_authorization_id(self, authorization_id):
+        return self.select_related("session").get(
+            authorization_id=authorization_id)
+
+
 class AmazonPaymentsAuthAttempt(models.Model):
     session = models.ForeignKey(AmazonPaymentsSession,
                                 related_name="auth_attempts")
-    authorization_id = models.TextField(blank=True, null=True)
-    transaction = models.OneToOneField(AmazonPaymentsTransaction, blank=True,
-                                       null=True)
+    authorization_id = models.CharField(max_length=64, blank=True, null=True,
+                                        unique=True)
+    # The AuthorizationReferenceId sent to Amazon
+    reference_id = models.CharField(max_length=32, blank=True, null=True,
+                                    unique=True)
+    # The primary key of the Authorize call's AmazonPaymentsTransaction. It
+    # isn't a foreign key, as the transaction log may be routed to another
+    # database (see routers.AmazonPaymentsRouter).
+    transaction_id = models.IntegerField(blank=True, null=True, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = AmazonPaymentsAuthAttemptManager()
+
+    def _get_transaction(self):
+        # The transaction may have been set before it was saved.
+        tx = getattr(self, "_transaction", None)
+        if tx is not None and tx.pk == self.transaction_id:
+            return tx
+        if self.transaction_id is None:
+            return None
+        self._transaction = AmazonPaymentsTransaction.objects.filter(
+            pk=self.transaction_id).first()
+        return self._transaction
+
+    def _set_transaction(self, tx):
+        self._transaction = tx
+        self.transaction_id = tx.pk if tx is not None else None
+
+    transaction = property(_get_transaction, _set_transaction)
+
+
+# The number of buckets that renewals are hashed into. Shards are made up
+# of buckets, so this is the maximum number of shards.
+SHARD_BUCKETS = 1024
+
+
+def get_shard_bucket(billing_agreement_id):
+    return (zlib.crc32(billing_agreement_id) & 0xffffffff) % SHARD_BUCKETS
+
+
+class AmazonPaymentsRenewalManager(models.Manager):
+
+    def due(self, stale_after=None):
+        """
+        Returns the renewals that are due to be charged. If stale_after (a
+        timedelta) is given, this includes renewals that have been
+        authorizing for longer than that without getting an authorization
+        ID, e.g. because the process charging them crashed. These can safely
+        be retried as their reference IDs don't change, apart from those
+        whose outcome couldn't be found (see renewals.RenewalProcessor).
+        """
+        now = timezone.now()
+        due = models.Q(state=AmazonPaymentsRenewal.PENDING)
+        if stale_after is not None:
+            due |= (models.Q(state=AmazonPaymentsRenewal.AUTHORIZING,
+                             authorization_id__isnull=True,
+                             updated_at__lt=now - stale_after) &
+                    ~models.Q(error_code="OutcomeUnknown"))
+        return self.filter(due, due_at__lte=now)
+
+
+class AmazonPaymentsRenewal(models.Model):
+    """
+    A charge on the billing agreement of a session, e.g. for a subscription
+    renewal, made with AuthorizeOnBillingAgreement by the
+    amazon_payments_renew command.
+    """
+    PENDING = "pending"
+    AUTHORIZING = "authorizing"
+    AUTHORIZED = "authorized"
+    DECLINED = "declined"
+    FAILED = "failed"
+    STATE_CHOICES = (
+        (PENDING, "Pending"),
+        (AUTHORIZING, "Authorizing"),
+        (AUTHORIZED, "Authorized"),
+        (DECLINED, "Declined"),
+        (FAILED, "Failed"),
+    )
+
+    # Protected, so that a renewal's history can't be lost with its session
+    session = models.ForeignKey(AmazonPaymentsSession,
+                                related_name="renewals",
+                                on_delete=models.PROTECT)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    currency = models.CharField(max_length=3)
+    due_at = models.DateTimeField()
+    # The AuthorizationReferenceId sent to Amazon. It's derived from the
+    # billing agreement and due date (see generate_reference_id), so the
+    # same renewal can't be created, or charged, twice.
+    reference_id = models.CharField(max_length=32, unique=True)
+    state = models.CharField(max_length=16, choices=STATE_CHOICES,
+                             default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    authorization_id = models.CharField(max_length=64, blank=True, null=True,
+                                        unique=True)
+    order_reference_id = models.CharField(max_length=64, blank=True,
+                                          null=True)
+    error_code = models.CharField(max_length=64, blank=True, null=True)
+    # Used to split renewals into shards, see get_shard_bucket
+    bucket = models.PositiveSmallIntegerField(default=0, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = AmazonPaymentsRenewalManager()
+
+    class Meta:
+        index_together = [("state", "due_at")]
+
+    @staticmethod
+    def generate_reference_id(billing_agreement_id, due_at, key=""):
+        """
+        Returns a reference ID that's the same every time it's generated for
+        a billing agreement and due date. `key` tells apart renewals of
+        the same agreement that are due on the same day.
+        """
+        return "r" + hashlib.sha1("%s:%s:%s" % (
+            billing_agreement_id, due_at.date().isoformat(), key)
+        ).hexdigest()[:31]
+
+    def save(self, *args, **kwargs):
+        if not self.reference_id:
+            self.reference_id = self.generate_reference_id(
+                self.session.billing_agreement_id, self.due_at)
+        self.bucket = get_shard_bucket(self.session.billing_agreement_id)
+        super(AmazonPaymentsRenewal, self).save(*args, **kwargs)
+
+
+class AmazonPaymentsShardLeaseManager(models.Manager):
+
+    def acquire(self, name, num_shards, owner, duration, exclude=()):
+        """
+        Leases a shard of the work called `name`, split into num_shards
+        shards, that isn't leased by anyone else (or whose lease has
+        expired) for the given timedelta. Returns the lease, or None if all
+        the shards (other than those in exclude) are leased.
+        """
+        for shard in range(num_shards):
+            if shard in exclude:
+                continue
+            try:
+                with transaction.atomic():
+                    lease, created = self.get_or_create(
+                        name=name, num_shards=num_shards, shard=shard)
+            except IntegrityError:
+                # Created by another worker at the same time
+                lease = self.get(name=name, num_shards=num_shards,
+                                 shard=shard)
+            now = timezone.now()
+            if self.filter(
+                models.Q(expires_at__isnull=True) |
+                models.Q(expires_at__lt=now), pk=lease.pk,
+            ).update(owner=owner, expires_at=now + duration):
+                lease.owner = owner
+                lease.expires_at = now + duration
+                return lease
+
+
+class AmazonPaymentsShardLease(models.Model):
+    """
+    A lease on a shard of some work (e.g. renewals), held by one worker at
+    a time. A worker that crashes stops renewing its lease, so the shard
+    can be leased by another worker once the lease expires.
+    """
+    name = models.CharField(max_length=64)
+    num_shards = models.PositiveIntegerField()
+    shard = models.PositiveIntegerField()
+    owner = models.CharField(max_length=128, blank=True, null=True)
+    expires_at = models.DateTimeField(blank=True, null=True)
+
+    objects = AmazonPaymentsShardLeaseManager()
+
+    class Meta:
+        unique_together = [("name", "num_shards", "shard")]
+
+    def get_buckets(self):
+        """
+        Returns the renewal buckets in this shard.
+        """
+        return [bucket for bucket in range(SHARD_BUCKETS)
+                if bucket % self.num_shards == self.shard]
+
+    def renew(self, duration):
+        """
+        Extends the lease by the given timedelta from now. Returns False if
+        the lease was lost, e.g. because it expired and was taken by
+        another worker.
+        """
+        expires_at = timezone.now() + duration
+        renewed = AmazonPaymentsShardLease.objects.filter(
+            pk=self.pk, owner=self.owner).update(expires_at=expires_at)
+        if renewed:
+            self.expires_at = expires_at
+        return bool(renewed)
+
+    def release(self):
+        AmazonPaymentsShardLease.objects.filter(
+            pk=self.pk, owner=self.owner).update(owner=None, expires_at=None)
+
+
+class AmazonPaymentsCheckpoint(models.Model):
+    """
+    How far a resumable job (e.g. reconciliation) has got, so that the next
+    run can carry on from there.
+    """
+    name = models.CharField(max_length=64, unique=True)
+    position = models.CharField(max_length=255, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get_position(cls, name, default=""):
+        try:
+            return cls.objects.get(name=name).position
+        except cls.DoesNotExist:
+            return default
+
+    @classmethod
+    def set_position(cls, name, position):
+        if not cls.objects.filter(name=name).update(
+                position=position, updated_at=timezone.now()):
+            cls.objects.create(name=name, position=position)
+
+
+class AmazonPaymentsSettlement(models.Model):
+    """
+    A row of an Amazon Payments settlement report, matched to the session
+    and order it settles where possible. Imported by the
+    amazon_payments_import_settlements command.
+    """
+    settlement_id = models.CharField(max_length=64)
+    # The row's position in the report (following on from the rows of any
+    # earlier report of the settlement imported with it), which identifies
+    # it within the settlement
+    row_number = models.PositiveIntegerField()
+    transaction_type = models.CharField(max_length=64, blank=True)
+    amazon_transaction_id = models.CharField(max_length=64, blank=True,
+                                             db_index=True)
+    order_reference_id = models.CharField(max_length=64, blank=True)
+    seller_order_id = models.CharField(max_length=128, blank=True)
+    amount = models.DecimalField(max_digits=12, decimal_places=2, blank=True,
+                                 null=True)
+    currency = models.CharField(max_length=3, blank=True)
+    posted_at = models.DateTimeField(blank=True, null=True)
+    # The rows are kept when the session or order is deleted (e.g. pruned),
+    # as they record money that was actually settled
+    session = models.ForeignKey(AmazonPaymentsSession, blank=True, null=True,
+                                related_name="settlements",
+                                on_delete=models.SET_NULL)
+    order = models.ForeignKey("order.Order", blank=True, null=True,
+                              related_name="amazon_settlements",
+                              on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [("settlement_id", "row_number")]
+
+
+from amazon_payments import receivers  # noqa
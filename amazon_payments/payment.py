@@ -0,0 +1,55 @@
+import threading
+
+from oscar.core.loading import get_model
+
+SOURCE_TYPE_CODE = "amazon-payments"
+SOURCE_TYPE_NAME = "Amazon Payments"
+
+# Payment source and event types never change once created, so they're
+# looked up once per process.
+_types = {}
+_types_lock = threading.Lock()
+
+
+def _get_type(app_label, model_name, **lookup):
+    key = (model_name, lookup.get("code") or lookup.get("name"))
+    if key not in _types:
+        with _types_lock:
+            if key not in _types:
+                # The models are looked up here rather than on import, as
+                # this module is imported while the models are loading.
+                model = get_model(app_label, model_name)
+                # get_or_create handles another process creating the row at
+                # the same time, as the lookup is on a unique field.
+                _types[key] = model.objects.get_or_create(**lookup)[0]
+    return _types[key]
+
+
+def get_source_type():
+    """
+    Returns the Amazon Payments SourceType. It's looked up by code, as
+    names aren't unique.
+    """
+    return _get_type("payment", "SourceType", code=SOURCE_TYPE_CODE,
+                     defaults={"name": SOURCE_TYPE_NAME})
+
+
+def get_payment_event_type(name):
+    return _get_type("order", "PaymentEventType", name=name)
+
+
+def warm_payment_types():
+    """
+    Loads the types used when an order is placed, so that the first order
+    doesn't have to.
+    """
+    get_source_type()
+    get_payment_event_type("Purchase")
+
+
+def reset_payment_types():
+    """
+    Forgets the loaded types, e.g. after the database was flushed.
+    """
+    with _types_lock:
+        _types.clear()
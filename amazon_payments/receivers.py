@@ -0,0 +1,88 @@
+import logging
+
+from django.core.signals import request_started
+from django.db import DatabaseError
+from django.db.models import get_model
+from django.db.models.signals import class_prepared, post_delete, post_save
+
+from oscar.apps.basket import signals as basket_signals
+
+from amazon_payments.payment import warm_payment_types
+from amazon_payments.shipping import bump_basket_version, bump_offers_version
+
+logger = logging.getLogger("amazon_payments")
+
+
+def invalidate_line_shipping_cache(sender, instance, **kwargs):
+    bump_basket_version(instance.basket_id)
+
+
+def invalidate_offers_shipping_cache(sender, instance, **kwargs):
+    bump_offers_version()
+
+
+def invalidate_stockrecord_shipping_cache(sender, instance, **kwargs):
+    # Prices come from stock records, and shipping methods can depend on
+    # the basket's total, so the open baskets with lines for one change
+    # with it.
+    Basket = get_model("basket", "Basket")
+    basket_ids = get_model("basket", "Line").objects.filter(
+        stockrecord=instance.pk,
+        basket__status__in=Basket.editable_statuses,
+    ).values_list("basket", flat=True).distinct()
+    for basket_id in basket_ids:
+        bump_basket_version(basket_id)
+
+
+# The receivers invalidating the shipping cache, by the model they're
+# connected to, with whether they're also connected to post_delete. Stock
+# record deletions delete their lines, which invalidates their baskets.
+SHIPPING_CACHE_RECEIVERS = {
+    ("basket", "Line"): (invalidate_line_shipping_cache, True),
+    ("offer", "ConditionalOffer"): (invalidate_offers_shipping_cache, True),
+    ("partner", "StockRecord"): (invalidate_stockrecord_shipping_cache, False),
+}
+
+
+def connect_shipping_cache_receivers(sender, **kwargs):
+    opts = sender._meta
+    receiver, on_delete = SHIPPING_CACHE_RECEIVERS.get(
+        (opts.app_label, opts.object_name), (None, False))
+    if receiver is None:
+        return
+    post_save.connect(receiver, sender=sender)
+    if on_delete:
+        post_delete.connect(receiver, sender=sender)
+
+
+def invalidate_basket_shipping_cache(basket, **kwargs):
+    bump_basket_version(basket.id)
+
+
+def warm_payment_types_on_first_request(sender, **kwargs):
+    # Django 1.6 has no hook for when the apps are ready, so the payment
+    # types are loaded when the first request starts instead.
+    try:
+        warm_payment_types()
+    except DatabaseError:
+        logger.warning("Unable to load the payment types", exc_info=True)
+        return
+    request_started.disconnect(
+        dispatch_uid="amazon_payments_warm_payment_types")
+
+
+# The receivers are connected with explicit senders, as receivers for all
+# models would run on every save, and a post_delete receiver for all models
+# stops Django from deleting querysets without loading them. The models may
+# be forked and aren't necessarily loaded yet when this module is imported,
+# so they're connected as the model classes are prepared.
+class_prepared.connect(connect_shipping_cache_receivers)
+for app_label, object_name in SHIPPING_CACHE_RECEIVERS:
+    model = get_model(app_label, object_name, seed_cache=False,
+                      only_installed=False)
+    if model is not None:
+        connect_shipping_cache_receivers(model)
+basket_signals.voucher_addition.connect(invalidate_basket_shipping_cache)
+basket_signals.voucher_removal.connect(invalidate_basket_shipping_cache)
+request_started.connect(warm_payment_types_on_first_request,
+                        dispatch_uid="amazon_payments_warm_payment_types")
@@ -0,0 +1,239 @@
+import itertools
+import logging
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db import router
+from oscar.core.loading import get_model
+
+from amazon_payments.api import get_transaction_details
+from amazon_payments.bulk import run_in_threads
+from amazon_payments.logging_policy import TransactionLogPolicy
+from amazon_payments.models import (
+    AmazonPaymentsSession, AmazonPaymentsTransaction,
+    AmazonPaymentsAuthAttempt, AmazonPaymentsCheckpoint)
+from amazon_payments.renewals import RETRYABLE_ERRORS
+from amazon_payments.throttling import RateLimiter
+
+Source = get_model('payment', 'Source')
+
+logger = logging.getLogger("amazon_payments")
+
+Mismatch = namedtuple("Mismatch", [
+    "order_number", "session_id", "authorization_id", "issue", "expected",
+    "actual"])
+
+# The session states that are consistent with the state of an
+# authorization, as returned by get_amazon_state. Sessions may have moved on
+# (e.g. been refunded) since they were captured.
+MATCHING_STATES = {
+    AmazonPaymentsSession.AUTHORIZED: (AmazonPaymentsSession.AUTHORIZED,),
+    AmazonPaymentsSession.DECLINED: (AmazonPaymentsSession.DECLINED,),
+    AmazonPaymentsSession.CAPTURED: (
+        AmazonPaymentsSession.CAPTURED, AmazonPaymentsSession.REFUNDED,
+        AmazonPaymentsSession.CLOSED),
+    AmazonPaymentsSession.CLOSED: (
+        AmazonPaymentsSession.CLOSED, AmazonPaymentsSession.CAPTURED,
+        AmazonPaymentsSession.REFUNDED),
+}
+
+
+def get_amazon_state(status):
+    """
+    Returns the session state matching the state of an authorization (see
+    AmazonCheckoutView.get_authorization_state), or None if it's pending.
+    """
+    if status["state"] == "Declined":
+        return AmazonPaymentsSession.DECLINED
+    elif status["state"] == "Closed":
+        if status["reason_code"] == "MaxCapturesProcessed":
+            return AmazonPaymentsSession.CAPTURED
+        return AmazonPaymentsSession.CLOSED
+    elif status["state"] == "Open":
+        if status["captured_amount"]:
+            return AmazonPaymentsSession.CAPTURED
+        return AmazonPaymentsSession.AUTHORIZED
+
+
+class Reconciler(object):
+    """
+    Checks that the orders paid with Amazon Payments match the state and
+    amounts of their authorizations on Amazon.
+
+    Sessions with orders are streamed in order of their orders (rather than
+    the sessions, which are created before their orders), in chunks of
+    `batch_size`. The authorizations of each chunk are fetched from
+    `workers` threads, limited by the rate limiter, and the position is
+    saved as a checkpoint after each chunk so the next run only checks
+    orders placed since. The checkpoint isn't moved past a chunk with
+    authorizations that couldn't be fetched (e.g. because the calls were
+    throttled), so that the next run checks them again.
+    """
+    checkpoint_name = "reconciliation"
+
+    def __init__(self, api, workers=4, batch_size=100, rate_limiter=None,
+                 transaction_log_policy=None):
+        self.api = api
+        self.workers = workers
+        self.batch_size = batch_size
+        if rate_limiter is None:
+            # The GetAuthorizationDetails quota
+            rate_limiter = RateLimiter(1, burst=20)
+        self.rate_limiter = rate_limiter
+        if transaction_log_policy is None:
+            transaction_log_policy = TransactionLogPolicy.from_settings()
+        self.transaction_log_policy = transaction_log_policy
+
+    def get_sessions(self, resume=True):
+        sessions = AmazonPaymentsSession.objects.filter(
+            order__isnull=False).select_related("order").order_by("order")
+        if resume:
+            last_order_id = AmazonPaymentsCheckpoint.get_position(
+                self.checkpoint_name)
+            if last_order_id:
+                sessions = sessions.filter(order__gt=int(last_order_id))
+        return sessions.iterator()
+
+    def run(self, resume=True):
+        """
+        Yields a Mismatch for each discrepancy found. Returns once all the
+        orders have been checked.
+        """
+        sessions = self.get_sessions(resume)
+        complete = True
+        while True:
+            chunk = list(itertools.islice(sessions, self.batch_size))
+            if not chunk:
+                return
+            mismatches, chunk_complete = self.check_chunk(chunk)
+            for mismatch in mismatches:
+                yield mismatch
+            complete = complete and chunk_complete
+            if complete:
+                AmazonPaymentsCheckpoint.set_position(
+                    self.checkpoint_name, str(chunk[-1].order_id))
+
+    def check_chunk(self, sessions):
+        """
+        Returns the mismatches found in a chunk of sessions, and whether
+        all of their authorizations could be fetched.
+        """
+        session_pks = [session.pk for session in sessions]
+        # The latest authorization of each session
+        authorization_ids = dict(
+            AmazonPaymentsAuthAttempt.objects.filter(
+                session__in=session_pks, authorization_id__isnull=False,
+            ).order_by("pk").values_list("session", "authorization_id"))
+        debited = {}
+        for order_id, reference, amount in Source.objects.filter(
+                order__in=[session.order_id for session in sessions],
+                reference__in=authorization_ids.values(),
+        ).values_list("order", "reference", "amount_debited"):
+            debited[(order_id, reference)] = amount
+
+        to_fetch = []
+        mismatches = []
+        for session in sessions:
+            authorization_id = authorization_ids.get(session.pk)
+            if authorization_id is None:
+                mismatches.append(self.mismatch(
+                    session, None, "missing_authorization", None, None))
+            else:
+                to_fetch.append((session, authorization_id))
+        transactions = []
+        complete = True
+        for (session, authorization_id), status, exc_info in run_in_threads(
+                self.fetch_status, to_fetch, self.workers):
+            if exc_info is not None:
+                logger.error("Unable to reconcile order %s" % (
+                    session.order.number), exc_info=exc_info)
+                status = {"error_code": exc_info[0].__name__,
+                          "transactions": []}
+            if exc_info is not None or (
+                    status.get("error_code") in RETRYABLE_ERRORS):
+                complete = False
+            transactions.extend(
+                self.build_transaction(session, raw_request, raw_response,
+                                       **kw)
+                for raw_request, raw_response, kw in status["transactions"])
+            mismatches.extend(self.compare(
+                session, authorization_id, status,
+                debited.get((session.order_id, authorization_id))))
+        AmazonPaymentsTransaction.objects.using(
+            router.db_for_write(AmazonPaymentsTransaction)).bulk_create(
+                transactions)
+        return mismatches, complete
+
+    def fetch_status(self, item):
+        """
+        Fetches the details of an authorization. Runs in a worker thread, so
+        it doesn't use the DB; the calls made are returned to be logged.
+        """
+        session, authorization_id = item
+        transactions = []
+        status = {"transactions": transactions}
+
+        def callback(raw_request, raw_response, **kwargs):
+            transactions.append((raw_request, raw_response, kwargs))
+
+        self.rate_limiter.acquire()
+        try:
+            # Always asks Amazon, as a cached status could hide a mismatch
+            details = self.api.get_authorization_details(
+                authorization_id, callback=callback, use_cache=False)
+        except self.api.exception_class, e:
+            status["error_code"] = e.args[0]
+            return status
+        auth_status = details.AuthorizationStatus
+        status.update(
+            state=auth_status.State.text,
+            reason_code=(auth_status.ReasonCode.text
+                         if auth_status.ReasonCode else None),
+            amount=self.get_amount(details.AuthorizationAmount),
+            captured_amount=self.get_amount(details.CapturedAmount))
+        return status
+
+    def get_amount(self, tag):
+        if tag is None or tag.Amount is None:
+            return None
+        return Decimal(tag.Amount.text)
+
+    def compare(self, session, authorization_id, status, amount_debited):
+        """
+        Returns the mismatches between an order and its authorization.
+        """
+        if "error_code" in status:
+            return [self.mismatch(session, authorization_id, "error", None,
+                                  status["error_code"])]
+        mismatches = []
+        total = session.order.total_incl_tax
+        if status["amount"] != total:
+            mismatches.append(self.mismatch(
+                session, authorization_id, "amount", total, status["amount"]))
+        amazon_state = get_amazon_state(status)
+        if (amazon_state is not None and
+                session.state not in MATCHING_STATES[amazon_state]):
+            mismatches.append(self.mismatch(
+                session, authorization_id, "state", session.state,
+                amazon_state))
+        captured_amount = status["captured_amount"] or Decimal("0")
+        if captured_amount != (amount_debited or Decimal("0")):
+            mismatches.append(self.mismatch(
+                session, authorization_id, "captured_amount", amount_debited,
+                captured_amount))
+        return mismatches
+
+    def mismatch(self, session, authorization_id, issue, expected, actual):
+        return Mismatch(session.order.number, session.pk, authorization_id,
+                        issue, expected, actual)
+
+    def build_transaction(self, session, raw_request, raw_response,
+                          action=None, status_code=None, latency=None):
+        details = get_transaction_details(raw_request, raw_response, action)
+        level = self.transaction_log_policy.get_level(
+            details["action"], details["error_code"], status_code)
+        if level == TransactionLogPolicy.SUMMARY:
+            raw_request = raw_response = None
+        return AmazonPaymentsTransaction(
+            session=session, request=raw_request, response=raw_response,
+            status_code=status_code, latency=latency, **details)
@@ -0,0 +1,236 @@
+import logging
+import time
+from collections import defaultdict
+
+from django.db import router, transaction
+from django.utils import timezone
+
+from amazon_payments.api import get_transaction_details
+from amazon_payments.bulk import run_in_threads
+from amazon_payments.logging_policy import TransactionLogPolicy
+from amazon_payments.models import (
+    AmazonPaymentsRenewal, AmazonPaymentsTransaction)
+from amazon_payments.throttling import BULK, RateLimiter
+
+logger = logging.getLogger("amazon_payments")
+
+# Errors after which a call is retried. The reference ID doesn't change,
+# so a retried call can't charge the buyer twice even if the first one got
+# through (e.g. if it timed out). Amazon rejects such a retry, so the
+# renewal is then left for checking rather than marked as failed.
+RETRYABLE_ERRORS = (
+    "OutcomeUnknown",
+    "RequestThrottled",
+    "InternalServerError",
+    "ServiceUnavailable",
+    "RequestFailed",
+)
+
+
+class RenewalProcessor(object):
+    """
+    Charges due AmazonPaymentsRenewals with AuthorizeOnBillingAgreement.
+
+    Renewals are processed in batches, in primary key order. Each batch is
+    claimed (moved to AUTHORIZING) before any calls are made for it, and
+    the result of each call is saved as soon as it's available, so a run
+    that stops part way can be resumed by running it again.
+
+    The API calls are made from `workers` threads, limited by the rate
+    limiter (or the API's, if it has one), while the results are saved
+    from the calling thread.
+
+    If an earlier attempt at charging a renewal may have got through (it
+    timed out, or a run crashed while making it), the renewal is looked up
+    on its order reference if that's known. Otherwise, if the call can't be
+    made again, the renewal is left authorizing with the error code
+    "OutcomeUnknown", to be checked on Seller Central, rather than marked
+    as failed.
+    """
+
+    def __init__(self, api, workers=4, batch_size=100, rate_limiter=None,
+                 max_retries=3, transaction_log_policy=None):
+        self.api = api
+        self.workers = workers
+        self.batch_size = batch_size
+        if rate_limiter is None and api.rate_limiter is None:
+            rate_limiter = RateLimiter(1, burst=10)
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        if transaction_log_policy is None:
+            transaction_log_policy = TransactionLogPolicy.from_settings()
+        self.transaction_log_policy = transaction_log_policy
+
+    def run(self, renewals, heartbeat=None):
+        """
+        Charges the given renewals (a queryset, e.g.
+        AmazonPaymentsRenewal.objects.due()). Returns the number of
+        renewals that ended up in each state.
+
+        If given, heartbeat is called before each batch is claimed, and the
+        run stops if it returns False (e.g. if a shard lease was lost).
+        """
+        counts = defaultdict(int)
+        last_pk = 0
+        while heartbeat is None or heartbeat():
+            batch = list(renewals.filter(pk__gt=last_pk).select_related(
+                "session").order_by("pk")[:self.batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            claimed = [renewal for renewal in batch if self.claim(renewal)]
+            results = run_in_threads(self.authorize, claimed, self.workers)
+            for renewal, result, exc_info in results:
+                if exc_info is not None:
+                    logger.error("Renewal %s failed" % renewal.pk,
+                                 exc_info=exc_info)
+                    result = {"error_code": exc_info[0].__name__,
+                              "transactions": []}
+                self.save_result(renewal, result)
+                counts[renewal.state] += 1
+        return dict(counts)
+
+    def claim(self, renewal):
+        """
+        Moves a renewal to AUTHORIZING, unless it was changed since it was
+        loaded (e.g. claimed by another process). Returns True if it was
+        claimed.
+        """
+        now = timezone.now()
+        # A renewal left authorizing by an earlier run may have been charged
+        outcome_unknown = renewal.state == AmazonPaymentsRenewal.AUTHORIZING
+        claimed = AmazonPaymentsRenewal.objects.filter(
+            pk=renewal.pk, state=renewal.state,
+            updated_at=renewal.updated_at,
+        ).update(state=AmazonPaymentsRenewal.AUTHORIZING,
+                 attempts=renewal.attempts + 1, updated_at=now)
+        if claimed:
+            renewal.outcome_unknown = outcome_unknown
+            renewal.state = AmazonPaymentsRenewal.AUTHORIZING
+            renewal.attempts += 1
+            renewal.updated_at = now
+        return bool(claimed)
+
+    def authorize(self, renewal):
+        """
+        Makes the AuthorizeOnBillingAgreement call for a renewal, retrying
+        it after transient errors. Runs in a worker thread, so it doesn't
+        use the DB; the calls made are returned to be logged by save_result.
+        """
+        transactions = []
+        result = {"transactions": transactions}
+
+        def callback(raw_request, raw_response, **kwargs):
+            transactions.append((raw_request, raw_response, kwargs))
+
+        outcome_unknown = getattr(renewal, "outcome_unknown", False)
+        if outcome_unknown and renewal.order_reference_id:
+            try:
+                auth_details = self.find_authorization(renewal, callback)
+            except self.api.exception_class:
+                result["error_code"] = "OutcomeUnknown"
+                return result
+            if auth_details is not None:
+                return self.get_result(result, auth_details)
+            outcome_unknown = False
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(BULK)
+            try:
+                authorization_id, auth_status, tx = \
+                    self.api.authorize_on_billing_agreement(
+                        renewal.session.billing_agreement_id,
+                        renewal.reference_id, str(renewal.amount),
+                        renewal.currency, callback=callback)
+            except self.api.exception_class, e:
+                if e.args[0] == "OutcomeUnknown":
+                    outcome_unknown = True
+                if (e.args[0] in RETRYABLE_ERRORS and
+                        attempt < self.max_retries):
+                    time.sleep(2 ** attempt)
+                    continue
+                # A call that was rejected after an earlier one may have got
+                # through could have been rejected for reusing its reference.
+                result["error_code"] = (
+                    "OutcomeUnknown" if outcome_unknown else e.args[0])
+                return result
+            result.update(authorization_id=authorization_id,
+                          auth_state=auth_status.State.text)
+            if auth_status.ReasonCode:
+                result["reason_code"] = auth_status.ReasonCode.text
+            return result
+
+    def find_authorization(self, renewal, callback):
+        """
+        Returns the AuthorizationDetails of the authorization made for a
+        renewal on its order reference, or None if there isn't one.
+        """
+        authorization_id = self.api.find_authorization(
+            renewal.order_reference_id, renewal.reference_id,
+            callback=callback)
+        if authorization_id is not None:
+            return self.api.get_authorization_details(
+                authorization_id, callback=callback, use_cache=False)
+
+    def get_result(self, result, auth_details):
+        auth_status = auth_details.AuthorizationStatus
+        result.update(
+            authorization_id=auth_details.AmazonAuthorizationId.text,
+            auth_state=auth_status.State.text)
+        if auth_status.ReasonCode:
+            result["reason_code"] = auth_status.ReasonCode.text
+        return result
+
+    def get_renewal_state(self, result):
+        auth_state = result.get("auth_state")
+        if result.get("error_code") == "OutcomeUnknown":
+            # Left to be checked, and not retried (see
+            # AmazonPaymentsRenewalManager.due)
+            return AmazonPaymentsRenewal.AUTHORIZING
+        elif auth_state is None:
+            return AmazonPaymentsRenewal.FAILED
+        elif auth_state == "Declined":
+            return AmazonPaymentsRenewal.DECLINED
+        elif auth_state == "Pending":
+            # Left for the authorization to be checked with
+            # GetAuthorizationDetails; stale renewals with an
+            # authorization ID aren't retried.
+            return AmazonPaymentsRenewal.AUTHORIZING
+        return AmazonPaymentsRenewal.AUTHORIZED
+
+    def build_transaction(self, renewal, raw_request, raw_response,
+                          action=None, status_code=None, latency=None):
+        details = get_transaction_details(raw_request, raw_response, action)
+        level = self.transaction_log_policy.get_level(
+            details["action"], details["error_code"], status_code)
+        if level == TransactionLogPolicy.SUMMARY:
+            raw_request = raw_response = None
+        return AmazonPaymentsTransaction(
+            session=renewal.session, request=raw_request,
+            response=raw_response, status_code=status_code, latency=latency,
+            **details)
+
+    def save_result(self, renewal, result):
+        """
+        Saves the outcome of a renewal and logs the calls made for it, in a
+        single atomic write (on each database, if the transaction log is
+        routed to its own).
+        """
+        transactions = [
+            self.build_transaction(renewal, raw_request, raw_response, **kw)
+            for raw_request, raw_response, kw in result["transactions"]]
+        renewal.state = self.get_renewal_state(result)
+        renewal.authorization_id = result.get("authorization_id")
+        renewal.error_code = result.get("error_code")
+        if renewal.state == AmazonPaymentsRenewal.DECLINED:
+            renewal.error_code = result.get("reason_code")
+        for tx in transactions:
+            if tx.order_reference_id:
+                renewal.order_reference_id = tx.order_reference_id
+        using = router.db_for_write(AmazonPaymentsTransaction)
+        # The transaction log may be routed to its own database.
+        with transaction.atomic(using=using), transaction.atomic(
+                using=router.db_for_write(AmazonPaymentsRenewal)):
+            AmazonPaymentsTransaction.objects.using(using).bulk_create(
+                transactions)
+            renewal.save()
@@ -0,0 +1,54 @@
+from django.conf import settings
+
+# Models that are routed to the log database. These are write-heavy audit
+# tables that nothing in the checkout process reads back.
+DEFAULT_LOG_MODELS = ("amazonpaymentstransaction",)
+
+
+class AmazonPaymentsRouter(object):
+    """
+    Database router that isolates the Amazon Payments transaction log.
+
+    Writes to the log models go to the AMAZON_PAYMENTS_LOG_DATABASE alias,
+    and reads from them go to AMAZON_PAYMENTS_LOG_REPLICA_DATABASE (if set),
+    e.g. a replica used for reporting. Sessions and auth attempts are left
+    to the default routing, so money-critical writes stay on the primary
+    database.
+
+    Add "amazon_payments.routers.AmazonPaymentsRouter" to DATABASE_ROUTERS
+    to enable it.
+    """
+
+    def get_log_database(self):
+        return getattr(settings, "AMAZON_PAYMENTS_LOG_DATABASE", None)
+
+    def get_log_replica_database(self):
+        return getattr(settings, "AMAZON_PAYMENTS_LOG_REPLICA_DATABASE",
+                       None) or self.get_log_database()
+
+    def is_log_model(self, model):
+        return (model._meta.app_label == "amazon_payments" and
+                model._meta.model_name in getattr(
+                    settings, "AMAZON_PAYMENTS_LOG_MODELS",
+                    DEFAULT_LOG_MODELS))
+
+    def db_for_read(self, model, **hints):
+        if self.is_log_model(model):
+            return self.get_log_replica_database()
+
+    def db_for_write(self, model, **hints):
+        if self.is_log_model(model):
+            return self.get_log_database()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Log rows point at sessions and auth attempts on another database.
+        # The relation can't be enforced by the database, but is valid.
+        if (obj1._meta.app_label == "amazon_payments" and
+                obj2._meta.app_label == "amazon_payments"):
+            return True
+
+    def allow_syncdb(self, db, model):
+        log_database = self.get_log_database()
+        if log_database is None or model._meta.app_label != "amazon_payments":
+            return None
+        return (db == log_database) == self.is_log_model(model)
@@ -0,0 +1,170 @@
+import csv
+import gzip
+import itertools
+import logging
+import operator
+from decimal import Decimal, InvalidOperation
+
+from django.db import router, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from amazon_payments.models import (
+    AmazonPaymentsSession, AmazonPaymentsAuthAttempt,
+    AmazonPaymentsSettlement)
+
+logger = logging.getLogger("amazon_payments")
+
+
+def open_report(path):
+    """
+    Opens a (possibly gzipped) settlement report for reading.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+class SettlementImporter(object):
+    """
+    Imports flat file settlement reports into AmazonPaymentsSettlement.
+
+    Reports are read one row at a time and written with bulk_create in
+    batches of `batch_size`, so memory use doesn't grow with the size of
+    the report. Rows are matched to sessions and orders with dicts built
+    once per importer (by authorization ID, order reference ID and order
+    number), rather than with a query per row.
+    """
+    # Model field names, keyed by the report column they're read from
+    columns = {
+        "SettlementId": "settlement_id",
+        "TransactionType": "transaction_type",
+        "AmazonTransactionId": "amazon_transaction_id",
+        "OrderReferenceId": "order_reference_id",
+        "SellerOrderId": "seller_order_id",
+        "TransactionAmount": "amount",
+        "CurrencyCode": "currency",
+        "TransactionPostedDate": "posted_at",
+    }
+
+    def __init__(self, batch_size=5000, delimiter="\t"):
+        self.batch_size = batch_size
+        self.delimiter = delimiter
+        self._index = None
+        # The highest row number imported so far for each settlement
+        self._replaced = {}
+
+    def get_index(self):
+        """
+        Returns a dict mapping authorization IDs, order reference IDs and
+        order numbers to (session ID, order ID) tuples.
+        """
+        if self._index is None:
+            index = {}
+            sessions = AmazonPaymentsSession.objects.filter(
+                order__isnull=False).values_list(
+                    "pk", "order", "order__number", "order_reference_id")
+            order_ids = {}
+            for session_id, order_id, number, order_reference_id in (
+                    sessions.iterator()):
+                order_ids[session_id] = order_id
+                index[number] = (session_id, order_id)
+                if order_reference_id:
+                    index[order_reference_id] = (session_id, order_id)
+            auth_attempts = AmazonPaymentsAuthAttempt.objects.filter(
+                authorization_id__isnull=False).values_list(
+                    "session", "authorization_id")
+            for session_id, authorization_id in auth_attempts.iterator():
+                index[authorization_id] = (
+                    session_id, order_ids.get(session_id))
+            self._index = index
+        return self._index
+
+    def read(self, report):
+        """
+        Yields the rows of a report (a file object) as dicts of
+        AmazonPaymentsSettlement field values.
+        """
+        reader = csv.reader(report, delimiter=self.delimiter)
+        header = next(reader, [])
+        positions = [(i, self.columns[name.strip()])
+                     for i, name in enumerate(header)
+                     if name.strip() in self.columns]
+        for row_number, row in enumerate(reader, 1):
+            values = {"row_number": row_number}
+            for i, field in positions:
+                if i < len(row):
+                    values[field] = row[i].strip().decode("utf-8")
+            yield values
+
+    def build_settlement(self, values):
+        amount = values.get("amount")
+        try:
+            values["amount"] = Decimal(amount) if amount else None
+        except InvalidOperation:
+            logger.warning("Invalid amount %r in settlement row %s" % (
+                amount, values["row_number"]))
+            values["amount"] = None
+        posted_at = values.get("posted_at")
+        values["posted_at"] = parse_datetime(posted_at) if posted_at \
+            else None
+        if (values["posted_at"] is not None and
+                timezone.is_naive(values["posted_at"])):
+            values["posted_at"] = timezone.make_aware(
+                values["posted_at"], timezone.utc)
+        settlement = AmazonPaymentsSettlement(**values)
+        index = self.get_index()
+        for key in (settlement.amazon_transaction_id,
+                    settlement.order_reference_id,
+                    settlement.seller_order_id):
+            if key and key in index:
+                settlement.session_id, settlement.order_id = index[key]
+                break
+        return settlement
+
+    def run(self, report):
+        """
+        Imports a report (a file object), replacing any rows previously
+        imported for the settlements in it. Returns the number of rows
+        imported and how many of them were matched.
+
+        Each settlement's rows are replaced in a transaction, so a failed
+        import leaves the rows previously imported for it in place. A
+        settlement that carries on from a report already imported by this
+        importer is added to rather than replaced.
+        """
+        imported = matched = 0
+        using = router.db_for_write(AmazonPaymentsSettlement)
+        settlements = itertools.groupby(
+            itertools.imap(self.build_settlement, self.read(report)),
+            operator.attrgetter("settlement_id"))
+        offsets = {}
+        for settlement_id, rows in settlements:
+            with transaction.atomic(using=using):
+                if settlement_id not in offsets:
+                    offsets[settlement_id] = self._replaced.get(
+                        settlement_id, 0)
+                    if settlement_id not in self._replaced:
+                        AmazonPaymentsSettlement.objects.using(using).filter(
+                            settlement_id=settlement_id).delete()
+                offset = offsets[settlement_id]
+                batch = []
+                for settlement in rows:
+                    settlement.row_number += offset
+                    batch.append(settlement)
+                    imported += 1
+                    if settlement.session_id is not None:
+                        matched += 1
+                    if len(batch) >= self.batch_size:
+                        self.save_batch(batch, using)
+                        batch = []
+                self.save_batch(batch, using)
+                self._replaced[settlement_id] = settlement.row_number
+        return imported, matched
+
+    def save_batch(self, batch, using):
+        if not batch:
+            return
+        AmazonPaymentsSettlement.objects.using(using).bulk_create(batch)
+        logger.debug("Imported settlement rows up to #%s" % (
+            batch[-1].row_number))
@@ -0,0 +1,48 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+BASKET_VERSION_KEY = "amazon_payments_basket_version:%s"
+OFFERS_VERSION_KEY = "amazon_payments_offers_version"
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, None):
+            version = cache.get(key) or version
+    return version
+
+
+def bump_basket_version(basket_id):
+    """
+    Invalidates the shipping methods cached for a basket.
+    """
+    cache.set(BASKET_VERSION_KEY % basket_id, uuid.uuid4().hex, None)
+
+
+def bump_offers_version():
+    """
+    Invalidates the shipping methods cached for all baskets.
+    """
+    cache.set(OFFERS_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def get_shipping_cache_key(basket, user, shipping_address=None):
+    """
+    Returns the cache key of the shipping methods of a basket, which
+    changes whenever the basket's lines or vouchers, or any
+    offers, change.
+    """
+    address_hash = ""
+    if shipping_address is not None:
+        address_hash = shipping_address.generate_hash()
+    return "amazon_payments_shipping:%s:%s:%s:%s:%s" % (
+        basket.id, user.pk, _get_version(BASKET_VERSION_KEY % basket.id),
+        _get_version(OFFERS_VERSION_KEY), address_hash)
+
+
+def get_shipping_cache_timeout():
+    return getattr(settings, "AMAZON_PAYMENTS_SHIPPING_CACHE_TIMEOUT", 60 * 15)
@@ -0,0 +1,286 @@
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils.module_loading import import_by_path
+
+from amazon_payments.locks import CacheLock
+from amazon_payments.models import (
+    AmazonPaymentsSession, AmazonPaymentsTransaction)
+
+DEFAULT_STORAGE = "amazon_payments.storage.DatabaseSessionStorage"
+
+
+def get_session_storage(request):
+    """
+    Returns the AMAZON_PAYMENTS_SESSION_STORAGE instance for the request,
+    creating it on first use so that the session is only loaded once per
+    request.
+    """
+    if not hasattr(request, "_amazon_payments_session_storage"):
+        storage_class = import_by_path(getattr(
+            settings, "AMAZON_PAYMENTS_SESSION_STORAGE", DEFAULT_STORAGE))
+        request._amazon_payments_session_storage = storage_class(request)
+    return request._amazon_payments_session_storage
+
+
+class DatabaseSessionStorage(object):
+    """
+    Saves the AmazonPaymentsSession of the request's basket to the DB
+    whenever it changes.
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    def get(self):
+        """
+        Returns the AmazonPaymentsSession for the request's basket, or None.
+        """
+        if not hasattr(self, "_session"):
+            self._session = self.load_from_db()
+        return self._session
+
+    def load_from_db(self):
+        try:
+            return self.request.basket.amazonpaymentssession
+        except (AmazonPaymentsSession.DoesNotExist, AttributeError):
+            return None
+
+    def save(self, session):
+        session.save()
+        self._session = session
+
+    def persist(self, session):
+        """
+        Makes sure the session is saved to the DB, e.g. before saving
+        objects that refer to it.
+        """
+        if session.pk is None:
+            self.save(session)
+
+    def add_transaction(self, session, tx):
+        tx.save()
+
+    def transition(self, session, state, **fields):
+        """
+        Moves the session to the given state. See
+        AmazonPaymentsSession.transition.
+        """
+        return session.transition(state, **fields)
+
+
+class EphemeralSessionStorage(DatabaseSessionStorage):
+    """
+    Keeps a new AmazonPaymentsSession, and the transactions logged for it,
+    out of the DB until it's persisted (before its payment is authorized),
+    as most sessions belong to baskets that are abandoned.
+
+    Subclasses implement load_data, store_data and clear_data.
+    """
+
+    fields = ("billing_agreement_id", "order_reference_id", "access_token",
+              "access_token_expires_at", "state")
+    # Sessions are persisted before moving to these states, in which money
+    # is moved, so that AmazonPaymentsSession.transition makes the move
+    # with a conditional UPDATE that only one request can win.
+    persisted_states = (AmazonPaymentsSession.AUTHORIZING,)
+
+    def get(self):
+        if not hasattr(self, "_session"):
+            data = self.load_data()
+            if data is None:
+                self._session = self.load_from_db()
+            else:
+                self._session = AmazonPaymentsSession(
+                    basket=self.request.basket, **dict(
+                        (name, AmazonPaymentsSession._meta.get_field(name)
+                         .to_python(value))
+                        for name, value in data["session"].items()))
+                self._session._pending_transactions = data["transactions"]
+        return self._session
+
+    def get_data(self, session):
+        return {
+            # Kept JSON serializable, for SessionSessionStorage
+            "session": dict(
+                (name, self.get_field_data(session, name))
+                for name in self.fields),
+            "transactions": getattr(session, "_pending_transactions", []),
+        }
+
+    def get_field_data(self, session, name):
+        value = getattr(session, name)
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        return value
+
+    def save(self, session):
+        if session.pk is not None or not self.can_store():
+            super(EphemeralSessionStorage, self).save(session)
+            self.clear_data()
+            return
+        self.store_data(self.get_data(session))
+        self._session = session
+
+    def persist(self, session):
+        if session.pk is not None:
+            return
+        pending = self.get_pending_transactions(session)
+        with transaction.atomic():
+            super(EphemeralSessionStorage, self).save(session)
+            AmazonPaymentsTransaction.objects.bulk_create([
+                AmazonPaymentsTransaction(session=session, **fields)
+                for fields in pending])
+        session._pending_transactions = []
+        self.clear_data()
+
+    def add_transaction(self, session, tx):
+        if session.pk is not None:
+            return tx.save()
+        if not hasattr(session, "_pending_transactions"):
+            session._pending_transactions = []
+        fields = self.get_transaction_data(tx)
+        session._pending_transactions.append(fields)
+        self.store_transaction(session, fields)
+
+    def get_transaction_data(self, tx):
+        """
+        Returns the fields of a transaction that are kept until the session
+        is persisted.
+        """
+        return dict((field.attname, getattr(tx, field.attname))
+                    for field in tx._meta.fields
+                    if field.attname not in ("id", "session_id", "created_at"))
+
+    def store_transaction(self, session, fields):
+        self.save(session)
+
+    def get_pending_transactions(self, session):
+        return getattr(session, "_pending_transactions", [])
+
+    def transition(self, session, state, **fields):
+        if session.pk is None and state in self.persisted_states:
+            try:
+                self.persist(session)
+            except IntegrityError:
+                # Another request for the basket persisted its session
+                # first, and is making the move.
+                return False
+        changed = session.transition(state, **fields)
+        if changed and session.pk is None:
+            self.save(session)
+        return changed
+
+    def can_store(self):
+        return True
+
+    def load_data(self):
+        raise NotImplementedError
+
+    def store_data(self, data):
+        raise NotImplementedError
+
+    def clear_data(self):
+        raise NotImplementedError
+
+
+class CacheSessionStorage(EphemeralSessionStorage):
+    """
+    Keeps new sessions in Django's cache, keyed by basket.
+
+    The transactions are kept under their own key and appended to under a
+    lock, so that concurrent requests for the same basket (e.g. widget
+    callbacks) don't overwrite each other's transactions.
+    """
+
+    def get_cache_key(self):
+        return "amazon_payments_session:%s" % self.request.basket.id
+
+    def get_transactions_key(self):
+        return "%s:transactions" % self.get_cache_key()
+
+    def get_timeout(self):
+        return getattr(
+            settings, "AMAZON_PAYMENTS_SESSION_CACHE_TIMEOUT", 3 * 60 * 60)
+
+    def can_store(self):
+        return getattr(self.request.basket, "id", None) is not None
+
+    def get_data(self, session):
+        data = super(CacheSessionStorage, self).get_data(session)
+        del data["transactions"]
+        return data
+
+    def load_data(self):
+        if self.can_store():
+            values = cache.get_many(
+                [self.get_cache_key(), self.get_transactions_key()])
+            data = values.get(self.get_cache_key())
+            if data is not None:
+                data["transactions"] = values.get(
+                    self.get_transactions_key(), [])
+            return data
+
+    def store_data(self, data):
+        cache.set(self.get_cache_key(), data, self.get_timeout())
+
+    def store_transaction(self, session, fields):
+        if not self.can_store():
+            return self.save(session)
+        key = self.get_transactions_key()
+        lock = CacheLock(key, timeout=5)
+        # If the lock can't be acquired, it's most likely held by a crashed
+        # process, and expires shortly.
+        lock.acquire(wait=5)
+        try:
+            transactions = cache.get(key) or []
+            transactions.append(fields)
+            cache.set(key, transactions, self.get_timeout())
+        finally:
+            lock.release()
+        session._pending_transactions = transactions
+        self.save(session)
+
+    def get_pending_transactions(self, session):
+        if not self.can_store():
+            return super(CacheSessionStorage, self).get_pending_transactions(
+                session)
+        return cache.get(self.get_transactions_key()) or []
+
+    def clear_data(self):
+        if self.can_store():
+            cache.delete_many(
+                [self.get_cache_key(), self.get_transactions_key()])
+
+
+class SessionSessionStorage(EphemeralSessionStorage):
+    """
+    Keeps new sessions in the user's Django session, which can be backed by
+    signed cookies.
+
+    Only summaries of the transactions (without the raw request and
+    response) are kept, as a cookie can hold about 4KB. Sessions are
+    persisted before they move to AUTHORIZING, so the money-moving calls
+    made after that are saved in full.
+    """
+
+    session_key = "amazon_payments_session"
+
+    def load_data(self):
+        data = self.request.session.get(self.session_key)
+        if data and data["basket_id"] == self.request.basket.id:
+            return data
+
+    def store_data(self, data):
+        data["basket_id"] = self.request.basket.id
+        self.request.session[self.session_key] = data
+
+    def clear_data(self):
+        self.request.session.pop(self.session_key, None)
+
+    def get_transaction_data(self, tx):
+        fields = super(SessionSessionStorage, self).get_transaction_data(tx)
+        fields.update(request=None, response=None)
+        return fields
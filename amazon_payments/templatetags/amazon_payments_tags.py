@@ -0,0 +1,141 @@
+from django import template
+from django.utils.html import escape, escapejs
+from django.utils.http import urlquote
+from django.utils.safestring import mark_safe
+
+register = template.Library()
+
+WIDGETS_HOST = "https://static-na.payments-amazon.com"
+PAYMENTS_HOSTS = {
+    True: "https://payments.amazon.com",
+    False: "https://payments-sandbox.amazon.com",
+}
+
+HEAD_TEMPLATE = """\
+<link rel="preconnect" href="%(widgets_host)s">
+<link rel="dns-prefetch" href="%(widgets_host)s">
+<link rel="dns-prefetch" href="%(payments_host)s">
+<script type="text/javascript">
+window.onAmazonLoginReady = function() {
+    amazon.Login.setClientId('%(client_id)s');
+};
+(function() {
+    var ready = false, pending = [];
+    function onError(error) {
+        if (!(document.getElementById('amazon_error_code').value || \
+document.getElementById('amazon_error_message').value)) {
+            document.getElementById('amazon_error_code').value = \
+error.getErrorCode();
+            document.getElementById('amazon_error_message').value = \
+error.getErrorMessage();
+            document.getElementById('amazon_place_order').submit();
+        }
+    }
+    function onChange() {
+        // Tells the view to discard billing agreement details it prefetched
+        var changed = document.getElementById('amazon_widgets_changed');
+        if (changed) {
+            changed.value = '1';
+        }
+    }
+    function bind(widget) {
+        widget.options.sellerId = '%(seller_id)s';
+        widget.options.agreementType = 'BillingAgreement';
+        widget.options.onError = onError;
+        widget.options.onAddressSelect = onChange;
+        widget.options.onPaymentSelect = onChange;
+        widget.options.onConsent = onChange;
+        new OffAmazonPayments.Widgets[widget.type](widget.options)
+            .bind(widget.element);
+    }
+    function mount(widget) {
+        var element = document.getElementById(widget.element);
+        if (!widget.lazy || !window.IntersectionObserver || !element) {
+            return bind(widget);
+        }
+        // Only load widgets once they're (nearly) scrolled into view.
+        var observer = new IntersectionObserver(function(entries) {
+            if (entries[0].isIntersecting) {
+                observer.disconnect();
+                bind(widget);
+            }
+        }, {rootMargin: '200px'});
+        observer.observe(element);
+    }
+    window.amazonPaymentsWidget = function(type, element, options, lazy) {
+        var widget = {type: type, element: element, options: options,
+                      lazy: lazy};
+        if (ready) {
+            mount(widget);
+        } else {
+            pending.push(widget);
+        }
+    };
+    window.onAmazonPaymentsReady = function() {
+        ready = true;
+        while (pending.length) {
+            mount(pending.shift());
+        }
+    };
+})();
+</script>
+<script type="text/javascript" async src="%(widgets_host)s/OffAmazonPayments/\
+us%(sandbox)s/js/Widgets.js?sellerId=%(quoted_seller_id)s"></script>"""
+
+WIDGET_TEMPLATE = """\
+<div id="%(element_id)s"></div>
+<script type="text/javascript">
+amazonPaymentsWidget('%(type)s', '%(element)s', {
+    amazonBillingAgreementId: '%(billing_agreement_id)s',
+    displayMode: '%(display_mode)s',
+    design: {size: {width: '%(width)s', height: '%(height)s'}}
+}, %(lazy)s);
+</script>"""
+
+# Widgets that are bound straight away rather than when they're scrolled
+# into view, as the order can't be placed until they're set up (the Consent
+# widget sets whether the buyer agreed to future payments).
+EAGER_WIDGETS = ("Consent",)
+
+
+@register.simple_tag(takes_context=True)
+def amazon_payments_head(context):
+    """
+    Renders the resource hints for the Amazon Payments hosts, and loads
+    Widgets.js without blocking the page. Widgets added with
+    amazon_payments_widget are bound once it has loaded.
+    """
+    is_live = bool(context.get("amazon_payments_is_live"))
+    seller_id = context.get("amazon_payments_seller_id") or ""
+    return mark_safe(HEAD_TEMPLATE % {
+        "widgets_host": WIDGETS_HOST,
+        "payments_host": PAYMENTS_HOSTS[is_live],
+        "client_id": escapejs(
+            context.get("amazon_payments_client_id") or ""),
+        "seller_id": escapejs(seller_id),
+        "quoted_seller_id": urlquote(seller_id),
+        "sandbox": "" if is_live else "/sandbox",
+    })
+
+
+@register.simple_tag(takes_context=True)
+def amazon_payments_widget(context, widget_type, element, width="400px",
+                           height="260px", display_mode="Edit", lazy=None):
+    """
+    Renders an Amazon Payments widget (e.g. AddressBook, Wallet or Consent)
+    for the billing agreement. Unless lazy is False (the default for
+    EAGER_WIDGETS), it's bound when it's scrolled into view.
+    """
+    if lazy is None:
+        lazy = widget_type not in EAGER_WIDGETS
+    return mark_safe(WIDGET_TEMPLATE % {
+        "type": escapejs(widget_type),
+        "element": escapejs(element),
+        "element_id": escape(element),
+        "width": escapejs(width),
+        "height": escapejs(height),
+        "display_mode": escapejs(display_mode),
+        "billing_agreement_id": escapejs(
+            context.get("amazon_payments_billing_agreement_id") or ""),
+        "lazy": "true" if lazy else "false",
+    })
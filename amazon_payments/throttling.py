@@ -0,0 +1,133 @@
+import threading
+import time
+
+# Request priorities, highest first
+INTERACTIVE = "interactive"
+NORMAL = "normal"
+BULK = "bulk"
+PRIORITIES = (INTERACTIVE, NORMAL, BULK)
+
+
+class RateLimiter(object):
+    """
+    A token bucket shared by the threads of a process, which allows bursts
+    of up to `burst` calls and `rate` calls per second on average, like the
+    request quotas of the MWS API.
+
+    headroom maps priorities to the number of tokens that calls of that
+    priority must leave in the bucket, so that some of the quota is kept for
+    higher priority calls (e.g. {NORMAL: 2, BULK: 5}).
+    """
+
+    def __init__(self, rate, burst=1, headroom=None):
+        self.rate = float(rate)
+        self.burst = burst
+        self.headroom = headroom or {}
+        for priority, tokens in self.headroom.items():
+            if priority not in PRIORITIES:
+                raise ValueError("Unknown priority %r" % priority)
+            if tokens + 1 > burst:
+                raise ValueError("The headroom for %s calls must be less "
+                                 "than the burst size" % priority)
+        self.tokens = float(burst)
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def _take(self, tokens, updated_at, now, priority):
+        """
+        Refills a bucket that had the given number of tokens at updated_at,
+        and takes a token from it if a call of the given priority may be
+        made. Returns the number of tokens left and the number of seconds
+        until a call may be made, which is 0 if a token was taken.
+        """
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        needed = 1 + self.headroom.get(priority, 0)
+        if tokens >= needed:
+            return tokens - 1, 0
+        return tokens, (needed - tokens) / self.rate
+
+    def try_acquire(self, priority=NORMAL):
+        """
+        Takes a token if one is available to calls of the given priority.
+        Returns the number of seconds until one will be, which is 0 if a
+        token was taken.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens, wait = self._take(
+                self.tokens, self.updated_at, now, priority)
+            self.updated_at = now
+            return wait
+
+    def acquire(self, priority=NORMAL, timeout=None):
+        """
+        Waits until a call of the given priority may be made, or for up to
+        `timeout` seconds if given. Returns False straight away if a call
+        couldn't be made within the timeout, else True.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = self.try_acquire(priority)
+            if not wait:
+                return True
+            if deadline is not None and time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class ConcurrencyController(object):
+    """
+    Limits the number of calls in flight with AIMD (additive increase,
+    multiplicative decrease): the limit grows by about one for each window
+    of healthy calls, and is cut by `decrease` when a call is throttled or
+    its latency spikes to more than `spike_factor` times the average.
+
+    Only calls started since the last cut can cut the limit again, so a
+    burst of throttled calls that were in flight together counts once.
+    """
+
+    def __init__(self, max_limit, min_limit=1, initial_limit=None,
+                 decrease=0.5, spike_factor=3.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit or min_limit)
+        self.decrease = decrease
+        self.spike_factor = spike_factor
+        self.in_flight = 0
+        self.avg_latency = None
+        self.epoch = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Waits until another call may be started. Returns a token to pass to
+        release once the call is done.
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return self.epoch
+
+    def release(self, token, latency=None, throttled=False):
+        """
+        Records the outcome of a call started with acquire and adjusts the
+        limit.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            spike = (latency is not None and self.avg_latency is not None and
+                     latency > self.spike_factor * self.avg_latency)
+            if throttled or spike:
+                if token == self.epoch:
+                    self.limit = max(self.min_limit,
+                                     self.limit * self.decrease)
+                    self.epoch += 1
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            if latency is not None and not throttled:
+                if self.avg_latency is None:
+                    self.avg_latency = latency
+                else:
+                    self.avg_latency = 0.8 * self.avg_latency + 0.2 * latency
+            self.condition.notify_all()
@@ -1,34 +1,46 @@
 from django.conf.urls import patterns, url
+from django.views.decorators.csrf import csrf_exempt
 
-import views
+from amazon_payments.lazy import lazy_view
+
+
+def view(name, **initkwargs):
+    # The views (and Oscar's checkout app) are imported on first request.
+    return lazy_view("amazon_payments.views", name, **initkwargs)
 
 
 # URLs for one-step checkout process
 urlpatterns = patterns("",
-    url(r'^amazon/login/$', views.AmazonOneStepLoginRedirectView.as_view(),  # noqa
+    url(r'^amazon/login/$', view("AmazonOneStepLoginRedirectView"),  # noqa
         name='amazon-payments-login-onestep'),
-    url(r'^amazon/$', views.AmazonOneStepPaymentDetailsView.as_view(),
+    url(r'^amazon/$', view("AmazonOneStepPaymentDetailsView"),
         name='amazon-payments-onestep'),
 )
 
 # URLs for default oscar multi-step checkout process
 urlpatterns += patterns("",
-    url(r'^amazon2/login/$', views.AmazonLoginRedirectView.as_view(),  # noqa
+    url(r'^amazon2/login/$', view("AmazonLoginRedirectView"),  # noqa
         name='amazon-payments-login'),
-    url(r'^amazon2/$', views.AmazonPaymentsIndexView.as_view(),
+    url(r'^amazon2/$', view("AmazonPaymentsIndexView"),
         name='amazon-payments-index'),
     url(r'^amazon2/shipping-address/$',
-        views.AmazonShippingAddressView.as_view(),
+        view("AmazonShippingAddressView"),
         name='amazon-payments-shipping-address'),
     url(r'^amazon2/shipping-method/$',
-        views.AmazonShippingMethodView.as_view(),
+        view("AmazonShippingMethodView"),
         name='amazon-payments-shipping-method'),
-    url(r'^amazon2/payment-method/$', views.AmazonPaymentMethodView.as_view(),
+    url(r'^amazon2/payment-method/$', view("AmazonPaymentMethodView"),
         name='amazon-payments-payment-method'),
     url(r'^amazon2/preview/$',
-        views.AmazonPaymentDetailsView.as_view(preview=True),
+        view("AmazonPaymentDetailsView", preview=True),
         name='amazon-payments-preview'),
     url(r'^amazon2/payment-details/$',
-        views.AmazonPaymentDetailsView.as_view(),
+        view("AmazonPaymentDetailsView"),
         name='amazon-payments-payment-details'),
 )
+
+# Instant payment notifications, which are posted by Amazon SNS
+urlpatterns += patterns("",
+    url(r'^amazon/ipn/$', csrf_exempt(view("AmazonPaymentsIPNView")),  # noqa
+        name='amazon-payments-ipn'),
+)
@@ -0,0 +1,87 @@
+import binascii
+import os
+import sys
+import threading
+import time
+
+from django.conf import settings
+
+# Crockford's base 32 alphabet, as used by ULIDs
+ULID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+
+def generate_ulid():
+    """
+    Returns a new ULID: a 26 character, lexicographically time-ordered
+    identifier made up of a millisecond timestamp and 80 random bits.
+    """
+    value = int(time.time() * 1000) << 80 | int(
+        binascii.hexlify(os.urandom(10)), 16)
+    chars = []
+    for i in range(26):
+        value, index = divmod(value, 32)
+        chars.append(ULID_ALPHABET[index])
+    return "".join(reversed(chars))
+
+
+_background_slots = None
+
+
+def _get_background_slots():
+    global _background_slots
+    if _background_slots is None:
+        _background_slots = threading.BoundedSemaphore(getattr(
+            settings, "AMAZON_PAYMENTS_BACKGROUND_THREADS", 10))
+    return _background_slots
+
+
+class BackgroundCall(object):
+    """
+    Calls func(*args, **kwargs) in a background thread, so that the caller
+    can do other work until it needs the result.
+
+    At most AMAZON_PAYMENTS_BACKGROUND_THREADS calls run in the background
+    at once, per process. When no thread is available (or background is
+    False), the call is made when the result is asked for instead.
+
+    func shouldn't use the DB, as the thread has its own connection, which
+    can't see uncommitted changes made by the request.
+    """
+
+    def __init__(self, func, args=(), kwargs=None, background=True):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.thread = None
+        self.done = False
+        if background and _get_background_slots().acquire(False):
+            self.thread = threading.Thread(target=self._run_in_background)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+            self.exc_info = None
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.done = True
+
+    def _run_in_background(self):
+        try:
+            self._run()
+        finally:
+            _get_background_slots().release()
+
+    def result(self):
+        """
+        Waits for the call to finish and returns its result, or re-raises
+        the exception it raised.
+        """
+        if self.thread is not None:
+            self.thread.join()
+        elif not self.done:
+            self._run()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
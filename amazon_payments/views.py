@@ -1,11 +1,18 @@
+import datetime
+import json
 import logging
+import uuid
 
 from django.core.urlresolvers import reverse, reverse_lazy
 from django.contrib import messages
 from django.conf import settings
+from django.core.cache import cache
+from django.db import router, transaction
 from django.utils.translation import ugettext as _
 from django.shortcuts import redirect, render_to_response
 from django.template import RequestContext
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 from django.views import generic
 from django import http
 
@@ -14,15 +21,41 @@ from oscar.core.loading import get_class, get_model
 from oscar.apps.checkout.views import (
     PaymentDetailsView, ShippingMethodView, PaymentMethodView, IndexView)
 
-from models import AmazonPaymentsSession
+from models import (
+    AmazonPaymentsSession, AmazonPaymentsTransaction,
+    AmazonPaymentsAuthAttempt)
 from amazon_payments import AmazonPaymentsAPI, AmazonPaymentsAPIError
+from amazon_payments.api import (
+    bs4, get_order_reference_id, get_transaction_details)
+from amazon_payments.caching import get_status_cache
+from amazon_payments.locks import CacheLock, get_shared_rate_limiter
+from amazon_payments.logging_policy import TransactionLogPolicy
+from amazon_payments.payment import get_payment_event_type, get_source_type
+from amazon_payments.shipping import (
+    get_shipping_cache_key, get_shipping_cache_timeout)
+from amazon_payments.storage import get_session_storage
+from amazon_payments.throttling import INTERACTIVE
+from amazon_payments.utils import BackgroundCall, generate_ulid
 
 logger = logging.getLogger("amazon_payments")
 
+# Seconds before an access token's expiry from which it's treated as expired
+ACCESS_TOKEN_EXPIRY_MARGIN = 60
+
+# The most MWS calls placing an order makes, and the seconds added to the
+# time they can take, from which the default submission lock timeout is
+# worked out
+MAX_SUBMISSION_CALLS = 10
+SUBMISSION_LOCK_MARGIN = 30
+
+# The most order references a single IPN can have invalidated
+MAX_IPN_IDS = 10
+
 Country = get_model('address', 'country')
 ShippingAddress = get_model('order', 'ShippingAddress')
 Source = get_model('payment', 'Source')
-SourceType = get_model('payment', 'SourceType')
+PaymentEvent = get_model('order', 'PaymentEvent')
+PaymentEventQuantity = get_model('order', 'PaymentEventQuantity')
 
 Repository = get_class('shipping.repository', 'Repository')
 UnableToTakePayment = get_class('payment.exceptions', 'UnableToTakePayment')
@@ -50,13 +83,15 @@ class AmazonLoginRedirectView(generic.RedirectView):
         billing_agreement_id = self.request.GET.get('billing_agreement_id')
         access_token = self.request.GET.get('access_token')
         if billing_agreement_id:
-            try:
-                session = self.request.basket.amazonpaymentssession
-            except AmazonPaymentsSession.DoesNotExist:
+            storage = get_session_storage(self.request)
+            session = storage.get()
+            if session is None:
                 session = AmazonPaymentsSession(basket=self.request.basket)
             session.billing_agreement_id = billing_agreement_id
             session.access_token = access_token
-            session.save()
+            session.access_token_expires_at = self.get_access_token_expiry(
+                access_token)
+            storage.save(session)
         else:
             messages.error(self.request,
                            _("An error occurred during login. Please try again"
@@ -64,18 +99,43 @@ class AmazonLoginRedirectView(generic.RedirectView):
             return reverse('basket:summary')
         return self._redirect_url
 
+    def get_access_token_expiry(self, access_token):
+        """
+        Returns when the access token expires, going by the `expires_in`
+        parameter that Login with Amazon adds to the redirect URL.
+        """
+        if not access_token:
+            return None
+        try:
+            expires_in = int(self.request.GET["expires_in"])
+        except (KeyError, ValueError):
+            expires_in = getattr(
+                settings, "AMAZON_PAYMENTS_ACCESS_TOKEN_LIFETIME", 60 * 60)
+        # Treat the token as expired a little early, so that it doesn't
+        # expire in the middle of placing an order.
+        return timezone.now() + datetime.timedelta(
+            seconds=expires_in - ACCESS_TOKEN_EXPIRY_MARGIN)
+
 
 class AmazonCheckoutView(object):
 
+    transaction_log_policy = None
+    # Transactions logged while this is a list are kept here instead of
+    # being saved straight away. See save_pending_transactions.
+    _pending_transactions = None
+    # The data cached by get_shipping_cache during this request
+    _shipping_cache = None
+    _order_totals = None
+
     def init_amazon_payments(self):
         """
         Creates a `session` and `api` variables to be used for interacting
         with the Amazon Payments API. Returns True if successful, else
         returns False
         """
-        try:
-            self.session = self.request.basket.amazonpaymentssession
-        except (AmazonPaymentsSession.DoesNotExist, AttributeError):
+        self.session_storage = get_session_storage(self.request)
+        self.session = self.session_storage.get()
+        if self.session is None:
             return False
         logger.debug("Amazon Billing Agreement ID: %s" % (
             self.session.billing_agreement_id))
@@ -86,12 +146,74 @@ class AmazonCheckoutView(object):
             settings.AMAZON_PAYMENTS_API_ENDPOINT,
             settings.AMAZON_PAYMENTS_API_VERSION,
             settings.AMAZON_PAYMENTS_IS_LIVE,
+            timeout=getattr(settings, "AMAZON_PAYMENTS_API_TIMEOUT", 30),
+            rate_limiter=get_shared_rate_limiter(), priority=INTERACTIVE,
+            rate_limit_wait=getattr(
+                settings, "AMAZON_PAYMENTS_RATE_LIMIT_WAIT", 5),
+            status_cache=get_status_cache(),
         )
         return True
 
-    def save_to_db_callback(self, raw_request, raw_response):
-        return self.session.transactions.create(
-            request=raw_request, response=raw_response)
+    def get_transaction_log_policy(self):
+        if self.transaction_log_policy is None:
+            self.transaction_log_policy = TransactionLogPolicy.from_settings()
+        return self.transaction_log_policy
+
+    def save_to_db_callback(self, raw_request, raw_response, action=None,
+                            status_code=None, latency=None):
+        tx = self.build_transaction(raw_request, raw_response, action,
+                                    status_code, latency)
+        self.store_transaction(tx)
+        return tx
+
+    def build_transaction(self, raw_request, raw_response, action=None,
+                          status_code=None, latency=None):
+        """
+        Returns an unsaved AmazonPaymentsTransaction for an API call.
+        """
+        details = get_transaction_details(raw_request, raw_response, action)
+        level = self.get_transaction_log_policy().get_level(
+            details["action"], details["error_code"], status_code)
+        if level == TransactionLogPolicy.SUMMARY:
+            # Only the structured columns are saved for uninteresting calls
+            raw_request = raw_response = None
+        tx = AmazonPaymentsTransaction(
+            session=self.session, request=raw_request, response=raw_response,
+            status_code=status_code, latency=latency, **details)
+        return tx
+
+    def store_transaction(self, tx):
+        if self._pending_transactions is not None:
+            self._pending_transactions.append(tx)
+        else:
+            self.session_storage.add_transaction(self.session, tx)
+
+    def save_pending_transactions(self, auth_attempt=None):
+        """
+        Saves the transactions logged since _pending_transactions was set,
+        and the auth attempt that links to one of them (if any), in a
+        single atomic write. If the transaction log is routed to its own
+        database, the two writes are only atomic on each database.
+        """
+        pending, self._pending_transactions = self._pending_transactions, None
+        auth_tx = auth_attempt.transaction if auth_attempt else None
+        using = router.db_for_write(AmazonPaymentsTransaction)
+        # The transaction log may be routed to its own database.
+        with transaction.atomic(using=using), transaction.atomic(
+                using=router.db_for_write(AmazonPaymentsAuthAttempt)):
+            # The session may only have been stored outside the DB so far.
+            self.session_storage.persist(self.session)
+            for tx in pending or []:
+                tx.session = self.session
+            AmazonPaymentsTransaction.objects.using(using).bulk_create(
+                [tx for tx in pending or [] if tx is not auth_tx])
+            if auth_attempt:
+                if auth_tx:
+                    # Needs a primary key for the auth attempt to link to.
+                    auth_tx.save()
+                    auth_attempt.transaction = auth_tx
+                auth_attempt.session = self.session
+                auth_attempt.save()
 
     def get_amazon_payments_context_vars(self):
         """
@@ -106,26 +228,203 @@ class AmazonCheckoutView(object):
                 self.session.billing_agreement_id),
         }
 
-    def get_amazon_order_details(self, request, **kwargs):
+    def start_amazon_order_details(self, request, background=True,
+                                   **kwargs):
+        """
+        Starts the GetBillingAgreementDetails request in a background thread
+        (if background is True), so that the order can be prepared while
+        waiting for Amazon. Returns the pre-flight call to pass to
+        get_amazon_order_details.
         """
-        Preforms a GetBillingAgreementDetails request, and checks if
+        if (kwargs.get("validate_shipping_address", True) and
+                "valid_shipping_countries" not in kwargs):
+            kwargs["valid_shipping_countries"] = list(
+                Country.objects.filter(is_shipping_country=True)
+                .values_list("iso_3166_1_a2", flat=True))
+        # The thread only builds the transaction; it's saved by
+        # get_amazon_order_details in the request's thread.
+        transactions = []
+        kwargs["callback"] = lambda *args, **kw: transactions.append(
+            self.build_transaction(*args, **kw))
+        prefetched = self.pop_prefetched_order_details(request)
+        if prefetched is not None:
+            for raw_request, raw_response, kw in prefetched["transactions"]:
+                transactions.append(
+                    self.build_transaction(raw_request, raw_response, **kw))
+            if prefetched["response"] is not None:
+                kwargs["raw_response"] = prefetched["response"]
+                background = False
+        call = BackgroundCall(self.api.get_amazon_order_details, (
+            self.session.billing_agreement_id, self.session.access_token,
+            getattr(request.basket, "has_subscriptions", False)), kwargs,
+            background=background)
+        return call, transactions
+
+    # The key of the prefetch token in the user's Django session
+    prefetch_session_key = "amazon_payments_prefetch"
+
+    def get_prefetch_cache_key(self, token):
+        return "amazon_payments_prefetch:%s:%s" % (
+            self.session.billing_agreement_id, token)
+
+    def prefetch_amazon_order_details(self):
+        """
+        Starts fetching the billing agreement details in a background thread
+        and caches them for the next request, if AMAZON_PAYMENTS_PREFETCH is
+        True. Returns the BackgroundCall, or None. See
+        pop_prefetched_order_details.
+
+        The details are cached under a token that's kept in the user's
+        Django session, and removed when they're used. Details that arrive
+        once the order has been placed (or the page has been rendered
+        again) are never read.
+        """
+        if not getattr(settings, "AMAZON_PAYMENTS_PREFETCH", False):
+            return None
+        token = uuid.uuid4().hex
+        self.request.session[self.prefetch_session_key] = token
+        key = self.get_prefetch_cache_key(token)
+        api = self.api
+        args = (self.session.billing_agreement_id, self.session.access_token)
+
+        def prefetch():
+            data = {"response": None, "transactions": []}
+            try:
+                data["response"] = api.get_billing_agreement_details(
+                    *args, process=False,
+                    callback=lambda *call, **kw: data[
+                        "transactions"].append(call + (kw,)))
+            finally:
+                # Failed calls are still logged by the next request.
+                cache.set(key, data, getattr(
+                    settings, "AMAZON_PAYMENTS_PREFETCH_TIMEOUT", 120))
+
+        return BackgroundCall(prefetch)
+
+    def pop_prefetched_order_details(self, request):
+        """
+        Returns the details cached by prefetch_amazon_order_details (if
+        any), removing them from the cache. The response is discarded (and
+        only the transactions are returned) if the widgets reported changes
+        since the page was rendered.
+        """
+        if not getattr(settings, "AMAZON_PAYMENTS_PREFETCH", False):
+            return None
+        token = request.session.pop(self.prefetch_session_key, None)
+        if token is None:
+            return None
+        key = self.get_prefetch_cache_key(token)
+        data = cache.get(key)
+        if data is None:
+            return None
+        cache.delete(key)
+        if request.POST.get("amazon_widgets_changed"):
+            data["response"] = None
+        return data
+
+    def get_amazon_order_details(self, request, preflight=None, **kwargs):
+        """
+        Preforms a GetBillingAgreementDetails request (or waits for the
+        pre-flight one started by start_amazon_order_details), and checks if
         there the user has set a valid shipping address (if
         validate_shipping_address is True) and/or there is a valid
         payment method (if validate_payment_details is True).
         """
-        if kwargs.get("validate_shipping_address", True):
-            kwargs["valid_shipping_countries"] = Country.objects\
-                .filter(is_shipping_country=True)\
-                .values_list("iso_3166_1_a2", flat=True)
-        kwargs["callback"] = self.save_to_db_callback
-        success, result = self.api.get_amazon_order_details(
-            self.session.billing_agreement_id, self.session.access_token,
-            getattr(request.basket, "has_subscriptions", False), **kwargs)
+        if preflight is None:
+            preflight = self.start_amazon_order_details(
+                request, background=False, **kwargs)
+        call, transactions = preflight
+        try:
+            success, result = call.result()
+        finally:
+            for tx in transactions:
+                self.store_transaction(tx)
         if success:
             return result
         for error in result:
             messages.error(request, _(error))
 
+    def get_shipping_cache(self, basket, shipping_address=None):
+        """
+        Returns the cache key and the data (shipping method codes) cached
+        for the basket and shipping address. The key changes whenever the
+        basket's lines or any offers change.
+        """
+        key = get_shipping_cache_key(basket, self.request.user,
+                                     shipping_address)
+        if self._shipping_cache is None:
+            self._shipping_cache = {}
+        if key not in self._shipping_cache:
+            self._shipping_cache[key] = cache.get(key) or {}
+        return key, self._shipping_cache[key]
+
+    def set_shipping_cache(self, key, data):
+        cache.set(key, data, get_shipping_cache_timeout())
+
+    def find_shipping_methods(self, basket, codes):
+        """
+        Returns the shipping methods with the given codes, or None if any of
+        them can't be found.
+        """
+        repository = Repository()
+        methods = [repository.find_by_code(code, basket) for code in codes]
+        if None not in methods:
+            return methods
+
+    def get_cached_shipping_methods(self, basket, shipping_address=None):
+        key, data = self.get_shipping_cache(basket, shipping_address)
+        if "methods" in data:
+            methods = self.find_shipping_methods(basket, data["methods"])
+            if methods is not None:
+                return methods
+        methods = Repository().get_shipping_methods(
+            user=self.request.user, basket=basket,
+            shipping_addr=shipping_address, request=self.request)
+        data["methods"] = [method.code for method in methods]
+        self.set_shipping_cache(key, data)
+        return methods
+
+    def get_cached_default_shipping_method(self, basket,
+                                           shipping_address=None):
+        key, data = self.get_shipping_cache(basket, shipping_address)
+        if "default" in data:
+            methods = self.find_shipping_methods(basket, [data["default"]])
+            if methods is not None:
+                return methods[0]
+        method = Repository().get_default_shipping_method(
+            user=self.request.user, basket=basket,
+            shipping_addr=shipping_address, request=self.request)
+        data["default"] = method.code
+        self.set_shipping_cache(key, data)
+        return method
+
+    def get_shipping_method(self, basket, shipping_address=None, **kwargs):
+        code = self.checkout_session.shipping_method_code(basket)
+        for method in self.get_cached_shipping_methods(basket,
+                                                       shipping_address):
+            if method.code == code:
+                return method
+
+    def get_order_totals(self, basket, shipping_method, **kwargs):
+        if kwargs or shipping_method is None:
+            return super(AmazonCheckoutView, self).get_order_totals(
+                basket, shipping_method, **kwargs)
+        # Only kept for the request, as the totals depend on offers, vouchers
+        # and prices that the shipping cache isn't invalidated for, and the
+        # amount charged must be the current total. The charge is part of
+        # the key as it can depend on the shipping address.
+        key = (basket.id, shipping_method.code,
+               shipping_method.charge_excl_tax,
+               shipping_method.is_tax_known and
+               shipping_method.charge_incl_tax)
+        if self._order_totals is None:
+            self._order_totals = {}
+        if key not in self._order_totals:
+            self._order_totals[key] = super(
+                AmazonCheckoutView, self).get_order_totals(
+                    basket, shipping_method)
+        return self._order_totals[key]
+
     def check_user_email_is_captured(self, request):
         """
         Overrides Oscar's pre-condition to change URL to redirect
@@ -198,6 +497,12 @@ class AmazonShippingAddressView(AmazonCheckoutView, CheckoutSessionMixin,
                            _("Please click on the 'Pay with Amazon' button to "
                              "begin the Amazon checkout process."))
             return redirect('basket:summary')
+        if self.session.is_access_token_expired():
+            # Don't make MWS calls that are bound to fail.
+            messages.error(self.request,
+                           _("Your session has expired. Please sign in again "
+                             "by clicking on the 'Pay with Amazon' button."))
+            return redirect('basket:summary')
         return super(AmazonShippingAddressView, self).dispatch(
             *args, **kwargs)
 
@@ -296,6 +601,11 @@ class AmazonShippingMethodView(AmazonCheckoutView, ShippingMethodView):
         self.checkout_session.use_shipping_method(method_code)
         return self.get_success_response()
 
+    def get_available_shipping_methods(self):
+        return self.get_cached_shipping_methods(
+            self.request.basket,
+            self.get_shipping_address(self.request.basket))
+
     def get_success_response(self):
         return redirect(reverse('checkout:amazon-payments-payment-method'))
 
@@ -314,9 +624,59 @@ class BaseAmazonPaymentDetailsView(AmazonCheckoutView, PaymentDetailsView):
                            _("Please click on the 'Pay with Amazon' button to "
                              "begin the Amazon checkout process."))
             return redirect('basket:summary')
+        if self.session.is_access_token_expired():
+            # Don't make MWS calls that are bound to fail.
+            messages.error(self.request,
+                           _("Your session has expired. Please sign in again "
+                             "by clicking on the 'Pay with Amazon' button."))
+            return redirect('basket:summary')
         return super(BaseAmazonPaymentDetailsView, self).dispatch(
             *args, **kwargs)
 
+    def submit_once(self, handle_place_order, request):
+        """
+        Calls handle_place_order(request) while holding a lock on the
+        billing agreement, so that concurrent submissions of the same order
+        (e.g. double clicks or retries) don't all call Amazon. Submissions
+        that have to wait for the lock reuse the redirect of the one that
+        placed the order, if an order was placed.
+        """
+        key = "submission:%s:%s" % (self.session.billing_agreement_id,
+                                    request.basket.id)
+        result_key = "amazon_payments_%s" % key
+        lock = CacheLock(key, self.get_submission_lock_timeout())
+        if not lock.acquire(wait=getattr(
+                settings, "AMAZON_PAYMENTS_SUBMISSION_WAIT", 30)):
+            messages.error(request, _(
+                "Your order is still being processed. Please try again in a "
+                "moment."))
+            return redirect("basket:summary")
+        try:
+            url = cache.get(result_key)
+            if url:
+                return redirect(url)
+            response = handle_place_order(request)
+            if self.session.order_id and response.status_code == 302:
+                cache.set(result_key, response["Location"], 60)
+            return response
+        finally:
+            lock.release()
+
+    def get_submission_lock_timeout(self):
+        """
+        Returns how long the submission lock is held at most. By default,
+        that's long enough for every call made while placing the order to
+        wait for the rate limiter and then time out, so the lock can't
+        expire while a submission is still calling Amazon.
+        """
+        timeout = getattr(
+            settings, "AMAZON_PAYMENTS_SUBMISSION_LOCK_TIMEOUT", None)
+        if timeout is None:
+            timeout = MAX_SUBMISSION_CALLS * (
+                (self.api.timeout or 30) + (self.api.rate_limit_wait or 0)
+            ) + SUBMISSION_LOCK_MARGIN
+        return timeout
+
     def set_order_details(self, total, order_id=None):
         data = {
             "AmazonOrderReferenceId": self.session.order_reference_id,
@@ -351,27 +711,83 @@ class BaseAmazonPaymentDetailsView(AmazonCheckoutView, PaymentDetailsView):
                     self.session.billing_agreement_id)},
                 False, self.save_to_db_callback)
 
+    def set_order_reference_id(self, order_reference_id):
+        if not self.session_storage.transition(
+                self.session, AmazonPaymentsSession.ORDER_REFERENCE_CREATED,
+                order_reference_id=order_reference_id):
+            logger.warning("Amazon Payments session %s: order reference "
+                           "created in state %s" % (
+                               self.session.pk, self.session.state))
+            self.session.order_reference_id = order_reference_id
+            self.session_storage.save(self.session)
+
+    def get_authorization_state(self, auth_status, captured_amount):
+        """
+        Returns the session state matching an AuthorizationStatus, or None
+        if the authorization is still pending.
+        """
+        state = auth_status.State.text
+        if state == "Declined":
+            return AmazonPaymentsSession.DECLINED
+        elif state == "Closed":
+            if auth_status.ReasonCode.text == "MaxCapturesProcessed":
+                return AmazonPaymentsSession.CAPTURED
+            return AmazonPaymentsSession.CLOSED
+        elif state == "Open":
+            if captured_amount:
+                return AmazonPaymentsSession.CAPTURED
+            return AmazonPaymentsSession.AUTHORIZED
+
     def handle_payment(self, order_number, total, **kwargs):
-        self.set_order_details(total.incl_tax, order_number)
-        auth_attempt = self.session.auth_attempts.create()
-        auth_ref = "%s-%s" % (auth_attempt.pk,
-                              auth_attempt.created_at.strftime("%s"))
+        # Guards against authorizing the same order reference twice, e.g.
+        # when the order is submitted twice.
+        if not self.session_storage.transition(
+                self.session, AmazonPaymentsSession.AUTHORIZING):
+            raise PaymentError("Cannot authorize payment in state %s" % (
+                self.session.state))
+        # Nothing is written to the DB until all the MWS calls are done.
+        self._pending_transactions = []
+        auth_attempt = None
         try:
-            authorization_id, tx = self.api.authorize(
-                self.session.order_reference_id, auth_ref, total.incl_tax,
-                settings.AMAZON_PAYMENTS_CURRENCY,
-                callback=self.save_to_db_callback)
-        except self.api.exception_class, e:
-            raise PaymentError(*e.args)
-        auth_attempt.authorization_id = authorization_id
-        auth_attempt.transaction = tx
-        auth_attempt.save()
-        try:
-            auth_status, captured_amount = self.api.get_authorization_status(
-                auth_attempt.authorization_id,
-                callback=self.save_to_db_callback)
-        except self.api.exception_class, e:
-            raise PaymentError(*e.args)
+            self.set_order_details(total.incl_tax, order_number)
+            # The authorization reference is generated locally, so the auth
+            # attempt doesn't need to be saved before calling Amazon.
+            auth_attempt = AmazonPaymentsAuthAttempt(
+                session=self.session, reference_id=generate_ulid())
+            try:
+                authorization_id, tx = self.api.authorize(
+                    self.session.order_reference_id, auth_attempt.reference_id,
+                    total.incl_tax, settings.AMAZON_PAYMENTS_CURRENCY,
+                    callback=self.save_to_db_callback)
+            except self.api.exception_class, e:
+                if e.args[0] != "OutcomeUnknown":
+                    raise PaymentError(*e.args)
+                authorization_id, tx = self.find_authorization(
+                    auth_attempt), None
+            auth_attempt.authorization_id = authorization_id
+            auth_attempt.transaction = tx
+            try:
+                auth_status, captured_amount = \
+                    self.api.get_authorization_status(
+                        auth_attempt.authorization_id,
+                        callback=self.save_to_db_callback)
+            except self.api.exception_class, e:
+                raise PaymentError(*e.args)
+        except (PaymentError, self.api.exception_class), e:
+            # If no authorization was made, the order can be submitted
+            # again. If that's not known, the session is left authorizing.
+            if ((auth_attempt is None or
+                 auth_attempt.authorization_id is None) and
+                    e.args[:1] != ("OutcomeUnknown",)):
+                self.session_storage.transition(
+                    self.session,
+                    AmazonPaymentsSession.ORDER_REFERENCE_CREATED)
+            raise
+        finally:
+            self.save_pending_transactions(auth_attempt)
+        state = self.get_authorization_state(auth_status, captured_amount)
+        if state:
+            self.session_storage.transition(self.session, state)
         if auth_status.State.text == "Declined":
             if auth_status.ReasonCode.text in ["InvalidPaymentMethod",
                                                "AmazonRejected"]:
@@ -385,10 +801,8 @@ class BaseAmazonPaymentDetailsView(AmazonCheckoutView, PaymentDetailsView):
               auth_status.ReasonCode.text != "MaxCapturesProcessed"):
             raise PaymentError(auth_status.State.text,
                                auth_status.ReasonCode.text)
-        source_type = SourceType.objects.get_or_create(
-            name="Amazon Payments")[0]
         source = Source(
-            source_type=source_type,
+            source_type=get_source_type(),
             currency="USD",
             amount_allocated=captured_amount,
             amount_debited=captured_amount,
@@ -397,6 +811,62 @@ class BaseAmazonPaymentDetailsView(AmazonCheckoutView, PaymentDetailsView):
         self.add_payment_event("Purchase", total.incl_tax,
                                reference=auth_attempt.authorization_id)
 
+    def find_authorization(self, auth_attempt):
+        """
+        Checks whether an Authorize call that timed out went through, and
+        returns the ID of its authorization. Raises PaymentError if it
+        didn't, or (with the code "OutcomeUnknown") if Amazon can't be
+        asked.
+        """
+        try:
+            authorization_id = self.api.find_authorization(
+                self.session.order_reference_id, auth_attempt.reference_id,
+                callback=self.save_to_db_callback)
+        except self.api.exception_class, e:
+            raise PaymentError("OutcomeUnknown", *e.args[1:])
+        if authorization_id is None:
+            raise PaymentError("RequestFailed",
+                               "The authorization wasn't made")
+        return authorization_id
+
+    def add_payment_event(self, event_type_name, amount, reference=''):
+        # As Oscar's, but without looking up the event type every time
+        if self._payment_events is None:
+            self._payment_events = []
+        self._payment_events.append(PaymentEvent(
+            event_type=get_payment_event_type(event_type_name),
+            amount=amount, reference=reference))
+
+    def place_order(self, *args, **kwargs):
+        # The order, payment sources and events are written together.
+        with transaction.atomic():
+            return super(BaseAmazonPaymentDetailsView, self).place_order(
+                *args, **kwargs)
+
+    def save_payment_events(self, order):
+        if not self._payment_events:
+            return
+        for event in self._payment_events:
+            event.order = order
+            event.save()
+        # As in Oscar, all lines are assumed to be involved in the initial
+        # payment event.
+        PaymentEventQuantity.objects.bulk_create([
+            PaymentEventQuantity(event=event, line=line,
+                                 quantity=line.quantity)
+            for line in order.lines.all()])
+
+    def save_payment_sources(self, order):
+        if not self._payment_sources:
+            return
+        if any(source.deferred_txns for source in self._payment_sources):
+            # Only saving them one by one creates their transactions
+            return super(BaseAmazonPaymentDetailsView, self)\
+                .save_payment_sources(order)
+        for source in self._payment_sources:
+            source.order = order
+        Source.objects.bulk_create(self._payment_sources)
+
     def handle_successful_order(self, order):
         response = super(BaseAmazonPaymentDetailsView, self)\
             .handle_successful_order(order)
@@ -410,7 +880,7 @@ class BaseAmazonPaymentDetailsView(AmazonCheckoutView, PaymentDetailsView):
                     "Unable to set up automatic payments for order %s: %s" % (
                         order, e))
         self.session.order = order
-        self.session.save()
+        self.session_storage.save(self.session)
         return response
 
 
@@ -425,6 +895,14 @@ class AmazonPaymentDetailsView(BaseAmazonPaymentDetailsView):
         kwargs.update(self.get_amazon_payments_context_vars())
         return kwargs
 
+    def get(self, request, *args, **kwargs):
+        if self.preview:
+            # The widgets are read-only on the preview page, so the details
+            # are unlikely to change before the order is placed.
+            self.prefetch_amazon_order_details()
+        return super(AmazonPaymentDetailsView, self).get(
+            request, *args, **kwargs)
+
     def post(self, request, *args, **kwargs):
         if request.POST.get('action', '') == 'place_order':
             return self.handle_place_order_submission(request)
@@ -452,16 +930,21 @@ class AmazonPaymentDetailsView(BaseAmazonPaymentDetailsView):
                     "An error occurred when processing your payment. "
                     "Please try again later."))
                 return redirect("checkout:amazon-payments-payment-details")
-            self.session.order_reference_id = order_reference_id
-            self.session.save()
+            self.set_order_reference_id(order_reference_id)
         return redirect("checkout:amazon-payments-preview")
 
     def handle_place_order_submission(self, request):
-        amazon_order_details = self.get_amazon_order_details(self.request)
+        return self.submit_once(self.handle_place_order, request)
+
+    def handle_place_order(self, request):
+        # Build the submission while Amazon checks the order details.
+        preflight = self.start_amazon_order_details(request)
+        submission = self.build_submission()
+        amazon_order_details = self.get_amazon_order_details(
+            request, preflight)
         if not amazon_order_details:
             return redirect("checkout:amazon-payments-preview")
-        return super(AmazonPaymentDetailsView, self)\
-            .handle_place_order_submission(request)
+        return self.submit(**submission)
 
 
 # VIEWS FOR ONE-STEP CHECKOUT
@@ -477,9 +960,7 @@ class AmazonOneStepPaymentDetailsView(BaseAmazonPaymentDetailsView):
         'check_basket_is_valid',)
 
     def get_default_shipping_method(self, basket):
-        return Repository().get_default_shipping_method(
-            user=self.request.user, basket=self.request.basket,
-            request=self.request)
+        return self.get_cached_default_shipping_method(basket)
 
     def get(self, request, *args, **kwargs):
         if request.basket.is_empty:
@@ -498,63 +979,72 @@ class AmazonOneStepPaymentDetailsView(BaseAmazonPaymentDetailsView):
                     callback=self.save_to_db_callback)
             except self.api.exception_class, e:
                 raise PaymentError(*e.args)
-            self.session.order_reference_id = order_reference_id
-            self.session.save()
+            self.set_order_reference_id(order_reference_id)
         # We've already checked for valid shipping address and
         # payment details in the post() method
         super(AmazonOneStepPaymentDetailsView, self).handle_payment(
             order_number, total, **kwargs)
 
+    def handle_place_order(self, request):
+        countries = dict(
+            (country.iso_3166_1_a2, country) for country in
+            Country.objects.filter(is_shipping_country=True))
+        # Work out the shipping method and totals while Amazon checks the
+        # order details.
+        preflight = self.start_amazon_order_details(
+            request, valid_shipping_countries=countries.keys())
+        shipping_method = self.get_default_shipping_method(
+            self.request.basket)
+        order_total = self.get_order_totals(
+            self.request.basket,
+            shipping_method=shipping_method)
+        try:
+            amazon_order_details = self.get_amazon_order_details(
+                request, preflight)
+        except AmazonPaymentsAPIError, e:
+            logger.debug(unicode(e))
+            if e.args[0] == "InvalidAddressConsentToken":
+                msg = _("Your session has expired. Please sign in again by"
+                        " clicking on the 'Pay with Amazon' button.")
+            else:
+                msg = _("Sorry, there's a problem processing your order "
+                        "via Amazon. Please try again later.")
+            messages.error(request, msg)
+            return redirect("basket:summary")
+        if not amazon_order_details:
+            return redirect(request.path)
+        # Get shipping address
+        amazon_shipping_address = amazon_order_details.Destination\
+            .PhysicalDestination
+        shipping_address = ShippingAddress(
+            first_name=amazon_shipping_address.Name.text,
+            line1=amazon_shipping_address.AddressLine1.text,
+            line4=amazon_shipping_address.City.text,
+            state=amazon_shipping_address.StateOrRegion.text,
+            postcode=amazon_shipping_address.PostalCode.text,
+            country=countries[amazon_shipping_address.CountryCode.text],
+        )
+        if amazon_shipping_address.AddressLine2:
+            shipping_address.line2 = amazon_shipping_address.AddressLine2\
+                .text
+        if amazon_shipping_address.Phone:
+            shipping_address.phone_number = amazon_shipping_address\
+                .Phone.text
+        submission = self.build_submission(
+            user=request.user, shipping_method=shipping_method,
+            order_total=order_total, shipping_address=shipping_address)
+        if (not request.user.is_authenticated() and
+                not self.checkout_session.get_guest_email()):
+            submission['order_kwargs']['guest_email'] = (
+                amazon_order_details.Buyer.Email.text)
+        result = self.submit(**submission)
+        return result
+
     def post(self, request, *args, **kwargs):
         if request.basket.is_empty:
             msg = _("You need to add some items to your basket to check out.")
         elif 'place_order' in request.POST:
-            try:
-                amazon_order_details = self.get_amazon_order_details(request)
-            except AmazonPaymentsAPIError, e:
-                logger.debug(unicode(e))
-                if e.args[0] == "InvalidAddressConsentToken":
-                    msg = _("Your session has expired. Please sign in again by"
-                            " clicking on the 'Pay with Amazon' button.")
-                else:
-                    msg = _("Sorry, there's a problem processing your order "
-                            "via Amazon. Please try again later.")
-                messages.error(request, msg)
-                return redirect("basket:summary")
-            if not amazon_order_details:
-                return redirect(request.path)
-            # Get shipping address
-            amazon_shipping_address = amazon_order_details.Destination\
-                .PhysicalDestination
-            shipping_address = ShippingAddress(
-                first_name=amazon_shipping_address.Name.text,
-                line1=amazon_shipping_address.AddressLine1.text,
-                line4=amazon_shipping_address.City.text,
-                state=amazon_shipping_address.StateOrRegion.text,
-                postcode=amazon_shipping_address.PostalCode.text,
-                country=Country.objects.get(
-                    iso_3166_1_a2=amazon_shipping_address.CountryCode.text),
-            )
-            if amazon_shipping_address.AddressLine2:
-                shipping_address.line2 = amazon_shipping_address.AddressLine2\
-                    .text
-            if amazon_shipping_address.Phone:
-                shipping_address.phone_number = amazon_shipping_address\
-                    .Phone.text
-            shipping_method = self.get_default_shipping_method(
-                self.request.basket)
-            order_total = self.get_order_totals(
-                self.request.basket,
-                shipping_method=shipping_method)
-            submission = self.build_submission(
-                user=request.user, shipping_method=shipping_method,
-                order_total=order_total, shipping_address=shipping_address)
-            if (not request.user.is_authenticated() and
-                    not self.checkout_session.get_guest_email()):
-                submission['order_kwargs']['guest_email'] = (
-                    amazon_order_details.Buyer.Email.text)
-            result = self.submit(**submission)
-            return result
+            return self.submit_once(self.handle_place_order, request)
 
         amazon_error_code = request.POST.get("amazon_error_code")
         amazon_error_message = request.POST.get("amazon_error_message")
@@ -586,3 +1076,98 @@ class AmazonOneStepPaymentDetailsView(BaseAmazonPaymentDetailsView):
         self.preview = False
         ctx = self.get_context_data(**kwargs)
         return self.render_to_response(ctx)
+
+
+# INSTANT PAYMENT NOTIFICATIONS
+class AmazonPaymentsIPNView(generic.View):
+    """
+    Receives Amazon's instant payment notifications (IPNs), which are sent
+    through Amazon SNS when the state of an order reference,
+    authorization, capture or refund changes, and drops the cached
+    statuses of the order references they're about.
+
+    The SNS signatures aren't verified, so notifications are only accepted
+    from the topic in the AMAZON_PAYMENTS_IPN_TOPIC_ARN setting and, if the
+    AMAZON_PAYMENTS_IPN_SECRET setting is set, with that secret in the
+    "secret" query parameter of the URL. Nothing is accepted if neither is
+    set. Only the ID of the object a notification is about is used, and at
+    most MAX_IPN_IDS order references are invalidated per notification.
+    """
+    http_method_names = ["post"]
+    # The element holding the ID of the object each type of notification is
+    # about
+    id_fields = {
+        "OrderReferenceNotification": "AmazonOrderReferenceId",
+        "PaymentAuthorize": "AmazonAuthorizationId",
+        "PaymentCapture": "AmazonCaptureId",
+        "PaymentRefund": "AmazonRefundId",
+    }
+
+    def is_authorized(self, request, notification):
+        topic_arn = getattr(settings, "AMAZON_PAYMENTS_IPN_TOPIC_ARN", None)
+        secret = getattr(settings, "AMAZON_PAYMENTS_IPN_SECRET", None)
+        if not (topic_arn or secret):
+            logger.error("IPN rejected: neither "
+                         "AMAZON_PAYMENTS_IPN_TOPIC_ARN nor "
+                         "AMAZON_PAYMENTS_IPN_SECRET is set")
+            return False
+        if topic_arn and notification.get("TopicArn") != topic_arn:
+            return False
+        if secret and not constant_time_compare(
+                request.GET.get("secret", ""), secret):
+            return False
+        return True
+
+    def get_amazon_ids(self, message):
+        field = self.id_fields.get(message.get("NotificationType"))
+        if field is None:
+            return []
+        data = bs4.BeautifulSoup(message.get("NotificationData") or "",
+                                 "xml")
+        return [tag.text.strip() for tag in data.find_all(field)]
+
+    def post(self, request, *args, **kwargs):
+        try:
+            notification = json.loads(request.body)
+            if not isinstance(notification, dict):
+                raise ValueError("Not a JSON object")
+        except ValueError, e:
+            logger.warning("Invalid IPN: %s" % e)
+            return http.HttpResponseBadRequest()
+        if not self.is_authorized(request, notification):
+            logger.warning("IPN from unknown sender rejected (topic %s)" % (
+                notification.get("TopicArn")))
+            return http.HttpResponseForbidden()
+        try:
+            if notification.get("Type") == "SubscriptionConfirmation":
+                logger.warning("Visit %s to confirm the IPN subscription" % (
+                    notification.get("SubscribeURL")))
+                return http.HttpResponse()
+            message = json.loads(notification.get("Message") or "{}")
+            amazon_ids = self.get_amazon_ids(message)
+        except (ValueError, AttributeError), e:
+            logger.warning("Invalid IPN: %s" % e)
+            return http.HttpResponseBadRequest()
+        order_reference_ids = []
+        for amazon_id in amazon_ids:
+            order_reference_id = get_order_reference_id(amazon_id) or amazon_id
+            if order_reference_id not in order_reference_ids:
+                order_reference_ids.append(order_reference_id)
+        if len(order_reference_ids) > MAX_IPN_IDS:
+            logger.warning("IPN for %s order references, only invalidating "
+                           "the first %s" % (len(order_reference_ids),
+                                             MAX_IPN_IDS))
+            order_reference_ids = order_reference_ids[:MAX_IPN_IDS]
+        api = AmazonPaymentsAPI(
+            settings.AMAZON_PAYMENTS_ACCESS_KEY,
+            settings.AMAZON_PAYMENTS_SECRET_KEY,
+            settings.AMAZON_PAYMENTS_SELLER_ID,
+            settings.AMAZON_PAYMENTS_API_ENDPOINT,
+            settings.AMAZON_PAYMENTS_API_VERSION,
+            settings.AMAZON_PAYMENTS_IS_LIVE,
+            status_cache=get_status_cache(),
+        )
+        for order_reference_id in order_reference_ids:
+            logger.info("IPN received for %s" % order_reference_id)
+            api.invalidate_status(order_reference_id)
+        return http.HttpResponse()
@@ -252,6 +252,30 @@ RESPONSES = {
       </ResponseMetadata>
     </GetAuthorizationDetailsResponse>
     """,
+    "order_reference_details": """
+    <GetOrderReferenceDetailsResponse xmlns="http://mws.amazonservices.com/schema/OffAmazonPayments/2013-01-01">
+      <GetOrderReferenceDetailsResult>
+        <OrderReferenceDetails>
+          <AmazonOrderReferenceId>S01-6576755-3809974</AmazonOrderReferenceId>
+          <OrderReferenceStatus>
+            <LastUpdateTimestamp>2015-03-20T14:43:26.949Z</LastUpdateTimestamp>
+            <State>Open</State>
+          </OrderReferenceStatus>
+          <OrderTotal>
+            <Amount>9.99</Amount>
+            <CurrencyCode>USD</CurrencyCode>
+          </OrderTotal>
+          <IdList>
+            <member>S01-6576755-3809974-A067494</member>
+          </IdList>
+          <CreationTimestamp>2015-03-20T14:43:20.010Z</CreationTimestamp>
+        </OrderReferenceDetails>
+      </GetOrderReferenceDetailsResult>
+      <ResponseMetadata>
+        <RequestId>5f20169b-7ab2-11df-bcef-d35615e2b044</RequestId>
+      </ResponseMetadata>
+    </GetOrderReferenceDetailsResponse>
+    """,
     "confirm_billing_agreement": """
     <ConfirmBillingAgreementResponse xmlns="http://mws.amazonservices.com/schema/OffAmazonPayments/2013-01-01">
       <ConfirmBillingAgreementResult/>
@@ -273,5 +297,136 @@ RESPONSES = {
         <RequestId>49fc9ede-4c49-4883-bba1-953b699ca70a</RequestId>
       </ResponseMetadata>
     </ValidateBillingAgreementResponse>
+    """,
+    "authorize_on_billing_agreement": """
+    <AuthorizeOnBillingAgreementResponse xmlns="http://mws.amazonservices.com/schema/OffAmazonPayments/2013-01-01">
+      <AuthorizeOnBillingAgreementResult>
+        <AuthorizationDetails>
+          <AuthorizationStatus>
+            <LastUpdateTimestamp>2015-04-20T14:43:26.949Z</LastUpdateTimestamp>
+            <State>Closed</State>
+            <ReasonCode>MaxCapturesProcessed</ReasonCode>
+          </AuthorizationStatus>
+          <ExpirationTimestamp>2015-05-20T14:43:26.949Z</ExpirationTimestamp>
+          <AuthorizationAmount>
+            <Amount>9.99</Amount>
+            <CurrencyCode>USD</CurrencyCode>
+          </AuthorizationAmount>
+          <CapturedAmount>
+            <Amount>9.99</Amount>
+            <CurrencyCode>USD</CurrencyCode>
+          </CapturedAmount>
+          <AmazonAuthorizationId>S01-4517324-8912350-A038173</AmazonAuthorizationId>
+          <CaptureNow>true</CaptureNow>
+          <AuthorizationReferenceId>r2c1f0d5e9a7b3c4d6e8f0a1b2c3d4e5</AuthorizationReferenceId>
+          <CreationTimestamp>2015-04-20T14:43:26.949Z</CreationTimestamp>
+        </AuthorizationDetails>
+        <AmazonOrderReferenceId>S01-4517324-8912350</AmazonOrderReferenceId>
+      </AuthorizeOnBillingAgreementResult>
+      <ResponseMetadata>
+        <RequestId>5f20169b-7ab2-11df-bcef-d35615e2b044</RequestId>
+      </ResponseMetadata>
+    </AuthorizeOnBillingAgreementResponse>
+    """,
+    "authorize_on_billing_agreement_declined": """
+    <AuthorizeOnBillingAgreementResponse xmlns="http://mws.amazonservices.com/schema/OffAmazonPayments/2013-01-01">
+      <AuthorizeOnBillingAgreementResult>
+        <AuthorizationDetails>
+          <AuthorizationStatus>
+            <LastUpdateTimestamp>2015-04-20T14:43:26.949Z</LastUpdateTimestamp>
+            <State>Declined</State>
+            <ReasonCode>InvalidPaymentMethod</ReasonCode>
+          </AuthorizationStatus>
+          <AuthorizationAmount>
+            <Amount>9.99</Amount>
+            <CurrencyCode>USD</CurrencyCode>
+          </AuthorizationAmount>
+          <AmazonAuthorizationId>S01-4517324-8912351-A038174</AmazonAuthorizationId>
+          <CaptureNow>true</CaptureNow>
+          <CreationTimestamp>2015-04-20T14:43:26.949Z</CreationTimestamp>
+        </AuthorizationDetails>
+        <AmazonOrderReferenceId>S01-4517324-8912351</AmazonOrderReferenceId>
+      </AuthorizeOnBillingAgreementResult>
+      <ResponseMetadata>
+        <RequestId>6a30179c-7ab2-11df-bcef-d35615e2b045</RequestId>
+      </ResponseMetadata>
+    </AuthorizeOnBillingAgreementResponse>
+    """,
+    "capture": """
+    <CaptureResponse xmlns="http://mws.amazonservices.com/schema/OffAmazonPayments/2013-01-01">
+      <CaptureResult>
+        <CaptureDetails>
+          <AmazonCaptureId>S01-6576755-3809974-C067494</AmazonCaptureId>
+          <CaptureReferenceId>c9d1f0d5e9a7b3c4d6e8f0a1b2c3d4e5</CaptureReferenceId>
+          <CaptureAmount>
+            <Amount>9.99</Amount>
+            <CurrencyCode>USD</CurrencyCode>
+          </CaptureAmount>
+          <RefundedAmount>
+            <Amount>0</Amount>
+            <CurrencyCode>USD</CurrencyCode>
+          </RefundedAmount>
+          <CaptureStatus>
+            <State>Completed</State>
+            <LastUpdateTimestamp>2015-03-21T10:00:00.000Z</LastUpdateTimestamp>
+          </CaptureStatus>
+          <CreationTimestamp>2015-03-21T10:00:00.000Z</CreationTimestamp>
+        </CaptureDetails>
+      </CaptureResult>
+      <ResponseMetadata>
+        <RequestId>8c5029be-7ab2-11df-bcef-d35615e2b047</RequestId>
+      </ResponseMetadata>
+    </CaptureResponse>
+    """,
+    "refund": """
+    <RefundResponse xmlns="http://mws.amazonservices.com/schema/OffAmazonPayments/2013-01-01">
+      <RefundResult>
+        <RefundDetails>
+          <AmazonRefundId>S01-6576755-3809974-R067494</AmazonRefundId>
+          <RefundReferenceId>r9d1f0d5e9a7b3c4d6e8f0a1b2c3d4e5</RefundReferenceId>
+          <RefundType>SellerInitiated</RefundType>
+          <RefundAmount>
+            <Amount>2.50</Amount>
+            <CurrencyCode>USD</CurrencyCode>
+          </RefundAmount>
+          <RefundStatus>
+            <State>Pending</State>
+            <LastUpdateTimestamp>2015-03-22T10:00:00.000Z</LastUpdateTimestamp>
+          </RefundStatus>
+          <CreationTimestamp>2015-03-22T10:00:00.000Z</CreationTimestamp>
+        </RefundDetails>
+      </RefundResult>
+      <ResponseMetadata>
+        <RequestId>9d6130cf-7ab2-11df-bcef-d35615e2b048</RequestId>
+      </ResponseMetadata>
+    </RefundResponse>
+    """,
+    "close_order_reference": """
+    <CloseOrderReferenceResponse xmlns="http://mws.amazonservices.com/schema/OffAmazonPayments/2013-01-01">
+      <CloseOrderReferenceResult/>
+      <ResponseMetadata>
+        <RequestId>ae7241d0-7ab2-11df-bcef-d35615e2b049</RequestId>
+      </ResponseMetadata>
+    </CloseOrderReferenceResponse>
+    """,
+    "throttled": """
+    <ErrorResponse xmlns="http://mws.amazonservices.com/schema/OffAmazonPayments/2013-01-01">
+      <Error>
+        <Type>Sender</Type>
+        <Code>RequestThrottled</Code>
+        <Message>Request is throttled.</Message>
+      </Error>
+      <RequestID>7b4018ad-7ab2-11df-bcef-d35615e2b046</RequestID>
+    </ErrorResponse>
+    """,
+    "error": """
+    <ErrorResponse xmlns="http://mws.amazonservices.com/schema/OffAmazonPayments/2013-01-01">
+      <Error>
+        <Type>Sender</Type>
+        <Code>InvalidAddressConsentToken</Code>
+        <Message>The Address Consent Token you submitted is not valid.</Message>
+      </Error>
+      <RequestID>c3ce3b9a-6ae6-4cb6-8cc6-3ffc1b1a6ea7</RequestID>
+    </ErrorResponse>
     """
 }
@@ -1,17 +1,71 @@
+import datetime
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
 from decimal import Decimal
+from StringIO import StringIO
 
+import requests
 from mock import patch, Mock
 from bs4 import BeautifulSoup
-from oscar.test.factories import create_product
+from oscar.core.loading import get_model
+from oscar.test.factories import create_order, create_product
 from oscar.apps.order.models import Order
 from oscar.apps.address.models import Country
+from oscar.apps.partner.models import StockRecord
+from oscar.apps.partner.strategy import Selector
+from oscar.apps.payment.models import Source, SourceType
+from oscar.apps.shipping.repository import Repository
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.signals import request_started
 from django.core.urlresolvers import reverse
+from django.db import DatabaseError, IntegrityError
+from django.db.models import F, ProtectedError
+from django.db.models.deletion import Collector
+from django.template import Context, Template
 from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
 from django.conf import settings
+from django.utils import timezone
 
-from amazon_payments import AmazonPaymentsAPI
+from amazon_payments import AmazonPaymentsAPI, AmazonPaymentsAPIError, views
+from amazon_payments.api import get_transaction_details
+from amazon_payments.caching import StatusCache
+from amazon_payments.lazy import LazyModule
+from amazon_payments.locks import CacheLock, SharedRateLimiter
+from amazon_payments.logging_policy import TransactionLogPolicy
+from amazon_payments.payment import (
+    get_source_type, reset_payment_types, warm_payment_types)
+from amazon_payments.receivers import warm_payment_types_on_first_request
+from amazon_payments.renewals import RenewalProcessor
+from amazon_payments.routers import AmazonPaymentsRouter
+from amazon_payments.settlements import SettlementImporter
+from amazon_payments.shipping import (
+    bump_offers_version, get_shipping_cache_key)
+from amazon_payments.storage import (
+    CacheSessionStorage, SessionSessionStorage)
+from amazon_payments.throttling import (
+    BULK, INTERACTIVE, ConcurrencyController, RateLimiter)
+from amazon_payments.utils import BackgroundCall, generate_ulid
+from amazon_payments.models import (
+    AmazonPaymentsSession, AmazonPaymentsTransaction,
+    AmazonPaymentsAuthAttempt, AmazonPaymentsRenewal,
+    AmazonPaymentsShardLease, AmazonPaymentsCheckpoint,
+    AmazonPaymentsSettlement, get_shard_bucket)
 from api_responses import RESPONSES
 
+Basket = get_model("basket", "Basket")
+
 
 class APITestCase(TestCase):
 
@@ -20,6 +74,7 @@ class APITestCase(TestCase):
 
     def create_mock_response(self, body, status_code=200):
         response = Mock()
+        response.url = settings.AMAZON_PAYMENTS_API_ENDPOINT
         response.content = body
         response.status_code = status_code
         return response
@@ -45,6 +100,96 @@ class SaveToDBTestCase(APITestCase):
             self.assertEqual(tx, "saved")
             self.assertEqual(len(self.db_callback_list), 1)
 
+    def test_callback_with_call_details(self):
+        calls = []
+
+        def callback(raw_request, raw_response, action=None, latency=None):
+            calls.append((action, latency))
+
+        with patch('requests.post') as post:
+            post.return_value = self.create_mock_response("xml response")
+            self.api.do_request("GetOrderReferenceDetails", {}, False,
+                                callback=callback)
+        self.assertEqual(calls[0][0], "GetOrderReferenceDetails")
+        self.assertIsNotNone(calls[0][1])
+
+    def test_request_timeout(self):
+        api = AmazonPaymentsAPI("access_key", "secret_key", "seller_id",
+                                timeout=5)
+        with patch('requests.post') as post:
+            post.side_effect = requests.Timeout("Read timed out.")
+            with self.assertRaises(AmazonPaymentsAPIError) as cm:
+                api.do_request("GetOrderReferenceDetails", {}, False,
+                               callback=self.save_to_db_callback)
+            assert post.call_args[1]["timeout"] == 5
+        assert cm.exception.args[0] == "RequestFailed"
+        assert self.db_callback_list == []
+
+    def test_money_moving_request_timeout(self):
+        with patch('requests.post') as post:
+            post.side_effect = requests.ReadTimeout("Read timed out.")
+            with self.assertRaises(AmazonPaymentsAPIError) as cm:
+                self.api.authorize("S01-6576755-3809974", "ref", "9.99",
+                                   "USD")
+        assert cm.exception.args[0] == "OutcomeUnknown"
+        with patch('requests.post') as post:
+            post.side_effect = requests.ConnectTimeout("Connect timed out.")
+            with self.assertRaises(AmazonPaymentsAPIError) as cm:
+                self.api.authorize("S01-6576755-3809974", "ref", "9.99",
+                                   "USD")
+        assert cm.exception.args[0] == "RequestFailed"
+
+    def test_find_authorization(self):
+        def side_effect(*args, **kwargs):
+            if kwargs["params"]["Action"] == "GetOrderReferenceDetails":
+                return self.create_mock_response(
+                    RESPONSES["order_reference_details"])
+            return self.create_mock_response(
+                RESPONSES["authorization_details"])
+
+        with patch('requests.post') as post:
+            post.side_effect = side_effect
+            assert self.api.find_authorization(
+                "S01-6576755-3809974", "7-1426862604") == (
+                    "S01-6576755-3809974-A067494")
+            assert self.api.find_authorization(
+                "S01-6576755-3809974", "another-ref") is None
+
+
+class TransactionDetailsTestCase(APITestCase):
+    """ Tests for extracting structured columns from transactions. """
+
+    def test_authorize_details(self):
+        details = get_transaction_details(
+            "https://mws.amazonservices.com/?Action=Authorize&"
+            "AmazonOrderReferenceId=S01-6576755-3809974",
+            RESPONSES["authorize"])
+        assert details["action"] == "Authorize"
+        assert details["error_code"] is None
+        assert details["order_reference_id"] == "S01-6576755-3809974"
+        assert details["authorization_id"] == "S01-6576755-3809974-A067494"
+        # Only listed in IdList, as it was captured straight away
+        assert details["capture_id"] == "S01-6576755-3809974-C067494"
+
+    def test_error_details(self):
+        details = get_transaction_details(
+            "", RESPONSES["error"], action="GetBillingAgreementDetails")
+        assert details["action"] == "GetBillingAgreementDetails"
+        assert details["error_code"] == "InvalidAddressConsentToken"
+        assert details["request_id"] == "c3ce3b9a-6ae6-4cb6-8cc6-3ffc1b1a6ea7"
+
+    def test_backfill_command(self):
+        session = AmazonPaymentsSession.objects.create(
+            billing_agreement_id="C01-9258635-6970398")
+        tx = session.transactions.create(
+            request=("https://mws.amazonservices.com/?Action=Authorize&"
+                     "AmazonOrderReferenceId=S01-6576755-3809974"),
+            response=RESPONSES["authorize"])
+        call_command("amazon_payments_backfill_transactions", batch_size=1)
+        tx = AmazonPaymentsTransaction.objects.get(pk=tx.pk)
+        assert tx.action == "Authorize"
+        assert tx.authorization_id == "S01-6576755-3809974-A067494"
+
 
 class GetAgreementDetailsTestCase(APITestCase):
     """ Tests for the get_amazon_order_details method. """
@@ -132,6 +277,1090 @@ class PaymentAuthorizationTestCase(APITestCase):
             self.assertEqual(result, (auth_status, Decimal("9.99")))
 
 
+class TransactionLogPolicyTestCase(TestCase):
+
+    def setUp(self):
+        self.policy = TransactionLogPolicy(sample_rate=0)
+
+    def test_errors_saved_in_full(self):
+        assert self.policy.get_level(
+            "GetAuthorizationDetails", error_code="InternalServerError"
+        ) == TransactionLogPolicy.FULL
+        assert self.policy.get_level(
+            "GetAuthorizationDetails", status_code=503
+        ) == TransactionLogPolicy.FULL
+
+    def test_money_moving_actions_saved_in_full(self):
+        assert (self.policy.get_level("Authorize", status_code=200) ==
+                TransactionLogPolicy.FULL)
+
+    def test_unsampled_reads_saved_as_summaries(self):
+        assert (self.policy.get_level("GetAuthorizationDetails", None, 200) ==
+                TransactionLogPolicy.SUMMARY)
+        policy = TransactionLogPolicy(sample_rate=1)
+        assert (policy.get_level("GetAuthorizationDetails", None, 200) ==
+                TransactionLogPolicy.FULL)
+
+
+@override_settings(AMAZON_PAYMENTS_LOG_DATABASE="logs",
+                   AMAZON_PAYMENTS_LOG_REPLICA_DATABASE="logs_replica")
+class RouterTestCase(TestCase):
+
+    def setUp(self):
+        self.router = AmazonPaymentsRouter()
+
+    def test_transaction_log_routed_to_log_database(self):
+        assert (self.router.db_for_write(AmazonPaymentsTransaction) ==
+                "logs")
+        assert (self.router.db_for_read(AmazonPaymentsTransaction) ==
+                "logs_replica")
+        assert self.router.allow_syncdb("logs", AmazonPaymentsTransaction)
+        assert not self.router.allow_syncdb("default",
+                                            AmazonPaymentsTransaction)
+
+    def test_sessions_stay_on_default_database(self):
+        assert self.router.db_for_write(AmazonPaymentsSession) is None
+        assert self.router.db_for_read(AmazonPaymentsAuthAttempt) is None
+        assert not self.router.allow_syncdb("logs", AmazonPaymentsSession)
+        assert self.router.allow_syncdb("default", AmazonPaymentsSession)
+        assert self.router.allow_relation(AmazonPaymentsTransaction(),
+                                          AmazonPaymentsSession())
+
+
+class ManagerTestCase(TestCase):
+    """ Tests for looking up sessions and auth attempts by Amazon IDs. """
+
+    def setUp(self):
+        self.session = AmazonPaymentsSession.objects.create(
+            billing_agreement_id="C01-9258635-6970398",
+            order_reference_id="S01-6576755-3809974")
+        self.auth_attempt = self.session.auth_attempts.create(
+            authorization_id="S01-6576755-3809974-A067494")
+
+    def test_session_lookups(self):
+        assert list(AmazonPaymentsSession.objects.for_billing_agreement(
+            "C01-9258635-6970398")) == [self.session]
+        assert AmazonPaymentsSession.objects.get_by_order_reference_id(
+            "S01-6576755-3809974") == self.session
+
+    def test_auth_attempt_lookup(self):
+        auth_attempt = AmazonPaymentsAuthAttempt.objects\
+            .get_by_authorization_id("S01-6576755-3809974-A067494")
+        assert auth_attempt == self.auth_attempt
+        assert auth_attempt.session == self.session
+
+
+class ULIDTestCase(TestCase):
+
+    def test_ulids_are_time_ordered(self):
+        with patch("time.time") as time:
+            time.return_value = 1400000000.0
+            first = generate_ulid()
+            time.return_value = 1400000000.001
+            second = generate_ulid()
+        assert len(first) == len(second) == 26
+        assert first < second
+
+
+class BackgroundCallTestCase(TestCase):
+
+    def test_result_from_thread(self):
+        call = BackgroundCall(threading.current_thread)
+        assert call.thread is not None
+        assert call.result() is not threading.current_thread()
+
+    def test_exception_is_reraised(self):
+        call = BackgroundCall(int, ("not a number",))
+        with self.assertRaises(ValueError):
+            call.result()
+
+    def test_not_in_background(self):
+        call = BackgroundCall(threading.current_thread, background=False)
+        assert call.thread is None
+        assert call.result() is threading.current_thread()
+
+
+class SessionStateTestCase(TestCase):
+
+    def setUp(self):
+        self.session = AmazonPaymentsSession.objects.create(
+            billing_agreement_id="C01-9258635-6970398")
+
+    def test_allowed_transition(self):
+        assert self.session.state == AmazonPaymentsSession.DRAFT
+        assert self.session.transition(
+            AmazonPaymentsSession.ORDER_REFERENCE_CREATED,
+            order_reference_id="S01-6576755-3809974")
+        session = AmazonPaymentsSession.objects.get(pk=self.session.pk)
+        assert session.state == AmazonPaymentsSession.ORDER_REFERENCE_CREATED
+        assert session.order_reference_id == "S01-6576755-3809974"
+        assert session.state_changed_at is not None
+
+    def test_transition_from_stale_state(self):
+        """
+        Checks that a transition made on a stale copy of the session
+        doesn't overwrite a concurrent transition.
+        """
+        stale_session = AmazonPaymentsSession.objects.get(pk=self.session.pk)
+        assert self.session.transition(AmazonPaymentsSession.AUTHORIZING)
+        assert not stale_session.transition(AmazonPaymentsSession.AUTHORIZING)
+        assert self.session.transition(AmazonPaymentsSession.CAPTURED)
+        assert not stale_session.transition(
+            AmazonPaymentsSession.ORDER_REFERENCE_CREATED)
+        session = AmazonPaymentsSession.objects.get(pk=self.session.pk)
+        assert session.state == AmazonPaymentsSession.CAPTURED
+
+    def test_stuck_authorizations(self):
+        self.session.transition(AmazonPaymentsSession.AUTHORIZING)
+        AmazonPaymentsSession.objects.filter(pk=self.session.pk).update(
+            state_changed_at=timezone.now() - datetime.timedelta(hours=2))
+        assert list(AmazonPaymentsSession.objects.stuck_authorizations(
+            datetime.timedelta(hours=1))) == [self.session]
+
+
+class ShippingCacheKeyTestCase(TestCase):
+
+    def setUp(self):
+        self.basket = Basket.objects.create()
+        self.basket.strategy = Selector().strategy()
+        self.user = AnonymousUser()
+
+    def test_key_changes_with_lines(self):
+        key = get_shipping_cache_key(self.basket, self.user)
+        assert get_shipping_cache_key(self.basket, self.user) == key
+        self.basket.add_product(create_product(price=Decimal("9.99")))
+        assert get_shipping_cache_key(self.basket, self.user) != key
+
+    def test_key_changes_with_offers(self):
+        key = get_shipping_cache_key(self.basket, self.user)
+        bump_offers_version()
+        assert get_shipping_cache_key(self.basket, self.user) != key
+
+    def test_key_changes_with_prices(self):
+        self.basket.add_product(create_product(price=Decimal("9.99")))
+        other_basket = Basket.objects.create()
+        key = get_shipping_cache_key(self.basket, self.user)
+        other_key = get_shipping_cache_key(other_basket, self.user)
+        stockrecord = StockRecord.objects.get()
+        stockrecord.price_excl_tax = Decimal("5.00")
+        stockrecord.save()
+        assert get_shipping_cache_key(self.basket, self.user) != key
+        assert get_shipping_cache_key(other_basket, self.user) == other_key
+
+    def test_receivers_have_senders(self):
+        # A post_delete receiver for all models would stop querysets from
+        # being deleted without loading them.
+        assert Collector("default").can_fast_delete(
+            AmazonPaymentsSettlement.objects.all())
+
+
+class CacheLockTestCase(TestCase):
+
+    def test_lock_is_exclusive(self):
+        lock = CacheLock("test")
+        assert lock.acquire()
+        other_lock = CacheLock("test")
+        assert not other_lock.acquire(wait=0.1)
+        lock.release()
+        assert other_lock.acquire()
+        other_lock.release()
+
+
+class RenewalTestCase(APITestCase):
+
+    def setUp(self):
+        super(RenewalTestCase, self).setUp()
+        self.session = AmazonPaymentsSession.objects.create(
+            billing_agreement_id="C01-9258635-6970398")
+
+    def create_renewal(self, days=0):
+        return AmazonPaymentsRenewal.objects.create(
+            session=self.session, amount=Decimal("9.99"), currency="USD",
+            due_at=timezone.now() + datetime.timedelta(days=days))
+
+    def test_reference_id_is_deterministic(self):
+        renewal = self.create_renewal()
+        assert len(renewal.reference_id) == 32
+        assert renewal.reference_id == (
+            AmazonPaymentsRenewal.generate_reference_id(
+                "C01-9258635-6970398", renewal.due_at))
+        with self.assertRaises(IntegrityError):
+            self.create_renewal()
+
+    def test_renew_command(self):
+        renewal = self.create_renewal()
+        future_renewal = self.create_renewal(days=30)
+        with patch('requests.post') as post:
+            post.return_value = self.create_mock_response(
+                RESPONSES["authorize_on_billing_agreement"])
+            call_command("amazon_payments_renew", rate=1000)
+            assert post.call_count == 1
+            params = post.call_args[1]["params"]
+            assert params["AuthorizationReferenceId"] == renewal.reference_id
+            # Running it again doesn't charge the renewal again
+            call_command("amazon_payments_renew", rate=1000)
+            assert post.call_count == 1
+        renewal = AmazonPaymentsRenewal.objects.get(pk=renewal.pk)
+        assert renewal.state == AmazonPaymentsRenewal.AUTHORIZED
+        assert renewal.attempts == 1
+        assert renewal.authorization_id == "S01-4517324-8912350-A038173"
+        assert renewal.order_reference_id == "S01-4517324-8912350"
+        assert self.session.transactions.get().action == (
+            "AuthorizeOnBillingAgreement")
+        assert AmazonPaymentsRenewal.objects.get(
+            pk=future_renewal.pk).state == AmazonPaymentsRenewal.PENDING
+
+    def test_throttled_call_is_retried(self):
+        renewal = self.create_renewal()
+        responses = [RESPONSES["throttled"],
+                     RESPONSES["authorize_on_billing_agreement_declined"]]
+        with patch('requests.post') as post, patch(
+                "amazon_payments.renewals.time.sleep"):
+            post.side_effect = lambda *args, **kwargs: (
+                self.create_mock_response(responses.pop(0)))
+            counts = RenewalProcessor(
+                self.api, rate_limiter=RateLimiter(1000, 10)).run(
+                    AmazonPaymentsRenewal.objects.due())
+        assert counts == {AmazonPaymentsRenewal.DECLINED: 1}
+        renewal = AmazonPaymentsRenewal.objects.get(pk=renewal.pk)
+        assert renewal.error_code == "InvalidPaymentMethod"
+        assert list(self.session.transactions.values_list(
+            "error_code", flat=True).order_by("pk")) == [
+                "RequestThrottled", None]
+
+    def test_unknown_outcome_is_left_for_checking(self):
+        renewal = self.create_renewal()
+        # The retry of a call that timed out is rejected as a duplicate
+        responses = [requests.ReadTimeout("Read timed out."),
+                     RESPONSES["error"].replace(
+                         "InvalidAddressConsentToken", "DuplicateReferenceId")]
+
+        def side_effect(*args, **kwargs):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return self.create_mock_response(response)
+
+        with patch('requests.post') as post, patch(
+                "amazon_payments.renewals.time.sleep"):
+            post.side_effect = side_effect
+            counts = RenewalProcessor(
+                self.api, rate_limiter=RateLimiter(1000, 10)).run(
+                    AmazonPaymentsRenewal.objects.due())
+        assert counts == {AmazonPaymentsRenewal.AUTHORIZING: 1}
+        renewal = AmazonPaymentsRenewal.objects.get(pk=renewal.pk)
+        assert renewal.error_code == "OutcomeUnknown"
+        AmazonPaymentsRenewal.objects.filter(pk=renewal.pk).update(
+            updated_at=timezone.now() - datetime.timedelta(hours=2))
+        assert not AmazonPaymentsRenewal.objects.due(
+            datetime.timedelta(hours=1)).exists()
+
+    def test_unknown_outcome_is_looked_up(self):
+        renewal = self.create_renewal()
+        AmazonPaymentsRenewal.objects.filter(pk=renewal.pk).update(
+            state=AmazonPaymentsRenewal.AUTHORIZING,
+            reference_id="7-1426862604",
+            order_reference_id="S01-6576755-3809974",
+            updated_at=timezone.now() - datetime.timedelta(hours=2))
+
+        def side_effect(*args, **kwargs):
+            if kwargs["params"]["Action"] == "GetOrderReferenceDetails":
+                return self.create_mock_response(
+                    RESPONSES["order_reference_details"])
+            return self.create_mock_response(
+                RESPONSES["authorization_details"])
+
+        with patch('requests.post') as post:
+            post.side_effect = side_effect
+            counts = RenewalProcessor(
+                self.api, rate_limiter=RateLimiter(1000, 10)).run(
+                    AmazonPaymentsRenewal.objects.due(
+                        datetime.timedelta(hours=1)))
+            actions = [call[1]["params"]["Action"]
+                       for call in post.call_args_list]
+        assert "AuthorizeOnBillingAgreement" not in actions
+        assert counts == {AmazonPaymentsRenewal.AUTHORIZED: 1}
+        renewal = AmazonPaymentsRenewal.objects.get(pk=renewal.pk)
+        assert renewal.authorization_id == "S01-6576755-3809974-A067494"
+
+    def test_renewals_keep_their_session(self):
+        self.create_renewal()
+        with self.assertRaises(ProtectedError):
+            self.session.delete()
+
+    def test_stale_renewals_are_retried(self):
+        renewal = self.create_renewal()
+        AmazonPaymentsRenewal.objects.filter(pk=renewal.pk).update(
+            state=AmazonPaymentsRenewal.AUTHORIZING,
+            updated_at=timezone.now() - datetime.timedelta(hours=2))
+        assert not AmazonPaymentsRenewal.objects.due().exists()
+        assert AmazonPaymentsRenewal.objects.due(
+            datetime.timedelta(hours=1)).get() == renewal
+
+    def test_shard_leases(self):
+        minute = datetime.timedelta(minutes=1)
+        lease = AmazonPaymentsShardLease.objects.acquire(
+            "renewals", 2, "node1", minute)
+        assert lease.shard == 0
+        assert AmazonPaymentsShardLease.objects.acquire(
+            "renewals", 2, "node2", minute).shard == 1
+        assert AmazonPaymentsShardLease.objects.acquire(
+            "renewals", 2, "node3", minute) is None
+        # The lease of a node that stopped renewing it can be taken over
+        AmazonPaymentsShardLease.objects.filter(pk=lease.pk).update(
+            expires_at=timezone.now() - minute)
+        taken = AmazonPaymentsShardLease.objects.acquire(
+            "renewals", 2, "node3", minute)
+        assert taken.pk == lease.pk
+        assert not lease.renew(minute)
+        assert taken.renew(minute)
+        taken.release()
+        assert AmazonPaymentsShardLease.objects.acquire(
+            "renewals", 2, "node1", minute).pk == lease.pk
+
+    def test_renew_command_skips_leased_shards(self):
+        renewal = self.create_renewal()
+        bucket = get_shard_bucket("C01-9258635-6970398")
+        assert renewal.bucket == bucket
+        AmazonPaymentsShardLease.objects.create(
+            name="renewals", num_shards=4, shard=bucket % 4, owner="node2",
+            expires_at=timezone.now() + datetime.timedelta(minutes=1))
+        with patch('requests.post') as post:
+            post.return_value = self.create_mock_response(
+                RESPONSES["authorize_on_billing_agreement"])
+            call_command("amazon_payments_renew", rate=1000, shards=4)
+            assert post.call_count == 0
+            # Once the other node's lease expires, its shard is reclaimed
+            AmazonPaymentsShardLease.objects.update(expires_at=timezone.now())
+            call_command("amazon_payments_renew", rate=1000, shards=4)
+            assert post.call_count == 1
+        assert AmazonPaymentsRenewal.objects.get(
+            pk=renewal.pk).state == AmazonPaymentsRenewal.AUTHORIZED
+        assert not AmazonPaymentsShardLease.objects.filter(
+            owner__isnull=False).exists()
+
+
+class ReconciliationTestCase(APITestCase):
+
+    def setUp(self):
+        super(ReconciliationTestCase, self).setUp()
+        cache.clear()
+
+    def create_paid_order(self, total, amount_debited,
+                          state=AmazonPaymentsSession.CAPTURED):
+        order = create_order()
+        Order.objects.filter(pk=order.pk).update(total_incl_tax=total)
+        session = AmazonPaymentsSession.objects.create(
+            billing_agreement_id="C01-9258635-6970398", order=order,
+            state=state)
+        AmazonPaymentsAuthAttempt.objects.create(
+            session=session,
+            authorization_id="S01-6576755-3809974-A%06d" % order.pk)
+        Source.objects.create(
+            order=order, source_type=SourceType.objects.get_or_create(
+                name="Amazon Payments")[0],
+            amount_debited=amount_debited,
+            reference="S01-6576755-3809974-A%06d" % order.pk)
+        return order
+
+    def reconcile(self, response="authorization_details", **options):
+        stdout = StringIO()
+        with patch('requests.post') as post:
+            post.return_value = self.create_mock_response(
+                RESPONSES[response])
+            call_command("amazon_payments_reconcile", rate=1000,
+                         stdout=stdout, stderr=StringIO(), **options)
+        return post.call_count, stdout.getvalue().splitlines()[1:]
+
+    def test_reconcile_command(self):
+        self.create_paid_order(Decimal("9.99"), Decimal("9.99"))
+        assert self.reconcile() == (1, [])
+        assert AmazonPaymentsCheckpoint.get_position("reconciliation")
+        # Only orders placed since the last run are checked
+        order = self.create_paid_order(
+            Decimal("10.01"), Decimal("9.99"),
+            state=AmazonPaymentsSession.AUTHORIZED)
+        calls, rows = self.reconcile()
+        assert calls == 1
+        assert rows == [
+            "%s,%s,S01-6576755-3809974-A%06d,amount,10.01,9.99" % (
+                order.number, order.amazonpaymentssession.pk, order.pk),
+            "%s,%s,S01-6576755-3809974-A%06d,state,authorized,captured" % (
+                order.number, order.amazonpaymentssession.pk, order.pk),
+        ]
+        assert self.reconcile()[0] == 0
+        # The authorizations are closed, so their details are cached, but
+        # they're fetched again as a cached status could hide a mismatch
+        assert self.reconcile(from_start=True)[0] == 2
+        assert AmazonPaymentsTransaction.objects.filter(
+            action="GetAuthorizationDetails").count() == 4
+
+    def test_failed_lookups_are_retried(self):
+        self.create_paid_order(Decimal("9.99"), Decimal("9.99"))
+        assert self.reconcile(response="throttled")[0] == 1
+        assert not AmazonPaymentsCheckpoint.get_position("reconciliation")
+        assert self.reconcile() == (1, [])
+        assert AmazonPaymentsCheckpoint.get_position("reconciliation")
+
+    def test_missing_authorization(self):
+        order = self.create_paid_order(Decimal("9.99"), Decimal("9.99"))
+        AmazonPaymentsAuthAttempt.objects.all().delete()
+        calls, rows = self.reconcile()
+        assert calls == 0
+        assert rows == ["%s,%s,,missing_authorization,," % (
+            order.number, order.amazonpaymentssession.pk)]
+
+
+class SettlementImportTestCase(TestCase):
+
+    def setUp(self):
+        self.order = create_order()
+        self.session = AmazonPaymentsSession.objects.create(
+            billing_agreement_id="C01-9258635-6970398", order=self.order,
+            order_reference_id="S01-6576755-3809974")
+        AmazonPaymentsAuthAttempt.objects.create(
+            session=self.session,
+            authorization_id="S01-6576755-3809974-A067494")
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_report(self, rows, name="settlement.txt.gz"):
+        path = os.path.join(self.tmpdir, name)
+        report = gzip.open(path, "wb")
+        report.write("SettlementId\tTransactionType\tAmazonTransactionId\t"
+                     "SellerOrderId\tTransactionAmount\tCurrencyCode\t"
+                     "TransactionPostedDate\n")
+        for row in rows:
+            report.write("\t".join(row) + "\n")
+        report.close()
+        return path
+
+    def test_import_settlements(self):
+        path = self.write_report([
+            ("1234", "Capture", "S01-6576755-3809974-A067494", "", "9.99",
+             "USD", "2015-03-21T10:00:00+00:00"),
+            ("1234", "Refund", "S01-6576755-3809974-R000001",
+             str(self.order.number), "-2.50", "USD", "2015-03-22T10:00:00"),
+            ("1234", "Capture", "S01-0000000-0000000-A000000", "", "5.00",
+             "USD", ""),
+        ])
+        stdout = StringIO()
+        call_command("amazon_payments_import_settlements", path,
+                     batch_size=2, stdout=stdout)
+        assert "Imported 3 rows" in stdout.getvalue()
+        assert "(2 matched)" in stdout.getvalue()
+        capture, refund, unmatched = AmazonPaymentsSettlement.objects\
+            .order_by("row_number")
+        assert capture.session == self.session
+        assert capture.order == self.order
+        assert capture.amount == Decimal("9.99")
+        assert capture.posted_at == datetime.datetime(
+            2015, 3, 21, 10, tzinfo=timezone.utc)
+        assert refund.order == self.order
+        assert refund.amount == Decimal("-2.50")
+        assert unmatched.session is None
+        assert unmatched.posted_at is None
+        # Importing the report again replaces its rows
+        call_command("amazon_payments_import_settlements", path,
+                     stdout=StringIO())
+        assert AmazonPaymentsSettlement.objects.count() == 3
+
+    def test_settlement_split_across_reports(self):
+        rows = [("5678", "Capture", "S01-6576755-3809974-A%06d" % i, "",
+                 "1.00", "USD", "") for i in range(5)]
+        paths = [self.write_report(rows[:3], "part1.txt.gz"),
+                 self.write_report(rows[3:], "part2.txt.gz")]
+        call_command("amazon_payments_import_settlements", *paths,
+                     stdout=StringIO())
+        assert list(AmazonPaymentsSettlement.objects.order_by(
+            "row_number").values_list("amazon_transaction_id", flat=True)) \
+            == [row[2] for row in rows]
+        # A failed import leaves the previous rows in place
+        with patch.object(SettlementImporter, "save_batch") as save_batch:
+            save_batch.side_effect = DatabaseError
+            with self.assertRaises(DatabaseError):
+                call_command("amazon_payments_import_settlements", paths[0],
+                             stdout=StringIO())
+        assert AmazonPaymentsSettlement.objects.count() == 5
+
+
+class BatchOperationsTestCase(APITestCase):
+    capture_status = "<State>Completed</State>"
+
+    def mock_post(self, url, params, **kwargs):
+        responses = {
+            "Capture": RESPONSES["capture"].replace(
+                "<State>Completed</State>", self.capture_status),
+            "Refund": RESPONSES["refund"],
+            "CloseOrderReference": RESPONSES["close_order_reference"],
+        }
+        if params.get("AmazonAuthorizationId") == "unknown":
+            return self.create_mock_response(RESPONSES["error"])
+        response = self.create_mock_response(responses[params["Action"]])
+        response.url = "%s?%s" % (url, urllib.urlencode(params))
+        return response
+
+    def test_bulk_capture(self):
+        rate_limiter = Mock(wraps=RateLimiter(1000, 10))
+        with patch('requests.post') as post:
+            post.side_effect = self.mock_post
+            results = sorted(self.api.bulk_capture(
+                [("S01-6576755-3809974-A067494", "ref1", "9.99", "USD"),
+                 ("unknown", "ref2", "9.99", "USD")],
+                rate_limiter=rate_limiter))
+        assert rate_limiter.acquire.call_args_list == [((BULK,),)] * 2
+        (ok_args, ok_result, ok_error), (bad_args, bad_result, bad_error) = \
+            results
+        assert ok_args[0] == "S01-6576755-3809974-A067494"
+        assert ok_result[0] == "S01-6576755-3809974-C067494"
+        assert ok_result[1].State.text == "Completed"
+        assert ok_error is None
+        assert bad_result is None
+        assert bad_error.args[0] == "InvalidAddressConsentToken"
+
+    def test_batch_command(self):
+        session = AmazonPaymentsSession.objects.create(
+            billing_agreement_id="C01-9258635-6970398",
+            order_reference_id="S01-6576755-3809974",
+            state=AmazonPaymentsSession.AUTHORIZED)
+        AmazonPaymentsAuthAttempt.objects.create(
+            session=session, authorization_id="S01-6576755-3809974-A067494")
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "operations.csv")
+            with open(path, "wb") as operations:
+                operations.write(
+                    "action,amazon_id,amount,currency,reference_id\n"
+                    "capture,S01-6576755-3809974-A067494,9.99,USD,\n"
+                    "capture,unknown,9.99,USD,\n")
+            stdout = StringIO()
+            with patch('requests.post') as post:
+                post.side_effect = self.mock_post
+                call_command("amazon_payments_batch", path, rate=1000,
+                             stdout=stdout, stderr=StringIO())
+        finally:
+            shutil.rmtree(tmpdir)
+        rows = sorted(stdout.getvalue().splitlines()[1:])
+        assert rows[0].startswith(
+            "2,capture,S01-6576755-3809974-A067494,c")
+        assert rows[0].endswith(
+            ",ok,S01-6576755-3809974-C067494,Completed,,")
+        assert rows[1].startswith("3,capture,unknown,")
+        assert ",error,,,InvalidAddressConsentToken," in rows[1]
+        session = AmazonPaymentsSession.objects.get(pk=session.pk)
+        assert session.state == AmazonPaymentsSession.CAPTURED
+        assert session.transactions.get().capture_id == (
+            "S01-6576755-3809974-C067494")
+
+    def run_batch(self, operations):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "operations.csv")
+            with open(path, "wb") as operations_file:
+                operations_file.write(
+                    "action,amazon_id,amount,currency,reference_id,reason\n" +
+                    operations)
+            stdout = StringIO()
+            with patch('requests.post') as post:
+                post.side_effect = self.mock_post
+                call_command("amazon_payments_batch", path, rate=1000,
+                             stdout=stdout, stderr=StringIO())
+        finally:
+            shutil.rmtree(tmpdir)
+        return stdout.getvalue().splitlines()[1:]
+
+    def test_refund_checkout_order(self):
+        session = AmazonPaymentsSession.objects.create(
+            order_reference_id="S01-6576755-3809974",
+            state=AmazonPaymentsSession.CAPTURED)
+        # Orders placed through the checkout are captured when they're
+        # authorized
+        session.transactions.create(**get_transaction_details(
+            "", RESPONSES["authorize"], action="Authorize"))
+        rows = self.run_batch(
+            "refund,S01-6576755-3809974-C067494,2.50,USD,refund1\n"
+            "refund,S01-6576755-3809974-C067494,2.50,USD,refund2\n")
+        assert [row.split(",")[4] for row in rows] == ["pending", "pending"]
+        # The refunds haven't completed yet
+        session = AmazonPaymentsSession.objects.get(pk=session.pk)
+        assert session.state == AmazonPaymentsSession.CAPTURED
+        assert session.transactions.filter(action="Refund").count() == 2
+
+    def test_declined_capture(self):
+        session = AmazonPaymentsSession.objects.create(
+            order_reference_id="S01-6576755-3809974",
+            state=AmazonPaymentsSession.AUTHORIZED)
+        self.capture_status = (
+            "<State>Declined</State><ReasonCode>AmazonRejected</ReasonCode>")
+        row, = self.run_batch(
+            "capture,S01-6576755-3809974-A067494,9.99,USD,\n")
+        assert row.endswith(
+            ",declined,S01-6576755-3809974-C067494,Declined,AmazonRejected,")
+        session = AmazonPaymentsSession.objects.get(pk=session.pk)
+        assert session.state == AmazonPaymentsSession.AUTHORIZED
+
+    def test_close_reason(self):
+        session = AmazonPaymentsSession.objects.create(
+            order_reference_id="S01-6576755-3809974",
+            state=AmazonPaymentsSession.CAPTURED)
+        row, = self.run_batch("close,S01-6576755-3809974,,,,Sold out\n")
+        assert ",ok," in row
+        session = AmazonPaymentsSession.objects.get(pk=session.pk)
+        assert session.state == AmazonPaymentsSession.CLOSED
+        assert "ClosureReason=Sold+out" in session.transactions.get().request
+
+    def test_refund_needs_reference_id(self):
+        with self.assertRaises(CommandError):
+            self.run_batch("refund,S01-6576755-3809974-C067494,2.50,USD,\n")
+
+
+class StatusCacheTestCase(APITestCase):
+
+    def setUp(self):
+        super(StatusCacheTestCase, self).setUp()
+        cache.clear()
+        self.api.status_cache = StatusCache(timeout=60)
+
+    def get_status(self, response):
+        with patch('requests.post') as post:
+            post.return_value = self.create_mock_response(response)
+            self.api.get_authorization_status("S01-6576755-3809974-A067494")
+        return post.call_count
+
+    def test_terminal_states_are_cached(self):
+        assert self.get_status(RESPONSES["authorization_details"]) == 1
+        assert self.get_status(RESPONSES["authorization_details"]) == 0
+        # e.g. on an IPN
+        self.api.invalidate_status(
+            authorization_id="S01-6576755-3809974-A067494")
+        assert self.get_status(RESPONSES["authorization_details"]) == 1
+
+    def test_terminal_states_expire(self):
+        with patch("amazon_payments.caching.cache") as mock_cache:
+            mock_cache.get.return_value = None
+            self.get_status(RESPONSES["authorization_details"])
+        assert mock_cache.set.call_args[0][2] == 24 * 60 * 60
+
+    def test_open_states_are_cached_with_timeout(self):
+        response = RESPONSES["authorization_details"].replace(
+            "<State>Closed</State>", "<State>Open</State>")
+        with patch("amazon_payments.caching.cache") as mock_cache:
+            mock_cache.get.return_value = None
+            self.get_status(response)
+        assert mock_cache.set.call_args[0][2] == 60
+
+    def test_errors_are_not_cached(self):
+        with self.assertRaises(AmazonPaymentsAPIError):
+            self.get_status(RESPONSES["error"])
+        assert self.get_status(RESPONSES["authorization_details"]) == 1
+
+    def test_writes_invalidate_cached_status(self):
+        self.get_status(RESPONSES["authorization_details"])
+        with patch('requests.post') as post:
+            post.return_value = self.create_mock_response(RESPONSES["capture"])
+            self.api.capture("S01-6576755-3809974-A067494", "ref", "9.99",
+                             "USD")
+        assert self.get_status(RESPONSES["authorization_details"]) == 1
+
+    def get_order_reference_status(self):
+        with patch('requests.post') as post:
+            post.return_value = self.create_mock_response(
+                RESPONSES["order_reference_details"])
+            self.api.get_order_reference_details("S01-6576755-3809974")
+        return post.call_count
+
+    def test_writes_invalidate_related_statuses(self):
+        self.get_status(RESPONSES["authorization_details"])
+        assert self.get_order_reference_status() == 1
+        assert self.get_order_reference_status() == 0
+        # Capturing changes the order reference's state too
+        with patch('requests.post') as post:
+            post.return_value = self.create_mock_response(RESPONSES["capture"])
+            self.api.capture("S01-6576755-3809974-A067494", "ref", "9.99",
+                             "USD")
+        assert self.get_order_reference_status() == 1
+        # An authorization can close the order reference's others
+        self.get_status(RESPONSES["authorization_details"])
+        with patch('requests.post') as post:
+            post.return_value = self.create_mock_response(
+                RESPONSES["authorize"])
+            self.api.do_request(
+                "Authorize", {"AmazonOrderReferenceId": "S01-6576755-3809974"})
+        assert self.get_status(RESPONSES["authorization_details"]) == 1
+
+    def post_ipn(self, message, url=None, **notification):
+        notification.setdefault("Type", "Notification")
+        notification.setdefault("TopicArn", "arn:aws:sns:us-east-1:1:ipn")
+        notification["Message"] = json.dumps(message)
+        return self.client.post(
+            url or reverse("checkout:amazon-payments-ipn"),
+            json.dumps(notification), content_type="text/plain")
+
+    def get_authorization_ipn(self, *authorization_ids):
+        return {"NotificationType": "PaymentAuthorize",
+                "NotificationData": (
+                    "<AuthorizationNotification><AuthorizationDetails>" +
+                    "".join("<AmazonAuthorizationId>%s"
+                            "</AmazonAuthorizationId>" % authorization_id
+                            for authorization_id in authorization_ids) +
+                    "</AuthorizationDetails></AuthorizationNotification>")}
+
+    @override_settings(
+        AMAZON_PAYMENTS_IPN_TOPIC_ARN="arn:aws:sns:us-east-1:1:ipn")
+    def test_ipn_invalidates_statuses(self):
+        self.get_status(RESPONSES["authorization_details"])
+        response = self.post_ipn(
+            self.get_authorization_ipn("S01-6576755-3809974-A067494"))
+        assert response.status_code == 200
+        assert self.get_status(RESPONSES["authorization_details"]) == 1
+        response = self.client.post(
+            reverse("checkout:amazon-payments-ipn"), "not JSON",
+            content_type="text/plain")
+        assert response.status_code == 400
+
+    def test_ipn_needs_known_sender(self):
+        self.get_status(RESPONSES["authorization_details"])
+        message = self.get_authorization_ipn("S01-6576755-3809974-A067494")
+        # Nothing is accepted until a topic or secret is configured
+        assert self.post_ipn(message).status_code == 403
+        with self.settings(
+                AMAZON_PAYMENTS_IPN_TOPIC_ARN="arn:aws:sns:us-east-1:1:ipn",
+                AMAZON_PAYMENTS_IPN_SECRET="s3cret"):
+            assert self.post_ipn(
+                message, TopicArn="arn:aws:sns:us-east-1:2:other",
+            ).status_code == 403
+            assert self.post_ipn(message).status_code == 403
+            url = reverse("checkout:amazon-payments-ipn") + "?secret=wrong"
+            assert self.post_ipn(message, url).status_code == 403
+            assert self.get_status(RESPONSES["authorization_details"]) == 0
+            url = reverse("checkout:amazon-payments-ipn") + "?secret=s3cret"
+            assert self.post_ipn(message, url).status_code == 200
+        assert self.get_status(RESPONSES["authorization_details"]) == 1
+
+    @override_settings(
+        AMAZON_PAYMENTS_IPN_TOPIC_ARN="arn:aws:sns:us-east-1:1:ipn")
+    def test_ipn_only_invalidates_its_object(self):
+        self.get_status(RESPONSES["authorization_details"])
+        # IDs outside the notification's own field are ignored
+        message = {"NotificationType": "PaymentCapture",
+                   "NotificationData": (
+                       "<CaptureNotification><CaptureDetails>"
+                       "<SellerCaptureNote><AmazonAuthorizationId>"
+                       "S01-6576755-3809974-A067494</AmazonAuthorizationId>"
+                       "</SellerCaptureNote></CaptureDetails>"
+                       "</CaptureNotification>")}
+        assert self.post_ipn(message).status_code == 200
+        assert self.get_status(RESPONSES["authorization_details"]) == 0
+        # and only the first MAX_IPN_IDS order references are invalidated
+        with patch("amazon_payments.views.AmazonPaymentsAPI."
+                   "invalidate_status") as invalidate_status:
+            self.post_ipn(self.get_authorization_ipn(*[
+                "S01-6576755-38099%02d-A067494" % i for i in range(20)]))
+        assert invalidate_status.call_count == views.MAX_IPN_IDS
+
+
+class PaymentTypesTestCase(TestCase):
+
+    def setUp(self):
+        reset_payment_types()
+
+    def tearDown(self):
+        reset_payment_types()
+
+    def test_source_type_is_loaded_once(self):
+        # Source types created before it was looked up by code are reused
+        existing = SourceType.objects.create(name="Amazon Payments")
+        with self.assertNumQueries(1):
+            assert get_source_type() == existing
+            assert get_source_type() == existing
+
+    def test_warmed_on_first_request(self):
+        # Earlier tests' requests may have disconnected it already
+        request_started.connect(
+            warm_payment_types_on_first_request,
+            dispatch_uid="amazon_payments_warm_payment_types")
+        with patch("amazon_payments.receivers.warm_payment_types") as warm:
+            request_started.send(sender=None)
+            request_started.send(sender=None)
+        assert warm.call_count == 1
+        warm_payment_types()
+        with self.assertNumQueries(0):
+            get_source_type()
+
+
+class RateLimiterTestCase(TestCase):
+
+    def test_burst(self):
+        limiter = RateLimiter(1, burst=2)
+        assert limiter.try_acquire() == 0
+        assert limiter.try_acquire() == 0
+        assert 0 < limiter.try_acquire() <= 1
+
+    def test_headroom_is_kept_for_interactive_calls(self):
+        limiter = RateLimiter(1, burst=5, headroom={BULK: 3})
+        assert limiter.try_acquire(BULK) == 0
+        assert limiter.try_acquire(BULK) == 0
+        assert limiter.try_acquire(BULK) > 0
+        for i in range(3):
+            assert limiter.try_acquire(INTERACTIVE) == 0
+        assert limiter.try_acquire(INTERACTIVE) > 0
+        with self.assertRaises(ValueError):
+            RateLimiter(1, burst=5, headroom={BULK: 5})
+
+    def test_shared_rate_limiter(self):
+        cache.clear()
+        web = SharedRateLimiter("test", 1, burst=3, headroom={BULK: 1})
+        batch = SharedRateLimiter("test", 1, burst=3, headroom={BULK: 1})
+        assert batch.try_acquire(BULK) == 0
+        assert batch.try_acquire(BULK) == 0
+        # The last token is kept for the web servers
+        assert batch.try_acquire(BULK) > 0
+        assert web.try_acquire(INTERACTIVE) == 0
+        assert web.try_acquire(INTERACTIVE) > 0
+
+    def test_do_request_priority(self):
+        api = AmazonPaymentsAPI("access_key", "secret_key", "seller_id",
+                                rate_limiter=Mock(), priority=BULK)
+        with patch('requests.post') as post:
+            post.return_value = Mock(content="", status_code=200)
+            api.do_request("Capture", {}, process=False)
+            api.do_request("Capture", {}, process=False,
+                           priority=INTERACTIVE)
+        assert api.rate_limiter.acquire.call_args_list == [
+            ((BULK,), {"timeout": None}), ((INTERACTIVE,), {"timeout": None})]
+
+    def test_rate_limit_wait(self):
+        api = AmazonPaymentsAPI("access_key", "secret_key", "seller_id",
+                                rate_limiter=RateLimiter(0.01, burst=1),
+                                priority=INTERACTIVE, rate_limit_wait=1)
+        with patch('requests.post') as post, patch(
+                "amazon_payments.throttling.time.sleep") as sleep:
+            post.return_value = Mock(content="", status_code=200)
+            api.do_request("Capture", {}, process=False)
+            # The next token is 100 seconds away, so this fails straight
+            # away rather than holding up the checkout
+            with self.assertRaises(AmazonPaymentsAPIError) as cm:
+                api.do_request("Capture", {}, process=False)
+        assert cm.exception.args[0] == "RequestThrottled"
+        assert post.call_count == 1
+        assert not sleep.called
+
+
+class ConcurrencyControllerTestCase(APITestCase):
+
+    def test_additive_increase_multiplicative_decrease(self):
+        controller = ConcurrencyController(8)
+        for i in range(10):
+            controller.release(controller.acquire(), latency=0.1)
+        assert 4 <= controller.limit <= 5
+        # Calls that were in flight together only cut the limit once
+        tokens = [controller.acquire() for i in range(4)]
+        limit = controller.limit
+        for token in tokens:
+            controller.release(token, throttled=True)
+        assert controller.limit == limit / 2
+        # A latency spike counts as throttling
+        limit = controller.limit
+        controller.release(controller.acquire(), latency=1)
+        assert controller.limit == limit / 2
+        assert controller.in_flight == 0
+
+    def test_do_request_reports_throttling(self):
+        self.api.concurrency_controller = ConcurrencyController(
+            8, initial_limit=4)
+        with patch('requests.post') as post:
+            post.return_value = self.create_mock_response(
+                RESPONSES["throttled"], status_code=503)
+            with self.assertRaises(AmazonPaymentsAPIError):
+                self.api.do_request("Capture", {})
+            assert self.api.concurrency_controller.limit == 2
+            post.side_effect = requests.Timeout("timed out")
+            with self.assertRaises(AmazonPaymentsAPIError):
+                self.api.do_request("Capture", {})
+            assert self.api.concurrency_controller.limit == 1
+        assert self.api.concurrency_controller.in_flight == 0
+
+
+class PruneCommandTestCase(TestCase):
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.old_session = AmazonPaymentsSession.objects.create(
+            billing_agreement_id="C01-9258635-6970398")
+        self.old_session.transactions.create(request="request",
+                                             response="response")
+        AmazonPaymentsSession.objects.filter(pk=self.old_session.pk).update(
+            created_at=timezone.now() - datetime.timedelta(days=100))
+        self.new_session = AmazonPaymentsSession.objects.create(
+            billing_agreement_id="C01-9258635-6970399")
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+
+    def test_old_sessions_archived_and_deleted(self):
+        call_command("amazon_payments_prune", days=90, batch_size=1,
+                     archive_dir=self.archive_dir)
+        assert list(AmazonPaymentsSession.objects.all()) == [self.new_session]
+        assert not AmazonPaymentsTransaction.objects.exists()
+        filename, = os.listdir(self.archive_dir)
+        archive = gzip.open(os.path.join(self.archive_dir, filename))
+        rows = [json.loads(line) for line in archive]
+        assert [row["model"] for row in rows] == [
+            "amazon_payments.amazonpaymentstransaction",
+            "amazon_payments.amazonpaymentssession"]
+        assert rows[1]["pk"] == self.old_session.pk
+
+    def create_old_session(self, **kwargs):
+        session = AmazonPaymentsSession.objects.create(
+            billing_agreement_id="C01-9258635-6970400", **kwargs)
+        AmazonPaymentsSession.objects.filter(pk=session.pk).update(
+            created_at=timezone.now() - datetime.timedelta(days=100))
+        return session
+
+    def test_sessions_holding_money_are_kept(self):
+        # e.g. when placing the order failed after the authorization
+        authorizing = self.create_old_session(
+            state=AmazonPaymentsSession.AUTHORIZING)
+        authorized = self.create_old_session(
+            state=AmazonPaymentsSession.DECLINED)
+        AmazonPaymentsAuthAttempt.objects.create(
+            session=authorized,
+            authorization_id="S01-6576755-3809974-A067494")
+        subscription = self.create_old_session()
+        AmazonPaymentsRenewal.objects.create(
+            session=subscription, amount=Decimal("9.99"), currency="USD",
+            due_at=timezone.now())
+        call_command("amazon_payments_prune", days=90, no_archive=True,
+                     stdout=StringIO())
+        assert set(AmazonPaymentsSession.objects.all()) == set([
+            self.new_session, authorizing, authorized, subscription])
+
+    def test_settlements_are_kept(self):
+        settlement = AmazonPaymentsSettlement.objects.create(
+            settlement_id="12345", row_number=1,
+            order_reference_id="S01-6576755-3809974",
+            session=self.old_session)
+        call_command("amazon_payments_prune", days=90, no_archive=True,
+                     stdout=StringIO())
+        assert list(AmazonPaymentsSession.objects.all()) == [self.new_session]
+        settlement = AmazonPaymentsSettlement.objects.get(pk=settlement.pk)
+        assert settlement.session is None
+        assert settlement.order_reference_id == "S01-6576755-3809974"
+
+
+class SessionStorageTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().get("/")
+        self.request.basket = Basket.objects.create()
+        self.request.session = {}
+
+    def test_cache_storage_keeps_concurrent_transactions(self):
+        CacheSessionStorage(self.request).save(
+            AmazonPaymentsSession(basket=self.request.basket))
+        # Two requests for the same basket, both loaded before either logs
+        # a transaction
+        storages = [CacheSessionStorage(self.request) for i in range(2)]
+        sessions = [storage.get() for storage in storages]
+        for storage, session, action in zip(
+                storages, sessions, ("GetBillingAgreementDetails",
+                                     "SetBillingAgreementDetails")):
+            storage.add_transaction(session, AmazonPaymentsTransaction(
+                action=action, request="request", response="response"))
+        storage = CacheSessionStorage(self.request)
+        session = storage.get()
+        assert len(session._pending_transactions) == 2
+        storage.persist(session)
+        assert set(session.transactions.values_list("action", flat=True)) == {
+            "GetBillingAgreementDetails", "SetBillingAgreementDetails"}
+
+    def test_session_is_persisted_before_authorizing(self):
+        CacheSessionStorage(self.request).save(AmazonPaymentsSession(
+            basket=self.request.basket,
+            state=AmazonPaymentsSession.ORDER_REFERENCE_CREATED))
+        # Two submissions for the same basket
+        storages = [CacheSessionStorage(self.request) for i in range(2)]
+        sessions = [storage.get() for storage in storages]
+        assert [storage.transition(
+            session, AmazonPaymentsSession.AUTHORIZING)
+            for storage, session in zip(storages, sessions)] == [True, False]
+        assert AmazonPaymentsSession.objects.get().state == (
+            AmazonPaymentsSession.AUTHORIZING)
+
+    def test_session_storage_keeps_summaries(self):
+        storage = SessionSessionStorage(self.request)
+        session = AmazonPaymentsSession(basket=self.request.basket)
+        storage.add_transaction(session, AmazonPaymentsTransaction(
+            action="GetBillingAgreementDetails", status_code=200,
+            request="request", response="response"))
+        tx = self.request.session[storage.session_key]["transactions"][0]
+        assert tx["action"] == "GetBillingAgreementDetails"
+        assert tx["status_code"] == 200
+        assert tx["request"] is None and tx["response"] is None
+        storage = SessionSessionStorage(self.request)
+        storage.persist(storage.get())
+        tx = AmazonPaymentsTransaction.objects.get()
+        assert tx.action == "GetBillingAgreementDetails"
+        assert tx.response is None
+
+
+# Prints the time taken by an import and which of the given modules it
+# loaded, in a fresh interpreter.
+IMPORT_TIME_SCRIPT = """
+import sys, time
+start = time.time()
+__import__(sys.argv[1])
+print(time.time() - start)
+print(",".join(name for name in sys.argv[2:] if name in sys.modules))
+"""
+
+
+class ImportTimeTestCase(TestCase):
+    """
+    Import-time regression checks. Importing the package (e.g. from a
+    management command or a worker) shouldn't pull in requests, bs4 and
+    lxml, and loading the URLconf shouldn't pull in the views.
+    """
+    heavy_modules = ("requests", "bs4", "lxml", "amazon_payments.views",
+                     "oscar.apps.checkout.views")
+    # Seconds, for the fastest of a few runs. Importing the package took
+    # around 0.12s before requests and bs4 were loaded lazily.
+    budget = float(os.environ.get("AMAZON_PAYMENTS_IMPORT_BUDGET", "0.1"))
+
+    def time_import(self, module, runs=3):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE="tests.settings")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        timings = []
+        for i in range(runs):
+            output = subprocess.check_output(
+                [sys.executable, "-c", IMPORT_TIME_SCRIPT, module] +
+                list(self.heavy_modules), cwd=root, env=env)
+            elapsed, loaded = output.splitlines()
+            timings.append(float(elapsed))
+        return min(timings), [name for name in loaded.split(",") if name]
+
+    def test_package_import(self):
+        for module in ("amazon_payments", "amazon_payments.api",
+                       "amazon_payments.throttling"):
+            elapsed, loaded = self.time_import(module)
+            self.assertEqual(loaded, [])
+            self.assertLess(elapsed, self.budget)
+
+    def test_urlconf_import(self):
+        elapsed, loaded = self.time_import("amazon_payments.urls", runs=1)
+        self.assertEqual(loaded, [])
+
+    def test_lazy_module(self):
+        module = LazyModule("json")
+        self.assertIs(module.dumps, json.dumps)
+        with patch("json.dumps") as dumps:
+            module.dumps({})
+            dumps.assert_called_once_with({})
+
+
 class ViewTestCase(APITestCase):
     def add_product_to_basket(self, price=Decimal('9.99')):
         product = create_product(price=price, num_in_stock=1)
@@ -141,6 +1370,30 @@ class ViewTestCase(APITestCase):
     def setUp(self):
         # Every test needs access to the request factory.
         self.factory = RequestFactory()
+        cache.clear()
+        reset_payment_types()
+
+    def create_country(self):
+        return Country.objects.create(**{
+            'iso_3166_1_a3': u'USA', 'iso_3166_1_a2': u'US',
+            'name': u'UNITED STATES', 'display_order': 0,
+            'printable_name': u'The United States of America',
+            'iso_3166_1_numeric': 840, 'is_shipping_country': True})
+
+    def checkout_side_effect(self, *args, **kwargs):
+        """
+        Returns a successful response for each action called when
+        placing an order.
+        """
+        response = {
+            "GetBillingAgreementDetails": "subscriptions_consent_given",
+            "CreateOrderReferenceForId": "create_order_reference",
+            "Authorize": "authorize",
+            "GetAuthorizationDetails": "authorization_details",
+            "ConfirmBillingAgreement": "confirm_billing_agreement",
+            "ValidateBillingAgreement": "validate_billing_agreement",
+        }.get(kwargs["params"]["Action"])
+        return self.create_mock_response(RESPONSES.get(response, ""))
 
 
 class BasketViewTestCase(ViewTestCase):
@@ -193,6 +1446,65 @@ class OneStepCheckoutTestCase(ViewTestCase):
             response.context["amazon_payments_billing_agreement_id"] ==
             basket.amazonpaymentssession.billing_agreement_id)
 
+    def test_widgets_are_loaded_asynchronously(self):
+        self.add_product_to_basket()
+        response = self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398"},
+            follow=True)
+        soup = BeautifulSoup(response.content)
+        script = soup.find("script", src=lambda src: src and (
+            "Widgets.js" in src))
+        assert script.has_attr("async")
+        assert "/sandbox/" in script["src"]
+        assert not soup.find("link", rel="preconnect").has_attr(
+            "crossorigin")
+        assert soup.find(id="walletWidgetDiv")
+        assert ("amazonBillingAgreementId: 'C01\\u002D9258635\\u002D6970398'"
+                in response.content)
+
+    def test_consent_widget_is_bound_straight_away(self):
+        # The order can't be placed until the Consent widget is set up, so
+        # it isn't left until it's scrolled into view.
+        template = Template(
+            '{% load amazon_payments_tags %}'
+            '{% amazon_payments_widget "Wallet" "walletWidgetDiv" %}'
+            '{% amazon_payments_widget "Consent" "consentDiv" %}')
+        content = template.render(Context({
+            "amazon_payments_billing_agreement_id": "C01-9258635-6970398"}))
+        wallet, consent = content.split('<div id="consentDiv">')
+        assert wallet.rstrip().endswith("}, true);\n</script>")
+        assert consent.rstrip().endswith("}, false);\n</script>")
+
+    def test_shipping_methods_are_cached(self):
+        self.add_product_to_basket()
+        self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398"})
+        with patch("oscar.apps.shipping.repository.Repository"
+                   ".get_shipping_methods",
+                   side_effect=Repository().get_shipping_methods) as get:
+            response = self.client.get(self.payment_url)
+            order_total = response.context["order_total"]
+            self.client.get(self.payment_url)
+            assert get.call_count == 1
+            # Changing the basket invalidates the cache
+            self.add_product_to_basket(price=Decimal("5.00"))
+            response = self.client.get(self.payment_url)
+            assert get.call_count == 2
+            assert (response.context["order_total"].incl_tax ==
+                    order_total.incl_tax + Decimal("5.00"))
+
+    def test_order_totals_are_not_cached(self):
+        self.add_product_to_basket()
+        self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398"})
+        response = self.client.get(self.payment_url)
+        order_total = response.context["order_total"]
+        # A change that doesn't invalidate the shipping cache
+        StockRecord.objects.update(price_excl_tax=F("price_excl_tax") + 1)
+        response = self.client.get(self.payment_url)
+        assert (response.context["order_total"].excl_tax ==
+                order_total.excl_tax + 1)
+
     def test_error_handling(self):
         self.add_product_to_basket()
         self.client.get(
@@ -208,6 +1520,92 @@ class OneStepCheckoutTestCase(ViewTestCase):
             self.assertIn("Please select a shipping address.",
                           response.content)
 
+    def test_rejected_authorization_can_be_retried(self):
+        self.add_product_to_basket()
+        self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398"},
+            follow=True)
+        self.create_country()
+
+        def side_effect(*args, **kwargs):
+            if kwargs["params"]["Action"] == "Authorize":
+                return self.create_mock_response(
+                    "InvalidOrderReferenceStatus: not confirmed")
+            return self.checkout_side_effect(*args, **kwargs)
+
+        with patch('requests.post') as post:
+            post.side_effect = side_effect
+            self.client.post(self.payment_url, {"place_order": "1"})
+        session = AmazonPaymentsSession.objects.get()
+        assert session.state == AmazonPaymentsSession.ORDER_REFERENCE_CREATED
+        with patch('requests.post') as post:
+            post.side_effect = self.checkout_side_effect
+            self.client.post(self.payment_url, {"place_order": "1"})
+        assert Order.objects.count() == 1
+        assert (AmazonPaymentsSession.objects.get().state ==
+                AmazonPaymentsSession.CAPTURED)
+
+    def test_authorization_timeout(self):
+        """
+        Checks that an Authorize call that timed out isn't treated as
+        failed if it went through.
+        """
+        self.add_product_to_basket()
+        self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398"},
+            follow=True)
+        self.create_country()
+        auth_refs = []
+
+        def side_effect(*args, **kwargs):
+            params = kwargs["params"]
+            if params["Action"] == "Authorize":
+                auth_refs.append(params["AuthorizationReferenceId"])
+                raise requests.ReadTimeout("Read timed out.")
+            elif params["Action"] == "GetOrderReferenceDetails":
+                return self.create_mock_response(
+                    RESPONSES["order_reference_details"])
+            elif params["Action"] == "GetAuthorizationDetails":
+                return self.create_mock_response(
+                    RESPONSES["authorization_details"].replace(
+                        "7-1426862604", auth_refs[-1]))
+            return self.checkout_side_effect(*args, **kwargs)
+
+        with patch('requests.post') as post:
+            post.side_effect = side_effect
+            self.client.post(self.payment_url, {"place_order": "1"})
+        assert len(auth_refs) == 1
+        assert Order.objects.count() == 1
+        auth_attempt = AmazonPaymentsAuthAttempt.objects.get()
+        assert auth_attempt.authorization_id == "S01-6576755-3809974-A067494"
+        assert auth_attempt.reference_id == auth_refs[0]
+
+    def test_authorization_timeout_outcome_unknown(self):
+        self.add_product_to_basket()
+        self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398"},
+            follow=True)
+        self.create_country()
+
+        def side_effect(*args, **kwargs):
+            if kwargs["params"]["Action"] in ("Authorize",
+                                              "GetOrderReferenceDetails"):
+                raise requests.ReadTimeout("Read timed out.")
+            return self.checkout_side_effect(*args, **kwargs)
+
+        with patch('requests.post') as post:
+            post.side_effect = side_effect
+            self.client.post(self.payment_url, {"place_order": "1"})
+            call_count = post.call_count
+            # The order can't be submitted again until the outcome is known
+            self.client.post(self.payment_url, {"place_order": "1"})
+            assert "Authorize" not in [
+                call[1]["params"]["Action"]
+                for call in post.call_args_list[call_count:]]
+        assert not Order.objects.exists()
+        assert (AmazonPaymentsSession.objects.get().state ==
+                AmazonPaymentsSession.AUTHORIZING)
+
     def test_successful_checkout(self):
         self.add_product_to_basket()
         self.client.get(
@@ -260,6 +1658,111 @@ class OneStepCheckoutTestCase(ViewTestCase):
             assert source.amount_allocated == Decimal("9.99")
             assert source.amount_debited == Decimal("9.99")
             assert source.reference == "S01-6576755-3809974-A067494"
+            event = order.payment_events.get()
+            assert event.event_type.name == "Purchase"
+            assert event.line_quantities.get().line == order.lines.get()
+            tx = AmazonPaymentsTransaction.objects.get(action="Authorize")
+            assert tx.status_code == 200
+            assert tx.authorization_id == "S01-6576755-3809974-A067494"
+            auth_attempt = AmazonPaymentsAuthAttempt.objects.get()
+            assert auth_attempt.transaction == tx
+            assert len(auth_attempt.reference_id) == 26
+            assert (auth_attempt.session.state ==
+                    AmazonPaymentsSession.CAPTURED)
+
+    def test_duplicate_submission_reuses_result(self):
+        """
+        Checks that a submission that waited for a concurrent one which
+        placed the order is redirected to the same page without calling
+        Amazon again.
+        """
+        self.add_product_to_basket()
+        self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398"},
+            follow=True)
+        self.create_country()
+        with patch('requests.post') as post:
+            post.side_effect = self.checkout_side_effect
+            response = self.client.post(self.payment_url,
+                                        {"place_order": "1"})
+            thank_you_url = response["Location"]
+            assert thank_you_url.endswith(reverse("checkout:thank-you"))
+            call_count = post.call_count
+            # Simulate the duplicate having loaded the basket and passed the
+            # stock check before the order was placed.
+            StockRecord.objects.update(num_in_stock=1, num_allocated=0)
+            with patch("oscar.apps.basket.middleware.BasketMiddleware"
+                       ".get_basket") as get_basket:
+                get_basket.return_value = Order.objects.get().basket
+                response = self.client.post(self.payment_url,
+                                            {"place_order": "1"})
+            assert response["Location"] == thank_you_url
+            assert post.call_count == call_count
+        assert Order.objects.count() == 1
+
+    def test_expired_lock_does_not_allow_second_authorization(self):
+        self.add_product_to_basket()
+        self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398"},
+            follow=True)
+        self.create_country()
+        # A first submission is still authorizing, but its lock has expired
+        AmazonPaymentsSession.objects.update(
+            state=AmazonPaymentsSession.AUTHORIZING,
+            order_reference_id="S01-6576755-3809974")
+        with patch('requests.post') as post:
+            post.side_effect = self.checkout_side_effect
+            self.client.post(self.payment_url, {"place_order": "1"})
+        actions = [call[1]["params"]["Action"]
+                   for call in post.call_args_list]
+        assert "Authorize" not in actions
+        assert not Order.objects.exists()
+
+    @override_settings(AMAZON_PAYMENTS_SESSION_STORAGE=(
+        "amazon_payments.storage.CacheSessionStorage"))
+    def test_cache_session_storage(self):
+        self.add_product_to_basket()
+        self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398"},
+            follow=True)
+        assert not AmazonPaymentsSession.objects.exists()
+        self.create_country()
+        with patch('requests.post') as post:
+            post.side_effect = self.checkout_side_effect
+            response = self.client.post(self.payment_url, {"place_order": "1"},
+                                        follow=True)
+            assert response.status_code == 200
+        order = Order.objects.get()
+        session = AmazonPaymentsSession.objects.get()
+        assert session.order == order
+        assert session.billing_agreement_id == "C01-9258635-6970398"
+        assert session.order_reference_id == "S01-6576755-3809974"
+        assert set(session.transactions.values_list("action", flat=True)) == {
+            "GetBillingAgreementDetails", "CreateOrderReferenceForId",
+            "SetOrderReferenceDetails", "Authorize", "GetAuthorizationDetails",
+            "ConfirmBillingAgreement", "ValidateBillingAgreement"}
+
+    @override_settings(AMAZON_PAYMENTS_SESSION_STORAGE=(
+        "amazon_payments.storage.SessionSessionStorage"))
+    def test_access_token_expiry(self):
+        self.add_product_to_basket()
+        self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398",
+                             "access_token": "Atza|token",
+                             "expires_in": "3600"})
+        response = self.client.get(self.payment_url)
+        assert response.status_code == 200
+        # Logging in again with a token that's about to expire
+        self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398",
+                             "access_token": "Atza|token",
+                             "expires_in": "30"})
+        with patch('requests.post') as post:
+            response = self.client.post(self.payment_url, {"place_order": "1"},
+                                        follow=True)
+            assert not post.called
+        self.assertRedirects(response, reverse("basket:summary"))
+        assert "Your session has expired." in response.content
 
 
 class MultiStepCheckoutTestCase(ViewTestCase):
@@ -427,6 +1930,94 @@ class MultiStepCheckoutTestCase(ViewTestCase):
             assert source.amount_debited == Decimal("9.99")
             assert source.reference == "S01-6576755-3809974-A067494"
 
+    def capture_background_calls(self):
+        """
+        Patches BackgroundCall in the views, and returns the list that the
+        calls made are added to, so they can be joined.
+        """
+        calls = []
+
+        def background_call(*args, **kwargs):
+            calls.append(BackgroundCall(*args, **kwargs))
+            return calls[-1]
+
+        patcher = patch("amazon_payments.views.BackgroundCall",
+                        side_effect=background_call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return calls
+
+    @override_settings(AMAZON_PAYMENTS_PREFETCH=True)
+    def test_prefetched_order_details(self):
+        self.add_product_to_basket()
+        self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398"},
+            follow=True)
+        self._do_step_one()
+        self.create_country()
+        background_calls = self.capture_background_calls()
+        with patch('requests.post') as post:
+            post.side_effect = self.checkout_side_effect
+            self.client.post(self.shipping_address_url, follow=True)
+            response = self.client.get(self.confirm_order_url)
+            assert response.status_code == 200
+            # Wait for the prefetch thread
+            background_calls[-1].result()
+            actions = [call[1]["params"]["Action"]
+                       for call in post.call_args_list]
+            assert actions[-1] == "GetBillingAgreementDetails"
+            call_count = post.call_count
+            response = self.client.post(
+                self.confirm_order_url, {"action": "place_order"})
+            actions = [call[1]["params"]["Action"]
+                       for call in post.call_args_list[call_count:]]
+            assert "GetBillingAgreementDetails" not in actions
+        assert Order.objects.count() == 1
+        assert "amazon_payments_prefetch" not in self.client.session
+        # The prefetched call is logged too
+        session = AmazonPaymentsSession.objects.get()
+        assert session.transactions.filter(
+            action="GetBillingAgreementDetails").count() == 2
+
+    @override_settings(AMAZON_PAYMENTS_PREFETCH=True)
+    def test_late_prefetch_is_discarded(self):
+        """
+        Checks that details prefetched after the order was placed aren't
+        used by later requests.
+        """
+        self.add_product_to_basket()
+        self.client.get(
+            self.login_url, {"billing_agreement_id": "C01-9258635-6970398"},
+            follow=True)
+        self._do_step_one()
+        self.create_country()
+        background_calls = self.capture_background_calls()
+        prefetching = threading.Event()
+        release = threading.Event()
+
+        def side_effect(*args, **kwargs):
+            if prefetching.is_set():
+                prefetching.clear()
+                release.wait(5)
+            return self.checkout_side_effect(*args, **kwargs)
+
+        with patch('requests.post') as post:
+            post.side_effect = side_effect
+            self.client.post(self.shipping_address_url, follow=True)
+            prefetching.set()
+            self.client.get(self.confirm_order_url)
+            prefetch = background_calls[-1]
+            self.client.post(self.confirm_order_url,
+                             {"action": "place_order"})
+            release.set()
+            prefetch.result()
+        assert Order.objects.count() == 1
+        assert "amazon_payments_prefetch" not in self.client.session
+        view = views.AmazonPaymentDetailsView()
+        request = RequestFactory().post("/")
+        request.session = self.client.session
+        assert view.pop_prefetched_order_details(request) is None
+
     def test_error_in_order_confirmation(self):
         self.add_product_to_basket()
         self.client.get(